@@ -1,11 +1,14 @@
 import os
 import uuid
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Query, Body
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Query, Body, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
 import firebase_admin
-from firebase_admin import credentials, firestore, storage
+from firebase_admin import credentials, firestore, firestore_async, storage
+from google.api_core.exceptions import NotFound
 import google.generativeai as genai
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta, timezone
 from dotenv import load_dotenv
 import re
 import json
@@ -20,9 +23,25 @@ from reportlab.lib.pagesizes import letter, A4
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
-import requests
+import httpx
 from math import radians, sin, cos, sqrt, atan2
 import asyncio
+import hashlib
+import hmac
+import threading
+import time
+import random
+import copy
+import mmap
+import mimetypes
+import zipfile
+import tempfile
+import weakref
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
+import faiss
 
 # Load environment variables from .env
 load_dotenv()
@@ -38,9 +57,37 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Data backend: "firebase" (Firestore + Storage) or "memory" (in-process, for load tests without GCP)
+DATA_BACKEND = os.getenv("DATA_BACKEND", "firebase").lower()
+MEMORY_BACKEND_LATENCY_MS = float(os.getenv("MEMORY_BACKEND_LATENCY_MS", "0"))  # Injected per call
+MEMORY_BACKEND_JITTER_MS = float(os.getenv("MEMORY_BACKEND_JITTER_MS", "0"))  # Uniform extra latency on top
+
+# File storage: "firebase", "memory" or "local" (content-addressed files on disk, served from /files)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", DATA_BACKEND).lower()
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage"))
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "http://localhost:8000")  # How clients reach /files
+FILE_STREAM_CHUNK_SIZE = 256 * 1024
+
+# Direct-to-storage uploads (/upload-url, then /upload-complete)
+UPLOAD_URL_TTL_SECONDS = int(os.getenv("UPLOAD_URL_TTL_SECONDS", "900"))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_PROCESSING_LEASE_SECONDS = int(os.getenv("UPLOAD_PROCESSING_LEASE_SECONDS", "300"))  # A stalled /upload-complete can be retried after this
+# Signs /upload-target URLs for local and in-memory storage. Required with local storage, where the
+# worker that signs a URL is usually not the one that receives the upload (checked at startup)
+UPLOAD_SIGNING_SECRET = os.getenv("UPLOAD_SIGNING_SECRET", "")
+
+# Bulk document deletes and the retry queue for file cleanups that failed
+BULK_DELETE_MAX_DOCUMENTS = int(os.getenv("BULK_DELETE_MAX_DOCUMENTS", "1000"))
+BULK_DELETE_BLOB_CONCURRENCY = int(os.getenv("BULK_DELETE_BLOB_CONCURRENCY", "10"))
+BLOB_CLEANUP_RETRY_SECONDS = int(os.getenv("BLOB_CLEANUP_RETRY_SECONDS", "60"))  # How often each worker polls the queue
+BLOB_CLEANUP_MAX_ATTEMPTS = 8
+
+# /export/{user_id}: files fetched ahead of the one being zipped, which bounds export memory
+EXPORT_PREFETCH = int(os.getenv("EXPORT_PREFETCH", "4"))
+
 # Firebase setup
 FIREBASE_BUCKET = os.getenv("FIREBASE_BUCKET")
-if not firebase_admin._apps:
+if "firebase" in (DATA_BACKEND, STORAGE_BACKEND) and not firebase_admin._apps:
     # Priority order:
     # 1. SERVICE_ACCOUNT_JSON_B64 (for explicit service account in cloud)
     # 2. service-account.json file (for local development)
@@ -71,8 +118,11 @@ if not firebase_admin._apps:
                     f"Either provide service-account.json file or set SERVICE_ACCOUNT_JSON_B64. "
                     f"Error: {str(e)}"
                 )
-db = firestore.client()
-bucket = storage.bucket()
+if DATA_BACKEND == "firebase":
+    # The async client, so Firestore round trips never block the event loop; all access goes through `repo`
+    db = firestore_async.client()
+if STORAGE_BACKEND == "firebase":
+    bucket = storage.bucket()
 
 # Gemini setup
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -85,12 +135,147 @@ if GEMINI_API_KEY:
 else:
     print("⚠️  Warning: GEMINI_API_KEY not set. AI features will use fallback mode.")
 
-# Google Cloud Vision setup
-vision_client = vision.ImageAnnotatorClient()
+# Derived-artifact cache (rendered PDFs etc.)
+# Stored in Firebase Storage by default; set LOCAL_CACHE_DIR to keep them on local disk (development)
+LOCAL_CACHE_DIR = os.getenv("LOCAL_CACHE_DIR", "")
+CACHE_BLOB_PREFIX = "cache"
+
+# Bump whenever the layout of a generated PDF changes so stale renders are not served
+PDF_TEMPLATE_VERSION = "1"
+
+# ReportLab rendering is CPU-bound, so it runs in a small thread pool (created on first render) that
+# bounds how many renders run at once. Render threads still share the GIL with the event loop, which
+# slows other requests during a render but no longer stalls them for its whole duration; a process
+# pool would avoid that, but its spawned workers re-import this module and all its startup work
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", "2"))
+PDF_STREAM_CHUNK_SIZE = 64 * 1024
+
+# PDF styles are immutable once built, so they are shared by every render
+PDF_STYLES = getSampleStyleSheet()
+PDF_SUMMARY_TITLE_STYLE = ParagraphStyle(
+    'CustomTitle',
+    parent=PDF_STYLES['Heading1'],
+    fontSize=24,
+    textColor=colors.HexColor('#FF6D4D'),
+    spaceAfter=30,
+)
+PDF_SUMMARY_HEADING_STYLE = ParagraphStyle(
+    'CustomHeading',
+    parent=PDF_STYLES['Heading2'],
+    fontSize=16,
+    textColor=colors.HexColor('#D5451B'),
+    spaceAfter=12,
+)
+PDF_ITR_TITLE_STYLE = ParagraphStyle(
+    'ITRTitle',
+    parent=PDF_STYLES['Heading1'],
+    fontSize=20,
+    textColor=colors.HexColor('#FF6D4D'),
+    spaceAfter=20,
+)
+PDF_ITR_HEADING_STYLE = ParagraphStyle(
+    'ITRHeading',
+    parent=PDF_STYLES['Heading2'],
+    fontSize=14,
+    textColor=colors.HexColor('#D5451B'),
+    spaceAfter=10,
+)
+PDF_ITR_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#FDF6EB')),
+    ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+])
+PDF_SUMMARY_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#FDF6EB')),
+    ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+    ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+])
+PDF_REGIME_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#FF6D4D')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 12),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor('#FDF6EB')),
+    ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
+    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 1), (-1, -1), 10),
+    ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+])
+
+# Sentence embeddings (loaded lazily on first use)
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+
+# Semantic chat cache for generic (not user-specific) questions
+CHAT_CACHE_ENABLED = os.getenv("CHAT_CACHE_ENABLED", "true").lower() == "true"
+CHAT_CACHE_THRESHOLD = float(os.getenv("CHAT_CACHE_THRESHOLD", "0.92"))  # Cosine similarity
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "5000"))
+CHAT_CACHE_SAVE_EVERY = int(os.getenv("CHAT_CACHE_SAVE_EVERY", "50"))  # Persist after this many new entries
+CHAT_CACHE_TTL_SECONDS = int(os.getenv("CHAT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))  # Answers age out after this
+
+# Write-behind queue for non-critical Firestore writes (chat history, health score snapshots)
+WRITE_BEHIND_MAX_BATCH = min(int(os.getenv("WRITE_BEHIND_MAX_BATCH", "200")), 500)  # Firestore allows 500 writes per batch
+WRITE_BEHIND_FLUSH_SECONDS = float(os.getenv("WRITE_BEHIND_FLUSH_SECONDS", "2"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))  # Oldest writes are dropped past this
+WRITE_BEHIND_MAX_ATTEMPTS = 3
+
+# Conversation memory for chat prompts
+CHAT_MEMORY_TOKEN_BUDGET = int(os.getenv("CHAT_MEMORY_TOKEN_BUDGET", "1200"))  # Summary plus recent turns
+CHAT_MEMORY_SUMMARY_TOKENS = int(os.getenv("CHAT_MEMORY_SUMMARY_TOKENS", "300"))
+CHAT_MEMORY_MAX_RECENT_TURNS = int(os.getenv("CHAT_MEMORY_MAX_RECENT_TURNS", "6"))
+CHAT_MEMORY_FETCH_TURNS = int(os.getenv("CHAT_MEMORY_FETCH_TURNS", "20"))
+
+# Curated tax knowledge base answered without calling Gemini
+KB_ENABLED = os.getenv("KB_ENABLED", "true").lower() == "true"
+KB_PATH = os.getenv("KB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tax_knowledge_base.json"))
+KB_ANSWER_THRESHOLD = float(os.getenv("KB_ANSWER_THRESHOLD", "0.82"))  # Cosine similarity
+KB_PERSONAL_ANSWER_THRESHOLD = float(os.getenv("KB_PERSONAL_ANSWER_THRESHOLD", "0.9"))  # Stricter for "my"/"I" questions
+
+# Retrieval over each user's document text for chat
+DOC_CHUNK_CHARS = int(os.getenv("DOC_CHUNK_CHARS", "800"))
+DOC_CHUNK_OVERLAP = int(os.getenv("DOC_CHUNK_OVERLAP", "120"))
+CHAT_RAG_TOP_K = int(os.getenv("CHAT_RAG_TOP_K", "6"))
+CHAT_RAG_TOKEN_BUDGET = int(os.getenv("CHAT_RAG_TOKEN_BUDGET", "1000"))
+CHAT_RAG_MIN_SCORE = float(os.getenv("CHAT_RAG_MIN_SCORE", "0.25"))
+DOC_INDEX_CACHE_SIZE = int(os.getenv("DOC_INDEX_CACHE_SIZE", "256"))  # Per-user indexes kept in memory
+DOC_INDEX_TTL_SECONDS = int(os.getenv("DOC_INDEX_TTL_SECONDS", "300"))  # Picks up uploads handled by other workers
+
+# Daily deadline reminder sweep (one leader across workers precomputes every user's nudges)
+DEADLINE_SCHEDULER_ENABLED = os.getenv("DEADLINE_SCHEDULER_ENABLED", "true").lower() == "true"
+DEADLINE_SCHEDULER_POLL_SECONDS = int(os.getenv("DEADLINE_SCHEDULER_POLL_SECONDS", "300"))  # Also how often the lease is renewed
+DEADLINE_SCHEDULER_LEASE_SECONDS = int(os.getenv("DEADLINE_SCHEDULER_LEASE_SECONDS", "900"))  # Another worker takes over after this
+CUSTOM_DEADLINE_NUDGE_DAYS = int(os.getenv("CUSTOM_DEADLINE_NUDGE_DAYS", "14"))
+SCHEDULER_WORKER_ID = f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Google Cloud Vision setup (created on first use, so the server can start without GCP credentials)
+@lru_cache(maxsize=1)
+def get_vision_client() -> vision.ImageAnnotatorClient:
+    return vision.ImageAnnotatorClient()
 
 # Google Places API setup
 GOOGLE_PLACES_API_KEY = os.getenv("GOOGLE_PLACES_API_KEY", "")
 PLACES_API_BASE_URL = "https://maps.googleapis.com/maps/api/place"
+PLACES_DETAILS_CONCURRENCY = int(os.getenv("PLACES_DETAILS_CONCURRENCY", "5"))  # Concurrent Place Details calls per request
+PLACES_MAX_CONNECTIONS = int(os.getenv("PLACES_MAX_CONNECTIONS", "20"))  # Shared keep-alive pool per worker
+PLACES_SEARCH_TTL_SECONDS = int(os.getenv("PLACES_SEARCH_TTL_SECONDS", str(60 * 60)))  # Also bounds how stale "is_open" is
+PLACES_DETAILS_TTL_SECONDS = int(os.getenv("PLACES_DETAILS_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+PLACES_CACHE_MAX_ENTRIES = int(os.getenv("PLACES_CACHE_MAX_ENTRIES", "2000"))  # Per cache, in memory per worker
+PLACES_RADIUS_BUCKETS = [1000, 2000, 5000, 10000, 20000, 50000]  # Meters; requests round up to a bucket
+PLACES_SEARCH_KEYWORD = "chartered accountant"
+PLACES_PAGE_TOKEN_RETRIES = 3
+PLACES_PAGE_TOKEN_DELAY_SECONDS = 1.5
+PLACES_PAGE_TOKEN_MAX_AGE_SECONDS = 120  # next_page_token expires shortly after it is issued
+CA_CATALOGUE_ENABLED = os.getenv("CA_CATALOGUE_ENABLED", "true").lower() == "true"
+CA_CATALOGUE_COVERAGE_SECONDS = int(os.getenv("CA_CATALOGUE_COVERAGE_SECONDS", str(24 * 60 * 60)))  # Areas searched this recently are answered from the catalogue
+EARTH_RADIUS_KM = 6371.0
 
 # Document type configurations
 DOCUMENT_TYPES = {
@@ -150,6 +335,22 @@ class ChatRequest(BaseModel):
     message: str
     context: Optional[Dict[str, Any]] = {}
 
+class UploadUrlRequest(BaseModel):
+    user_id: str
+    document_type: str
+    file_name: str
+    content_type: str = "application/pdf"
+    metadata: Optional[Dict[str, Any]] = {}
+
+class UploadCompleteRequest(BaseModel):
+    user_id: str
+    upload_id: str
+
+class BulkDeleteRequest(BaseModel):
+    document_ids: Optional[List[str]] = None
+    document_type: Optional[str] = None
+    financial_year: Optional[str] = None
+
 def convert_firestore_datetime_to_iso(obj: Any) -> Any:
     """Recursively convert Firestore datetime and Timestamp objects to ISO format strings"""
     # Handle Firestore Timestamp objects
@@ -176,15 +377,785 @@ def convert_firestore_datetime_to_iso(obj: Any) -> Any:
     else:
         return obj
 
+# ==================== DATA ACCESS ====================
+
+FIRESTORE_BATCH_LIMIT = 500
+DELETE_DOCUMENT = object()  # Returned by a transform function to delete the document
+
+class Repository:
+    """
+    The single data-access layer behind every handler. Documents and collections are addressed by
+    slash-separated paths ("users/{user_id}/documents/{document_id}") and read back as plain
+    dicts, so handlers never touch client objects. Implemented by FirestoreRepository for
+    production and InMemoryRepository for load tests.
+    """
+    
+    def new_id(self, collection_path: str) -> str:
+        """A fresh auto-generated document ID for a collection"""
+        raise NotImplementedError
+    
+    async def get(self, path: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+    
+    async def get_many(self, paths: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Fetch several documents in one round trip: {path: data} for those that exist"""
+        raise NotImplementedError
+    
+    async def add(self, collection_path: str, data: Dict[str, Any]) -> str:
+        raise NotImplementedError
+    
+    async def set(self, path: str, data: Dict[str, Any], merge: bool = False):
+        raise NotImplementedError
+    
+    async def update(self, path: str, data: Dict[str, Any]):
+        """Update fields of an existing document; raises NotFound if it does not exist"""
+        raise NotImplementedError
+    
+    async def delete(self, path: str):
+        raise NotImplementedError
+    
+    async def query(self, collection_path: str, filters: tuple = (), order_by: Optional[str] = None,
+                    descending: bool = False, limit: Optional[int] = None,
+                    fields: Optional[List[str]] = None) -> List[tuple]:
+        """Run a query over a collection: [(document ID, data)]. filters are (field, op, value)."""
+        raise NotImplementedError
+    
+    async def list_ids(self, collection_path: str) -> List[str]:
+        """IDs in a collection, including documents that only exist as parents of subcollections"""
+        raise NotImplementedError
+    
+    async def iter_ids(self, collection_path: str):
+        """Yield the IDs list_ids returns as they are paged in, for collections too big to hold at once"""
+        raise NotImplementedError
+        yield
+    
+    async def commit(self, writes: List[tuple]):
+        """
+        Apply ("set" | "update" | "delete" | "delete_existing", path, data) writes as batches of up
+        to 500. "delete_existing" fails its whole batch if the document is already gone.
+        """
+        raise NotImplementedError
+    
+    async def transform(self, path: str, fn) -> Any:
+        """
+        Read-modify-write one document in a transaction. fn(current data or None) returns
+        (new data, None to leave it unchanged or DELETE_DOCUMENT, result); the result is returned.
+        """
+        raise NotImplementedError
+
+class FirestoreRepository(Repository):
+    """Repository over the async Firestore client"""
+    
+    def __init__(self, client):
+        self.client = client
+    
+    def new_id(self, collection_path: str) -> str:
+        return self.client.collection(collection_path).document().id
+    
+    async def get(self, path: str) -> Optional[Dict[str, Any]]:
+        snapshot = await self.client.document(path).get()
+        return snapshot.to_dict() if snapshot.exists else None
+    
+    async def get_many(self, paths: List[str]) -> Dict[str, Dict[str, Any]]:
+        found = {}
+        if not paths:
+            return found
+        async for snapshot in self.client.get_all([self.client.document(path) for path in paths]):
+            if snapshot.exists:
+                found[snapshot.reference.path] = snapshot.to_dict()
+        return found
+    
+    async def add(self, collection_path: str, data: Dict[str, Any]) -> str:
+        _, doc_ref = await self.client.collection(collection_path).add(data)
+        return doc_ref.id
+    
+    async def set(self, path: str, data: Dict[str, Any], merge: bool = False):
+        await self.client.document(path).set(data, merge=merge)
+    
+    async def update(self, path: str, data: Dict[str, Any]):
+        await self.client.document(path).update(data)
+    
+    async def delete(self, path: str):
+        await self.client.document(path).delete()
+    
+    async def query(self, collection_path: str, filters: tuple = (), order_by: Optional[str] = None,
+                    descending: bool = False, limit: Optional[int] = None,
+                    fields: Optional[List[str]] = None) -> List[tuple]:
+        query = self.client.collection(collection_path)
+        for field, op, value in filters:
+            query = query.where(field, op, value)
+        if fields is not None:
+            query = query.select(fields)
+        if order_by:
+            query = query.order_by(order_by, direction=firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING)
+        if limit:
+            query = query.limit(limit)
+        return [(doc.id, doc.to_dict()) async for doc in query.stream()]
+    
+    async def list_ids(self, collection_path: str) -> List[str]:
+        return [doc_ref.id async for doc_ref in self.client.collection(collection_path).list_documents()]
+    
+    async def iter_ids(self, collection_path: str):
+        async for doc_ref in self.client.collection(collection_path).list_documents(page_size=FIRESTORE_BATCH_LIMIT):
+            yield doc_ref.id
+    
+    async def commit(self, writes: List[tuple]):
+        for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+            batch = self.client.batch()
+            for op, path, data in writes[start:start + FIRESTORE_BATCH_LIMIT]:
+                doc_ref = self.client.document(path)
+                if op == "set":
+                    batch.set(doc_ref, data)
+                elif op == "update":
+                    batch.update(doc_ref, data)
+                elif op == "delete_existing":
+                    batch.delete(doc_ref, option=self.client.write_option(exists=True))
+                else:
+                    batch.delete(doc_ref)
+            await batch.commit()
+    
+    async def transform(self, path: str, fn) -> Any:
+        doc_ref = self.client.document(path)
+        
+        @firestore.async_transactional
+        async def run(transaction):
+            snapshot = await doc_ref.get(transaction=transaction)
+            new_data, result = fn(snapshot.to_dict() if snapshot.exists else None)
+            if new_data is DELETE_DOCUMENT:
+                transaction.delete(doc_ref)
+            elif new_data is not None:
+                transaction.set(doc_ref, new_data)
+            return result
+        
+        return await run(self.client.transaction())
+
+def _memory_value(value: Any) -> Any:
+    """Store values the way Firestore returns them: server timestamps resolved, datetimes in UTC"""
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, dict):
+        return {key: _memory_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_memory_value(item) for item in value]
+    return value
+
+def _memory_comparable(left: Any, right: Any) -> bool:
+    # Firestore range filters only match values of the same type as the operand
+    if isinstance(left, (int, float)) and not isinstance(left, bool):
+        return isinstance(right, (int, float)) and not isinstance(right, bool)
+    return type(left) is type(right) or (isinstance(left, datetime) and isinstance(right, datetime))
+
+_MEMORY_FILTER_OPS = {
+    "==": lambda field, value: field == value,
+    "!=": lambda field, value: field != value,
+    "<": lambda field, value: _memory_comparable(field, value) and field < value,
+    "<=": lambda field, value: _memory_comparable(field, value) and field <= value,
+    ">": lambda field, value: _memory_comparable(field, value) and field > value,
+    ">=": lambda field, value: _memory_comparable(field, value) and field >= value,
+    "in": lambda field, value: field in value,
+    "not-in": lambda field, value: field not in value,
+    "array_contains": lambda field, value: isinstance(field, list) and value in field,
+    "array_contains_any": lambda field, value: isinstance(field, list) and any(item in field for item in value),
+}
+
+_MISSING = object()
+
+def _memory_field(data: Dict[str, Any], field: str) -> Any:
+    """A possibly dotted field path ("metadata.financial_year"), or _MISSING"""
+    value = data
+    for part in field.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+class InMemoryRepository(Repository):
+    """
+    Process-local repository for load tests and benchmarks. Each call sleeps for the configured
+    latency (plus uniform jitter) to stand in for the Firestore round trip, then works on a dict.
+    """
+    
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.documents: Dict[str, Dict[str, Any]] = {}  # Document path -> data
+        self.lock = asyncio.Lock()
+    
+    async def _round_trip(self):
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+    
+    def _read(self, path: str) -> Optional[Dict[str, Any]]:
+        data = self.documents.get(path)
+        return copy.deepcopy(data) if data is not None else None
+    
+    def _write(self, op: str, path: str, data: Optional[Dict[str, Any]] = None, merge: bool = False):
+        if op in ("delete", "delete_existing"):
+            self.documents.pop(path, None)
+        elif op == "update":
+            if path not in self.documents:
+                raise NotFound(f"No document to update: {path}")
+            self.documents[path].update(copy.deepcopy(_memory_value(data)))
+        elif merge and path in self.documents:
+            self.documents[path].update(copy.deepcopy(_memory_value(data)))
+        else:
+            self.documents[path] = copy.deepcopy(_memory_value(data))
+    
+    def new_id(self, collection_path: str) -> str:
+        return uuid.uuid4().hex[:20]
+    
+    async def get(self, path: str) -> Optional[Dict[str, Any]]:
+        await self._round_trip()
+        return self._read(path)
+    
+    async def get_many(self, paths: List[str]) -> Dict[str, Dict[str, Any]]:
+        await self._round_trip()
+        return {path: self._read(path) for path in paths if path in self.documents}
+    
+    async def add(self, collection_path: str, data: Dict[str, Any]) -> str:
+        await self._round_trip()
+        doc_id = self.new_id(collection_path)
+        self._write("set", f"{collection_path}/{doc_id}", data)
+        return doc_id
+    
+    async def set(self, path: str, data: Dict[str, Any], merge: bool = False):
+        await self._round_trip()
+        self._write("set", path, data, merge)
+    
+    async def update(self, path: str, data: Dict[str, Any]):
+        await self._round_trip()
+        self._write("update", path, data)
+    
+    async def delete(self, path: str):
+        await self._round_trip()
+        self._write("delete", path)
+    
+    async def query(self, collection_path: str, filters: tuple = (), order_by: Optional[str] = None,
+                    descending: bool = False, limit: Optional[int] = None,
+                    fields: Optional[List[str]] = None) -> List[tuple]:
+        await self._round_trip()
+        prefix = f"{collection_path}/"
+        results = []
+        for path, data in self.documents.items():
+            if not path.startswith(prefix) or "/" in path[len(prefix):]:
+                continue
+            if all(
+                _memory_field(data, field) is not _MISSING and _MEMORY_FILTER_OPS[op](_memory_field(data, field), value)
+                for field, op, value in filters
+            ):
+                results.append((path[len(prefix):], data))
+        if order_by:
+            # As in Firestore, documents without the ordering field are left out
+            results = [(doc_id, data) for doc_id, data in results if _memory_field(data, order_by) is not _MISSING]
+            results.sort(key=lambda item: _memory_field(item[1], order_by), reverse=descending)
+        if limit:
+            results = results[:limit]
+        if fields is not None:
+            return [(doc_id, {field: copy.deepcopy(data[field]) for field in fields if field in data}) for doc_id, data in results]
+        return [(doc_id, copy.deepcopy(data)) for doc_id, data in results]
+    
+    async def list_ids(self, collection_path: str) -> List[str]:
+        await self._round_trip()
+        prefix = f"{collection_path}/"
+        return list(dict.fromkeys(
+            path[len(prefix):].split("/", 1)[0] for path in self.documents if path.startswith(prefix)
+        ))
+    
+    async def iter_ids(self, collection_path: str):
+        for document_id in await self.list_ids(collection_path):
+            yield document_id
+    
+    async def commit(self, writes: List[tuple]):
+        for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+            await self._round_trip()
+            chunk = writes[start:start + FIRESTORE_BATCH_LIMIT]
+            # Batches are atomic: check preconditions on existing documents before applying any write
+            for op, path, _ in chunk:
+                if op in ("update", "delete_existing") and path not in self.documents:
+                    raise NotFound(f"No document to {op.split('_')[0]}: {path}")
+            for op, path, data in chunk:
+                self._write(op, path, data)
+    
+    async def transform(self, path: str, fn) -> Any:
+        async with self.lock:
+            await self._round_trip()
+            new_data, result = fn(self._read(path))
+            if new_data is DELETE_DOCUMENT:
+                self._write("delete", path)
+            elif new_data is not None:
+                self._write("set", path, new_data)
+            return result
+
+class BlobStore:
+    """
+    Object storage for uploaded files and cached artifacts, addressed by blob name. Calls block,
+    like the Storage SDK they wrap, so async callers run them with asyncio.to_thread.
+    """
+    
+    def upload(self, name: str, data: Any, content_type: str, public: bool = True) -> str:
+        """
+        Store bytes or a file-like object and return the URL clients download it from.
+        Private blobs (public=False) are only read back through the API, never from that URL.
+        """
+        raise NotImplementedError
+    
+    def download(self, name: str) -> Optional[bytes]:
+        """The blob's bytes, or None if it does not exist"""
+        raise NotImplementedError
+    
+    def size(self, name: str) -> Optional[int]:
+        """The blob's size in bytes from its metadata, or None if it does not exist"""
+        raise NotImplementedError
+    
+    def delete(self, name: str):
+        """Delete a blob; deleting a missing blob is not an error"""
+        raise NotImplementedError
+    
+    def list(self, prefix: str) -> List[str]:
+        raise NotImplementedError
+    
+    def open(self, name: str):
+        """A binary file object for reading the blob in chunks, or None if it does not exist"""
+        data = self.download(name)
+        return io.BytesIO(data) if data is not None else None
+    
+    def name_from_url(self, url: str) -> str:
+        """The blob name behind a URL returned by upload"""
+        raise NotImplementedError
+    
+    def local_path(self, name: str) -> Optional[str]:
+        """A file on this machine holding the blob, for stores that can serve one directly"""
+        return None
+    
+    def create_upload_url(self, name: str, content_type: str, expires_seconds: int,
+                          max_bytes: int) -> Optional[Dict[str, Any]]:
+        """
+        A URL clients can upload at most max_bytes to directly: {"upload_url", "method", "headers"}.
+        None when the store cannot take direct uploads, in which case the API accepts them.
+        """
+        return None
+
+class FirebaseBlobStore(BlobStore):
+    """Blobs in the Firebase Storage bucket, made public on upload as the app expects"""
+    
+    def __init__(self, bucket):
+        self.bucket = bucket
+    
+    def upload(self, name: str, data: Any, content_type: str, public: bool = True) -> str:
+        blob = self.bucket.blob(name)
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            blob.upload_from_string(bytes(data), content_type=content_type)
+        else:
+            data.seek(0)
+            blob.upload_from_file(data, content_type=content_type)
+        if public:
+            # Make the blob publicly readable (or implement signed URLs for security)
+            blob.make_public()
+        return blob.public_url
+    
+    def download(self, name: str) -> Optional[bytes]:
+        try:
+            return self.bucket.blob(name).download_as_bytes()
+        except NotFound:
+            return None
+    
+    def size(self, name: str) -> Optional[int]:
+        blob = self.bucket.get_blob(name)
+        return blob.size if blob is not None else None
+    
+    def delete(self, name: str):
+        try:
+            self.bucket.blob(name).delete()
+        except NotFound:
+            pass
+    
+    def list(self, prefix: str) -> List[str]:
+        return [blob.name for blob in self.bucket.list_blobs(prefix=prefix)]
+    
+    def open(self, name: str):
+        blob = self.bucket.get_blob(name)
+        return blob.open("rb", chunk_size=FILE_STREAM_CHUNK_SIZE) if blob is not None else None
+    
+    def name_from_url(self, url: str) -> str:
+        return url.split(f"{self.bucket.name}/")[-1]
+    
+    def create_upload_url(self, name: str, content_type: str, expires_seconds: int,
+                          max_bytes: int) -> Optional[Dict[str, Any]]:
+        blob = self.bucket.blob(name)
+        # Signed into the URL, so Storage itself rejects an upload larger than max_bytes
+        headers = {"x-goog-resumable": "start", "x-goog-content-length-range": f"0,{max_bytes}"}
+        try:
+            # A V4 signed URL that starts a resumable session; the client POSTs to it, then PUTs to the session
+            url = blob.generate_signed_url(
+                version="v4",
+                expiration=timedelta(seconds=expires_seconds),
+                method="POST",
+                content_type=content_type,
+                headers=headers
+            )
+            return {"upload_url": url, "method": "POST", "headers": {"Content-Type": content_type, **headers}}
+        except Exception as e:
+            # Credentials that cannot sign (e.g. default compute credentials). An unsigned resumable
+            # session cannot cap the upload size, so refuse and let the API take the upload itself
+            print(f"Warning: Could not sign upload URL, uploads will go through the API: {e}")
+            return None
+
+class InMemoryBlobStore(BlobStore):
+    """Process-local blobs for load tests, with the same injected latency as InMemoryRepository"""
+    
+    URL_SCHEME = "memory://"
+    
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.blobs: Dict[str, bytes] = {}
+        self.lock = threading.Lock()
+    
+    def _round_trip(self):
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+    
+    def upload(self, name: str, data: Any, content_type: str, public: bool = True) -> str:
+        self._round_trip()
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data.seek(0)
+            data = data.read()
+        with self.lock:
+            self.blobs[name] = bytes(data)
+        return f"{self.URL_SCHEME}{name}"
+    
+    def download(self, name: str) -> Optional[bytes]:
+        self._round_trip()
+        with self.lock:
+            return self.blobs.get(name)
+    
+    def size(self, name: str) -> Optional[int]:
+        self._round_trip()
+        with self.lock:
+            data = self.blobs.get(name)
+        return len(data) if data is not None else None
+    
+    def delete(self, name: str):
+        self._round_trip()
+        with self.lock:
+            self.blobs.pop(name, None)
+    
+    def list(self, prefix: str) -> List[str]:
+        self._round_trip()
+        with self.lock:
+            return [name for name in self.blobs if name.startswith(prefix)]
+    
+    def name_from_url(self, url: str) -> str:
+        return url[len(self.URL_SCHEME):] if url.startswith(self.URL_SCHEME) else url
+
+class LocalBlobStore(BlobStore):
+    """
+    Blobs on local disk for on-prem deployments and benchmarks. Contents are written once under
+    objects/ by SHA-256, and each blob name under names/ is a hard link to its object, so the
+    link count tracks how many names share the bytes and the object goes with its last name.
+    Files are served by the /files route, except cached artifacts, which stay private.
+    """
+    
+    def __init__(self, root: str, base_url: str):
+        self.root = os.path.abspath(root)
+        self.objects_dir = os.path.join(self.root, "objects")
+        self.names_dir = os.path.join(self.root, "names")
+        self.base_url = base_url.rstrip("/")
+        self.lock = threading.Lock()
+    
+    def local_path(self, name: str) -> str:
+        path = os.path.normpath(os.path.join(self.names_dir, *name.split("/")))
+        if not path.startswith(self.names_dir + os.sep):
+            raise ValueError(f"Invalid blob name: {name}")
+        return path
+    
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest)
+    
+    def _write_object(self, object_path: str, data: memoryview):
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        # Write to a temp file first so concurrent readers never see a partial file
+        tmp_path = f"{object_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, object_path)
+    
+    def _upload_file(self, name: str, f):
+        """Store a file object that may not fit in memory, copying and hashing it in chunks"""
+        os.makedirs(self.objects_dir, exist_ok=True)
+        tmp_object = os.path.join(self.objects_dir, f"{uuid.uuid4().hex}.tmp")
+        digest = hashlib.sha256()
+        f.seek(0)
+        try:
+            with open(tmp_object, "wb") as out:
+                for chunk in iter(lambda: f.read(FILE_STREAM_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    out.write(chunk)
+            object_path = self._object_path(digest.hexdigest())
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            name_path = self.local_path(name)
+            os.makedirs(os.path.dirname(name_path), exist_ok=True)
+            tmp_link = f"{name_path}.{uuid.uuid4().hex}.tmp"
+            with self.lock:
+                for _ in range(2):
+                    try:
+                        # Publish this copy unless the same contents are already stored
+                        os.link(tmp_object, object_path)
+                    except FileExistsError:
+                        pass
+                    try:
+                        os.link(object_path, tmp_link)
+                        break
+                    except FileNotFoundError:
+                        continue  # Another worker deleted the object's last name in between
+                os.replace(tmp_link, name_path)
+        finally:
+            if os.path.exists(tmp_object):
+                os.remove(tmp_object)
+    
+    def upload(self, name: str, data: Any, content_type: str, public: bool = True) -> str:
+        if not isinstance(data, (bytes, bytearray, memoryview, io.BytesIO)):
+            self._upload_file(name, data)
+            return f"{self.base_url}/files/{name}"
+        view = memoryview(data) if isinstance(data, (bytes, bytearray, memoryview)) else data.getbuffer()
+        try:
+            object_path = self._object_path(hashlib.sha256(view).hexdigest())
+            name_path = self.local_path(name)
+            os.makedirs(os.path.dirname(name_path), exist_ok=True)
+            tmp_link = f"{name_path}.{uuid.uuid4().hex}.tmp"
+            with self.lock:
+                if not os.path.exists(object_path):
+                    self._write_object(object_path, view)
+                try:
+                    os.link(object_path, tmp_link)
+                except FileNotFoundError:
+                    # Another worker deleted the object's last name in between
+                    self._write_object(object_path, view)
+                    os.link(object_path, tmp_link)
+                os.replace(tmp_link, name_path)
+        finally:
+            view.release()
+        return f"{self.base_url}/files/{name}"
+    
+    def download(self, name: str) -> Optional[bytes]:
+        try:
+            with open(self.local_path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    
+    def open(self, name: str):
+        try:
+            return open(self.local_path(name), "rb")
+        except FileNotFoundError:
+            return None
+    
+    def size(self, name: str) -> Optional[int]:
+        try:
+            return os.path.getsize(self.local_path(name))
+        except FileNotFoundError:
+            return None
+    
+    def delete(self, name: str):
+        name_path = self.local_path(name)
+        with self.lock:
+            try:
+                links = os.stat(name_path).st_nlink
+            except FileNotFoundError:
+                return
+            object_path = None
+            if links <= 2:  # This name and the object: the object is not shared
+                digest = hashlib.sha256()
+                with open(name_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(FILE_STREAM_CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                object_path = self._object_path(digest.hexdigest())
+            os.remove(name_path)
+            if object_path and os.path.exists(object_path) and os.stat(object_path).st_nlink == 1:
+                os.remove(object_path)
+    
+    def list(self, prefix: str) -> List[str]:
+        names = []
+        for directory, _, files in os.walk(self.names_dir):
+            for file_name in files:
+                if file_name.endswith(".tmp"):
+                    continue
+                name = os.path.relpath(os.path.join(directory, file_name), self.names_dir).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names.append(name)
+        return names
+    
+    def name_from_url(self, url: str) -> str:
+        return url.split("/files/", 1)[-1]
+
+if DATA_BACKEND == "memory":
+    repo: Repository = InMemoryRepository(MEMORY_BACKEND_LATENCY_MS, MEMORY_BACKEND_JITTER_MS)
+    print(f"⚠️  Using the in-memory data backend ({MEMORY_BACKEND_LATENCY_MS:g} ms injected latency); nothing is persisted")
+elif DATA_BACKEND == "firebase":
+    repo = FirestoreRepository(db)
+else:
+    raise ValueError(f"Unknown DATA_BACKEND {DATA_BACKEND!r}; expected 'firebase' or 'memory'")
+
+if STORAGE_BACKEND == "memory":
+    blob_store: BlobStore = InMemoryBlobStore(MEMORY_BACKEND_LATENCY_MS, MEMORY_BACKEND_JITTER_MS)
+    # In-memory blobs only exist in this process, so an upload has to reach the worker that signed it anyway
+    UPLOAD_SIGNING_SECRET = UPLOAD_SIGNING_SECRET or uuid.uuid4().hex
+elif STORAGE_BACKEND == "local":
+    if not UPLOAD_SIGNING_SECRET:
+        raise ValueError("UPLOAD_SIGNING_SECRET must be set with STORAGE_BACKEND=local, the same for every worker")
+    blob_store = LocalBlobStore(LOCAL_STORAGE_DIR, PUBLIC_BASE_URL)
+elif STORAGE_BACKEND == "firebase":
+    blob_store = FirebaseBlobStore(bucket)
+else:
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}; expected 'firebase', 'local' or 'memory'")
+
+def user_path(user_id: str, *parts: str) -> str:
+    """Path under a user's document, e.g. user_path(uid, "documents") -> users/{uid}/documents"""
+    return "/".join(("users", user_id) + parts)
+
+_background_tasks = set()
+
+def spawn_background_task(coro):
+    """Run a coroutine in the background, keeping a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+class WriteBehindQueue:
+    """
+    Buffers non-critical Firestore writes so requests do not wait on them. Writes are committed
+    as batches when WRITE_BEHIND_MAX_BATCH are pending or every WRITE_BEHIND_FLUSH_SECONDS,
+    and whatever is left is flushed on shutdown.
+    """
+    
+    def __init__(self, max_batch: int, flush_seconds: float, max_pending: int):
+        self.max_batch = max_batch
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.pending = []  # (document path, data, attempts), oldest first
+        self.in_flight = []  # Batches being committed, still visible to pending_in until they land
+        self.lock = threading.Lock()
+        self.loop = None
+        self.wake = None
+        self.runner = None
+        self.stats = {"enqueued": 0, "written": 0, "batches": 0, "failed_batches": 0, "dropped": 0}
+    
+    @property
+    def depth(self) -> int:
+        return len(self.pending)
+    
+    def enqueue(self, path: str, data: Dict[str, Any]):
+        """
+        Queue a document write; safe to call from request handlers and worker threads. Needs the
+        queue started or a running event loop: it never starts a loop of its own to flush.
+        """
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is None and self.loop is None:
+            raise RuntimeError("WriteBehindQueue.enqueue needs a running event loop or a started queue")
+        with self.lock:
+            self.pending.append((path, data, 0))
+            self.stats["enqueued"] += 1
+            if len(self.pending) > self.max_pending:
+                del self.pending[0]
+                self.stats["dropped"] += 1
+            full = len(self.pending) >= self.max_batch
+        if self.runner is None:
+            # Flush loop not running (before startup or after shutdown): write straight through
+            if running_loop is not None:
+                spawn_background_task(self.flush())
+            else:
+                asyncio.run_coroutine_threadsafe(self.flush(), self.loop)
+        elif full:
+            self.loop.call_soon_threadsafe(self.wake.set)
+    
+    def pending_in(self, collection_path: str) -> List[Dict[str, Any]]:
+        """Queued documents for a collection, so reads can include writes not yet flushed"""
+        with self.lock:
+            queued = [item for batch in self.in_flight for item in batch] + self.pending
+            return [data for path, data, _ in queued if path.rsplit("/", 1)[0] == collection_path]
+    
+    async def flush(self):
+        """Commit everything pending, one Firestore batch at a time"""
+        while True:
+            with self.lock:
+                items = self.pending[:self.max_batch]
+                del self.pending[:self.max_batch]
+                if items:
+                    self.in_flight.append(items)
+            if not items:
+                return
+            try:
+                await repo.commit([("set", path, data) for path, data, _ in items])
+                with self.lock:
+                    self.in_flight.remove(items)
+                    self.stats["written"] += len(items)
+                    self.stats["batches"] += 1
+            except asyncio.CancelledError:
+                # Stopped mid-commit: requeue so the final flush writes the batch (sets are idempotent)
+                with self.lock:
+                    self.in_flight.remove(items)
+                    self.pending[:0] = items
+                raise
+            except Exception as e:
+                print(f"Warning: Write-behind batch of {len(items)} failed: {e}")
+                retry = [(path, data, attempts + 1) for path, data, attempts in items if attempts + 1 < WRITE_BEHIND_MAX_ATTEMPTS]
+                with self.lock:
+                    self.in_flight.remove(items)
+                    self.stats["failed_batches"] += 1
+                    self.stats["dropped"] += len(items) - len(retry)
+                    self.pending[:0] = retry
+                return  # Retry on the next trigger rather than spinning on a failing backend
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            if self.pending:
+                await self.flush()
+    
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        self.runner = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the flush loop and write out everything still queued"""
+        if self.runner is not None:
+            self.runner.cancel()
+            try:
+                await self.runner
+            except asyncio.CancelledError:
+                pass
+            self.runner = None
+        await self.flush()
+        if self.pending:
+            print(f"Warning: {len(self.pending)} queued writes could not be flushed on shutdown")
+
+write_behind_queue = WriteBehindQueue(WRITE_BEHIND_MAX_BATCH, WRITE_BEHIND_FLUSH_SECONDS, WRITE_BEHIND_MAX_PENDING)
+
+def _read_pdf_text(pdf_content: bytes) -> str:
+    doc = fitz.open(stream=pdf_content, filetype="pdf")
+    text = ""
+    for page in doc:
+        text += page.get_text()
+    doc.close()
+    return text
+
 async def extract_text_from_pdf(pdf_content: bytes) -> str:
-    """Extract text from PDF using PyMuPDF"""
-    try:
-        doc = fitz.open(stream=pdf_content, filetype="pdf")
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        doc.close()
-        return text
+    """Extract text from PDF using PyMuPDF (in a worker thread; parsing is CPU-bound)"""
+    try:
+        return await asyncio.to_thread(_read_pdf_text, pdf_content)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error processing PDF: {str(e)}")
 
@@ -192,7 +1163,7 @@ async def extract_text_from_image(image_content: bytes) -> str:
     """Extract text from image using Google Cloud Vision API"""
     try:
         image = vision.Image(content=image_content)
-        response = vision_client.text_detection(image=image)
+        response = get_vision_client().text_detection(image=image)
         
         if response.error.message:
             raise Exception(response.error.message)
@@ -322,26 +1293,216 @@ async def process_document_with_gemini(document_type: str, extracted_text: str,
             print(f"Using fallback extraction due to error: {error_str}")
             return await extract_metadata_fallback(document_type, extracted_text, user_metadata)
 
-async def upload_file_to_firebase(file_content: bytes, file_name: str, user_id: str) -> str:
-    """Upload file to Firebase Storage and return download URL"""
+# ==================== CONTENT-ADDRESSED BLOBS ====================
+
+# blobs/{sha256} records which stored object holds those bytes and how many documents use it
+BLOB_RECORDS_COLLECTION = "blobs"
+blob_stats = Counter()
+
+def _blob_record_path(blob_hash: str) -> str:
+    return f"{BLOB_RECORDS_COLLECTION}/{blob_hash}"
+
+def _add_blob_reference(record: Dict[str, Any]) -> Dict[str, Any]:
+    return {**record, "ref_count": record.get("ref_count", 0) + 1, "last_referenced_at": datetime.utcnow()}
+
+async def register_blob(blob_hash: str, size: int, put_object) -> str:
+    """
+    Record one more reference to content and return its download URL. Repeat content only gains a
+    reference; otherwise put_object() stores the bytes and returns (blob name, URL). New objects
+    get a fresh generation name, so an upload racing the deletion of the same content's last
+    reference never reuses a doomed object.
+    """
+    record_path = _blob_record_path(blob_hash)
+    
+    def claim_existing(record):
+        if record is None:
+            return None, None
+        return _add_blob_reference(record), record["url"]
+    
+    url = await repo.transform(record_path, claim_existing)
+    if url:
+        blob_stats["deduplicated"] += 1
+        blob_stats["bytes_saved"] += size
+        return url
+    
+    blob_name, uploaded_url = await put_object()
+    
+    def create_record(record):
+        if record is not None:  # The same content was stored concurrently; use that copy
+            return _add_blob_reference(record), (record["url"], False)
+        return {
+            "name": blob_name,
+            "url": uploaded_url,
+            "size": size,
+            "ref_count": 1,
+            "created_at": datetime.utcnow(),
+            "last_referenced_at": datetime.utcnow()
+        }, (uploaded_url, True)
+    
+    url, created = await repo.transform(record_path, create_record)
+    if created:
+        blob_stats["uploaded"] += 1
+    else:
+        blob_stats["deduplicated"] += 1
+        await asyncio.to_thread(blob_store.delete, blob_name)
+    return url
+
+def _blob_generation_name(blob_hash: str, file_name: str) -> str:
+    file_extension = file_name.split('.')[-1]
+    return f"{BLOB_RECORDS_COLLECTION}/{blob_hash[:2]}/{blob_hash}/{uuid.uuid4().hex[:12]}.{file_extension}"
+
+async def store_blob(file_content: bytes, file_name: str) -> tuple:
+    """Store file bytes once however many documents use them: (download URL, content hash)"""
+    blob_hash = hashlib.sha256(file_content).hexdigest()
+    
+    async def put_object():
+        blob_name = _blob_generation_name(blob_hash, file_name)
+        content_type = f"application/{file_name.split('.')[-1]}"
+        return blob_name, await asyncio.to_thread(blob_store.upload, blob_name, file_content, content_type)
+    
+    return await register_blob(blob_hash, len(file_content), put_object), blob_hash
+
+async def release_blob_reference(blob_hash: str) -> Optional[str]:
+    """
+    Drop one document's reference to a blob. Returns the object name once the last reference is
+    gone, for the caller to delete; the record is removed in the same transaction.
+    """
+    def release(record):
+        if record is None:
+            return None, None
+        ref_count = record.get("ref_count", 1) - 1
+        if ref_count > 0:
+            return {**record, "ref_count": ref_count}, None
+        return DELETE_DOCUMENT, record["name"]
+    
+    return await repo.transform(_blob_record_path(blob_hash), release)
+
+async def delete_blob_object(blob_name: str):
+    await asyncio.to_thread(blob_store.delete, blob_name)
+    blob_stats["deleted"] += 1
+
+async def release_blob(blob_hash: str) -> bool:
+    """Drop one document's reference to a blob, deleting the object with the last one. Returns True if deleted."""
+    blob_name = await release_blob_reference(blob_hash)
+    if blob_name is None:
+        return False
+    await delete_blob_object(blob_name)
+    return True
+
+# Failed cleanups are retried from blob_cleanup_queue/{id}. Each step is retried on its own, so a
+# reference is never released twice: "release" items did not commit, "delete_object" items did.
+BLOB_CLEANUP_QUEUE = "blob_cleanup_queue"
+
+async def enqueue_blob_cleanup(kind: str, target: str, error: str):
+    await repo.set(f"{BLOB_CLEANUP_QUEUE}/{uuid.uuid4().hex}", {
+        "kind": kind,
+        "target": target,
+        "status": "pending",
+        "attempts": 0,
+        "last_error": error,
+        "next_attempt_at": datetime.now(timezone.utc),
+        "created_at": datetime.now(timezone.utc)
+    })
+    blob_stats["cleanup_queued"] += 1
+
+async def take_document(doc_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Delete a document and return its data, or None if it was already gone. Only one of several
+    overlapping deletes (e.g. a client retry) gets the data, so only that one releases its file.
+    """
+    def take(doc_data):
+        if doc_data is None:
+            return None, None
+        return DELETE_DOCUMENT, doc_data
+    
+    return await repo.transform(doc_path, take)
+
+async def cleanup_document_file(doc_data: Dict[str, Any]) -> str:
+    """
+    Remove a deleted document's file, or its reference to shared content. Returns "deleted",
+    "shared" (other documents still use the bytes), "none" or "queued" (handed to the retry queue).
+    """
+    if doc_data.get('blob_hash'):
+        try:
+            # Shared content is only removed once no other document references it
+            blob_name = await release_blob_reference(doc_data['blob_hash'])
+        except Exception as e:
+            await enqueue_blob_cleanup("release", doc_data['blob_hash'], str(e))
+            return "queued"
+        if blob_name is None:
+            return "shared"
+    elif doc_data.get('file_url'):
+        # Extract blob name from URL (documents uploaded before content addressing)
+        blob_name = blob_store.name_from_url(doc_data['file_url'])
+    else:
+        return "none"
     try:
-        # Create a unique file path
-        file_extension = file_name.split('.')[-1]
-        unique_filename = f"{user_id}/{uuid.uuid4()}.{file_extension}"
-        
-        # Upload to Firebase Storage
-        blob = bucket.blob(unique_filename)
-        blob.upload_from_string(file_content, content_type=f'application/{file_extension}')
-        
-        # Make the blob publicly readable (or implement signed URLs for security)
-        blob.make_public()
-        
-        return blob.public_url
+        await delete_blob_object(blob_name)
+    except Exception as e:
+        await enqueue_blob_cleanup("delete_object", blob_name, str(e))
+        return "queued"
+    return "deleted"
+
+async def retry_blob_cleanups() -> int:
+    """Claim and run due cleanup retries; several workers can poll the same queue safely"""
+    now = datetime.now(timezone.utc)
+    due = await repo.query(BLOB_CLEANUP_QUEUE, (('status', '==', 'pending'), ('next_attempt_at', '<=', now)),
+                           order_by='next_attempt_at', limit=50)
+    done = 0
+    for item_id, _ in due:
+        path = f"{BLOB_CLEANUP_QUEUE}/{item_id}"
+        
+        def claim(item):
+            # Pushing next_attempt_at out doubles as a lease: other workers skip the item meanwhile
+            if item is None or item["status"] != "pending" or item["next_attempt_at"] > now:
+                return None, None
+            attempts = item["attempts"] + 1
+            backoff = BLOB_CLEANUP_RETRY_SECONDS * 2 ** min(attempts, 10)
+            return {**item, "attempts": attempts, "next_attempt_at": now + timedelta(seconds=backoff)}, item
+        
+        item = await repo.transform(path, claim)
+        if item is None:
+            continue
+        try:
+            if item["kind"] == "release":
+                blob_name = await release_blob_reference(item["target"])
+                if blob_name is not None:
+                    # The reference is released now, so only the object delete may be retried
+                    await repo.set(path, {**item, "kind": "delete_object", "target": blob_name, "attempts": 0})
+                    await delete_blob_object(blob_name)
+            else:
+                await delete_blob_object(item["target"])
+            await repo.delete(path)
+            done += 1
+        except Exception as e:
+            update = {"last_error": str(e)}
+            if item["attempts"] + 1 >= BLOB_CLEANUP_MAX_ATTEMPTS:
+                update["status"] = "dead"  # Left for manual inspection
+            await repo.update(path, update)
+    return done
+
+async def run_blob_cleanup_retries():
+    while True:
+        await asyncio.sleep(BLOB_CLEANUP_RETRY_SECONDS)
+        try:
+            retried = await retry_blob_cleanups()
+            if retried:
+                print(f"Blob cleanup: {retried} queued cleanups completed")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Warning: Blob cleanup retry pass failed: {e}")
+
+async def upload_file_to_firebase(file_content: bytes, file_name: str, user_id: str) -> tuple:
+    """Upload file to the blob store, deduplicated by content: (download URL, content hash)"""
+    try:
+        return await store_blob(file_content, file_name)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
 
 async def store_document_metadata(user_id: str, document_type: str, file_url: str, 
-                                extracted_metadata: Dict[str, Any], user_metadata: Dict[str, Any]) -> str:
+                                extracted_metadata: Dict[str, Any], user_metadata: Dict[str, Any],
+                                blob_hash: Optional[str] = None) -> str:
     """Store document metadata in Firestore"""
     try:
         # Combine user metadata with extracted metadata
@@ -352,6 +1513,7 @@ async def store_document_metadata(user_id: str, document_type: str, file_url: st
             "user_id": user_id,
             "document_type": document_type,
             "file_url": file_url,
+            "blob_hash": blob_hash,
             "uploaded_at": datetime.utcnow(),
             "status": "processed",
             "metadata": combined_metadata,
@@ -359,16 +1521,18 @@ async def store_document_metadata(user_id: str, document_type: str, file_url: st
         }
         
         # Store in Firestore
-        doc_ref = db.collection('users').document(user_id).collection('documents').add(document_data)
-        
-        return doc_ref[1].id
+        return await repo.add(user_path(user_id, 'documents'), document_data)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error storing metadata: {str(e)}")
 
-async def process_chat_with_gemini(user_message: str, context: Dict[str, Any]) -> Dict[str, Any]:
-    """Process chat message with Gemini AI and return response with action chips and follow-ups"""
-    
-    # Build context string from user's documents and profile
+DEFAULT_FOLLOW_UP_QUESTIONS = [
+    "What documents do I need to file my ITR?",
+    "What are the tax deduction options available?",
+    "When is the ITR filing deadline?"
+]
+
+def build_chat_context_str(context: Dict[str, Any]) -> str:
+    """Build the prompt context string from user's documents and profile"""
     context_str = ""
     if context:
         if 'documents' in context and context['documents']:
@@ -378,9 +1542,29 @@ async def process_chat_with_gemini(user_message: str, context: Dict[str, Any]) -
                 metadata = doc.get('metadata', {})
                 context_str += f"• {doc_type}: {', '.join([f'{k}={v}' for k, v in list(metadata.items())[:3]])}\n"
         
+        if context.get('document_excerpts'):
+            context_str += "\nRelevant excerpts from the user's documents:\n"
+            for excerpt in context['document_excerpts']:
+                context_str += f"[{excerpt['document_type']}] {excerpt['text']}\n---\n"
+        
         if 'user_profile' in context:
             profile = context['user_profile']
             context_str += f"\nUser Profile: {profile}\n"
+        
+        conversation = context.get('conversation')
+        if conversation:
+            if conversation['summary']:
+                context_str += f"\nSummary of the earlier conversation: {conversation['summary']}\n"
+            if conversation['recent_turns']:
+                context_str += "\nRecent conversation:\n"
+                context_str += "\n".join(format_chat_turn(turn) for turn in conversation['recent_turns']) + "\n"
+    return context_str
+
+async def process_chat_with_gemini(user_message: str, context: Dict[str, Any]) -> Dict[str, Any]:
+    """Answer a chat message with Gemini; follow-ups and action chips are chosen locally"""
+    
+    # Build context string from user's documents and profile
+    context_str = build_chat_context_str(context)
     
     prompt = f"""
     You are a helpful tax assistant for an Indian tax filing application. The user is asking about tax-related questions.
@@ -390,6 +1574,9 @@ async def process_chat_with_gemini(user_message: str, context: Dict[str, Any]) -
     
     User Question: {user_message}
     
+    If the context includes the conversation so far, use it to resolve follow-up questions
+    and do not ask for details the user has already given.
+    
     Please provide a helpful, accurate, and concise response. Focus on:
     1. Direct answers to the user's question
     2. Relevant tax information for India
@@ -397,29 +1584,9 @@ async def process_chat_with_gemini(user_message: str, context: Dict[str, Any]) -
     4. Clear explanations without unnecessary jargon
     
     Keep your response focused and to the point. Avoid very long explanations unless specifically requested.
-    
-    After your response, suggest 2-4 relevant follow-up questions that the user might want to ask next.
-    Also suggest 2-4 action chips (quick actions) that would be helpful based on the conversation.
-    
-    Format your response as JSON with:
-    {{
-        "response": "your main response text",
-        "follow_up_questions": ["question 1", "question 2", "question 3"],
-        "action_chips": [
-            {{"label": "Action name", "type": "action_type", "data": {{}}}},
-            ...
-        ]
-    }}
-    
-    Action types can be:
-    - "find_ca": Find nearby Chartered Accountants
-    - "view_deadlines": View tax deadlines
-    - "upload_document": Upload a document
-    - "calculate_tax": Calculate tax
-    - "view_summary": View tax summary
-    - "chat": Continue conversation with a specific question
-    
-    Only include relevant actions based on the conversation context.
+    Format the answer as 3-8 concise bullet points starting with "• " (1-2 lines each, no repetition).
+    If the answer is very short, reply with a single plain sentence instead.
+    Return only the answer text, no JSON and no headings.
     """
     
     try:
@@ -427,12 +1594,7 @@ async def process_chat_with_gemini(user_message: str, context: Dict[str, Any]) -
         if not GEMINI_API_KEY:
             return {
                 "response": "I'm sorry, but the AI assistant is currently unavailable. Please try again later or contact support.",
-                "follow_up_questions": [
-                    "What documents do I need to file my ITR?",
-                    "What are the tax deduction options available?",
-                    "When is the ITR filing deadline?"
-                ],
-                "action_chips": []
+                "fallback": True
             }
         
         model = genai.GenerativeModel('gemini-2.0-flash')
@@ -443,127 +1605,1024 @@ async def process_chat_with_gemini(user_message: str, context: Dict[str, Any]) -
                 asyncio.to_thread(model.generate_content, prompt),
                 timeout=30.0  # 30 second timeout
             )
-            response_text = response.text
+            return {"response": response.text}
         except asyncio.TimeoutError:
             return {
                 "response": "I'm sorry, but the request timed out. Please try again with a shorter question.",
-                "follow_up_questions": [
-                    "What documents do I need to file my ITR?",
-                    "What are the tax deduction options available?"
-                ],
-                "action_chips": []
+                "fallback": True
             }
         except Exception as api_error:
             error_str = str(api_error)
             if "DNS" in error_str or "503" in error_str or "timeout" in error_str.lower() or "network" in error_str.lower() or "resolution failed" in error_str.lower():
                 return {
                     "response": "I'm sorry, but I'm having trouble connecting to the AI service. Please check your internet connection and try again later.",
-                    "follow_up_questions": [
-                        "What documents do I need to file my ITR?",
-                        "What are the tax deduction options available?"
-                    ],
-                    "action_chips": []
+                    "fallback": True
                 }
             else:
                 raise
-        
-        # Try to parse JSON response
-        try:
-            # Extract JSON from markdown code blocks if present
-            json_match = re.search(r'```json\s*(\{.*?\})\s*```', response_text, re.DOTALL)
-            if json_match:
-                response_text = json_match.group(1)
-            else:
-                # Try to find JSON object directly
-                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                if json_match:
-                    response_text = json_match.group(0)
-            
-            parsed = json.loads(response_text)
-            return parsed
-        except:
-            # If JSON parsing fails, return as plain text with defaults
-            return {
-                "response": response_text,
-                "follow_up_questions": [
-                    "What documents do I need to file my ITR?",
-                    "What are the tax deduction options available?",
-                    "When is the ITR filing deadline?"
-                ],
-                "action_chips": []
-            }
     except HTTPException:
         raise
     except Exception as e:
         # Return a user-friendly error instead of crashing
         return {
             "response": f"I apologize, but I encountered an error processing your request. Please try again later. Error: {str(e)[:100]}",
-            "follow_up_questions": [
-                "What documents do I need to file my ITR?",
-                "What are the tax deduction options available?"
-            ],
-            "action_chips": []
+            "fallback": True
         }
 
-async def sanitize_chat_response(raw_response: str) -> str:
-    """Sanitize and format chat response into bullet points"""
+# Local chat response formatting (replaces a second LLM round trip per chat turn)
+CHAT_MAX_BULLETS = 8
+CHAT_BULLET_MAX_CHARS = 220
+CHAT_SHORT_RESPONSE_CHARS = 200
+CHAT_BULLET_RE = re.compile(r'^\s*(?:[-*•●▪◦‣]|\d{1,2}[.)])\s+')
+CHAT_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s+(?=[A-Z₹0-9"(])')
+CHAT_ABBREVIATIONS = ("rs.", "e.g.", "i.e.", "etc.", "sec.", "no.", "vs.", "approx.", "u/s.")
+
+def _strip_markdown(text: str) -> str:
+    """Remove markdown decoration that the app does not render"""
+    text = re.sub(r'```[a-zA-Z]*', '', text)
+    text = re.sub(r'^\s*#{1,6}\s*', '', text, flags=re.MULTILINE)
+    text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)
+    text = re.sub(r'__(.+?)__', r'\1', text)
+    text = re.sub(r'(?<![\w*])\*(?!\s)([^*\n]+?)(?<!\s)\*(?![\w*])', r'\1', text)
+    text = re.sub(r'\[([^\]]+)\]\([^)]+\)', r'\1', text)
+    return text
+
+def _split_sentences(paragraph: str) -> List[str]:
+    """Split a paragraph into sentences without breaking on common abbreviations"""
+    sentences = []
+    for fragment in CHAT_SENTENCE_SPLIT_RE.split(paragraph):
+        if sentences and sentences[-1].lower().endswith(CHAT_ABBREVIATIONS):
+            sentences[-1] = f"{sentences[-1]} {fragment}"
+        else:
+            sentences.append(fragment)
+    return [s.strip() for s in sentences if s.strip()]
+
+def _shorten_point(point: str) -> str:
+    """Keep a bullet to roughly two lines, preferring a sentence boundary"""
+    point = re.sub(r'\s+', ' ', point).strip()
+    if len(point) <= CHAT_BULLET_MAX_CHARS:
+        return point
+    
+    sentences = _split_sentences(point)
+    shortened = ""
+    for sentence in sentences:
+        candidate = f"{shortened} {sentence}".strip()
+        if len(candidate) > CHAT_BULLET_MAX_CHARS:
+            break
+        shortened = candidate
+    if shortened:
+        return shortened
+    
+    cut = point[:CHAT_BULLET_MAX_CHARS].rsplit(' ', 1)[0]
+    return cut.rstrip(',;:') + "…"
+
+def _point_tokens(point: str) -> set:
+    """Normalised word set used to spot repeated points"""
+    return set(re.findall(r'[a-z0-9₹]+', point.lower()))
+
+def _is_repeat(tokens: set, seen: List[set]) -> bool:
+    """A point repeats an earlier one if their word sets mostly overlap"""
+    for previous in seen:
+        overlap = len(tokens & previous)
+        if overlap and overlap / min(len(tokens), len(previous)) >= 0.8:
+            return True
+    return False
+
+def sanitize_chat_response(raw_response: str) -> str:
+    """Sanitize and format chat response into concise, de-duplicated bullet points"""
     
+    if not raw_response:
+        return ""
+    
+    try:
+        text = _strip_markdown(raw_response).strip()
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        
+        # If the response is already very short, just clean it up without forcing bullet points
+        if len(text) <= CHAT_SHORT_RESPONSE_CHARS and not any(CHAT_BULLET_RE.match(line) for line in lines):
+            return re.sub(r'\s+', ' ', text)
+        
+        # Collect candidate points, keeping the model's own list structure where it has one
+        points = []
+        if any(CHAT_BULLET_RE.match(line) for line in lines):
+            previous_was_bullet = False
+            for line in lines:
+                if CHAT_BULLET_RE.match(line):
+                    points.append(CHAT_BULLET_RE.sub('', line))
+                    previous_was_bullet = True
+                elif previous_was_bullet and line[:1].islower():
+                    # Wrapped continuation of the previous bullet
+                    points[-1] = f"{points[-1]} {line}"
+                elif line.endswith(':') and len(line) < 60:
+                    # Lead-in lines such as "Here are your options:" add nothing as bullets
+                    previous_was_bullet = False
+                else:
+                    points.extend(_split_sentences(line))
+                    previous_was_bullet = False
+        else:
+            for line in lines:
+                points.extend(_split_sentences(line))
+        
+        # Remove repetition and keep each point concise
+        bullets = []
+        seen = []
+        for point in points:
+            point = _shorten_point(point)
+            tokens = _point_tokens(point)
+            if not tokens or _is_repeat(tokens, seen):
+                continue
+            seen.append(tokens)
+            bullets.append(point)
+            if len(bullets) >= CHAT_MAX_BULLETS:
+                break
+        
+        if not bullets:
+            return raw_response.strip()
+        if len(bullets) == 1:
+            return bullets[0]
+        return "\n".join(f"• {bullet}" for bullet in bullets)
+    except Exception as e:
+        # If formatting fails for any reason, return the original response
+        print(f"Warning: Chat response formatting failed: {e}. Returning original response.")
+        return raw_response
+
+async def stream_chat_with_gemini(user_message: str, context: Dict[str, Any]):
+    """Stream the chat answer from Gemini as text chunks while it is being generated"""
+    
+    if not GEMINI_API_KEY:
+        yield "I'm sorry, but the AI assistant is currently unavailable. Please try again later or contact support."
+        return
+    
+    context_str = build_chat_context_str(context)
+    
+    # The answer is shown as it streams, so ask for the final bullet format directly
     prompt = f"""
-    You are a response formatting expert. Take the following tax-related response and format it into clear, concise bullet points.
+    You are a helpful tax assistant for an Indian tax filing application. The user is asking about tax-related questions.
+    
+    Context Information:
+    {context_str}
+    
+    User Question: {user_message}
     
-    Raw Response:
-    {raw_response}
+    If the context includes the conversation so far, use it to resolve follow-up questions
+    and do not ask for details the user has already given.
     
-    Please:
-    1. Convert the response into bullet points (•)
-    2. Keep each bullet point concise (1-2 lines max)
-    3. Remove any unnecessary repetition
-    4. Maintain the key information and accuracy
-    5. Use clear, simple language
-    6. Limit to 5-8 bullet points maximum
-    7. If the response is already very short, just clean it up without forcing bullet points
+    Please provide a helpful, accurate, and concise response. Focus on:
+    1. Direct answers to the user's question
+    2. Relevant tax information for India
+    3. Practical advice when applicable
+    4. Clear explanations without unnecessary jargon
     
-    Return only the formatted response, no additional text.
+    Format the answer as 3-8 concise bullet points starting with "• " (1-2 lines each).
+    If the answer is very short, reply with a single plain sentence instead.
+    Return only the answer text, no JSON and no headings.
     """
     
-    try:
-        # Check if Gemini API key is configured
-        if not GEMINI_API_KEY:
-            return raw_response
-        
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        # Try to generate content with timeout
+    model = genai.GenerativeModel('gemini-2.0-flash')
+    
+    response = await asyncio.wait_for(model.generate_content_async(prompt, stream=True), timeout=30.0)
+    chunks = response.__aiter__()
+    while True:
         try:
-            response = await asyncio.wait_for(
-                asyncio.to_thread(model.generate_content, prompt),
-                timeout=15.0  # 15 second timeout for sanitization
-            )
-            return response.text.strip()
-        except (asyncio.TimeoutError, Exception) as e:
-            error_str = str(e)
-            # If sanitization fails (timeout, DNS, network error), return the original response
-            if "DNS" in error_str or "503" in error_str or "timeout" in error_str.lower() or "network" in error_str.lower() or "resolution failed" in error_str.lower():
-                print(f"Warning: Chat response sanitization failed: {error_str}. Returning original response.")
-            return raw_response
-    except Exception as e:
-        # If sanitization fails for any reason, return the original response
-        return raw_response
+            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=30.0)
+        except StopAsyncIteration:
+            break
+        if chunk.text:
+            yield chunk.text
 
-@app.post("/upload-document")
-async def upload_document(
-    user_id: str = Form(...),
-    document_type: str = Form(...),
-    file: UploadFile = File(...),
-    metadata: str = Form("{}")  # JSON string of additional metadata
-):
+def chat_stream_error_message(error: Exception) -> str:
+    """User-facing text for a chat stream that failed part way"""
+    if isinstance(error, asyncio.TimeoutError):
+        return "I'm sorry, but the request timed out. Please try again with a shorter question."
+    error_str = str(error)
+    if "DNS" in error_str or "503" in error_str or "timeout" in error_str.lower() or "network" in error_str.lower() or "resolution failed" in error_str.lower():
+        return "I'm sorry, but I'm having trouble connecting to the AI service. Please check your internet connection and try again later."
+    return f"I apologize, but I encountered an error processing your request. Please try again later. Error: {error_str[:100]}"
+
+def sse_event(event: str, data: Any) -> str:
+    """Format a Server-Sent Event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# ==================== SEMANTIC CHAT CACHE ====================
+
+_embedding_model = None
+_embedding_model_lock = threading.Lock()
+
+def get_embedding_model():
+    """Load the sentence-transformers model once per process"""
+    global _embedding_model
+    if _embedding_model is None:
+        with _embedding_model_lock:
+            if _embedding_model is None:
+                # Deferred import: sentence-transformers pulls in torch, which slows startup
+                from sentence_transformers import SentenceTransformer
+                _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    return _embedding_model
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """Embed texts as L2-normalised float32 vectors, so inner product is cosine similarity"""
+    vectors = get_embedding_model().encode(texts, normalize_embeddings=True, convert_to_numpy=True)
+    return np.asarray(vectors, dtype='float32')
+
+PERSONAL_QUESTION_RE = re.compile(r"\b(?:my|mine|me|i|i'm|i've|i'd|i'll|our|ours|we|us)\b", re.IGNORECASE)
+# Follow-ups that only make sense with the earlier conversation ("what about seniors?", "is that taxable?"):
+# a leading connective or pronoun, or a short question whose only subject is a pronoun. A pronoun
+# elsewhere ("Is it mandatory to link PAN?", "What is this form used for?") does not count.
+CONTEXT_DEPENDENT_RE = re.compile(
+    r"^\s*(?:and|also|so|then|what about|how about|that|this|it|those|these|same)\b"
+    r"|^\s*(?:(?:how|why|what|when|where)\s+)?(?:is|are|was|were|does|do|did|can|could|will|would|should)\s+"
+    r"(?:that|this|it|those|these)\b(?:\s+[\w'-]+){0,2}\s*[?.!]*\s*$",
+    re.IGNORECASE
+)
+
+# Questions about the user's uploads ("Explain the uploaded Form 16") need their documents even without "my"
+DOCUMENT_REFERENCE_RE = re.compile(r"\b(?:upload(?:ed|s)?|attached|attachment|documents?|files?|pdfs?|scan(?:ned)?)\b", re.IGNORECASE)
+
+def is_generic_chat_question(message: str) -> bool:
+    """Generic questions have one answer for everyone, so their answers can be shared"""
+    return not (
+        PERSONAL_QUESTION_RE.search(message)
+        or CONTEXT_DEPENDENT_RE.search(message)
+        or DOCUMENT_REFERENCE_RE.search(message)
+    )
+
+@lru_cache(maxsize=1)
+def _knowledge_base_digest() -> str:
+    try:
+        with open(KB_PATH, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()[:12]
+    except OSError:
+        return "none"
+
+def chat_cache_version() -> str:
+    """Cached answers are only reused within the financial year and knowledge base they were given under"""
+    return f"{financial_year_for(date.today())}:{_knowledge_base_digest()}"
+
+class SemanticChatCache:
     """
-    Upload and process tax documents with AI-powered extraction
+    LRU cache of answers to generic chat questions, looked up by FAISS nearest neighbour. Entries
+    expire after a TTL or when the financial year or knowledge base changes. Every worker keeps its
+    own cache and merges it into the persisted copy on save, so workers do not clobber each other.
     """
-    try:
-        # Validate document type
-        if document_type not in DOCUMENT_TYPES:
-            raise HTTPException(status_code=400, detail=f"Invalid document type. Allowed types: {list(DOCUMENT_TYPES.keys())}")
+    
+    def __init__(self, threshold: float, max_entries: int, ttl_seconds: int, artifact_prefix: str = "chat_cache"):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.index_path = f"{artifact_prefix}/index.faiss"
+        self.entries_path = f"{artifact_prefix}/entries.json"
+        self.index = None  # Created on first insert, once the embedding size is known
+        self.entries = OrderedDict()  # Entry id -> cached answer, least recently used first
+        self.next_id = 0
+        self.unsaved_entries = 0
+        self.lock = threading.Lock()
+    
+    def _is_current(self, entry: Dict[str, Any]) -> bool:
+        return (
+            entry.get("version") == chat_cache_version()
+            and time.time() - entry.get("cached_at", 0) < self.ttl_seconds
+        )
+    
+    def lookup(self, vector: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Return the cached answer for the closest previous question above the threshold"""
+        with self.lock:
+            if self.index is None or self.index.ntotal == 0:
+                return None
+            scores, ids = self.index.search(vector.reshape(1, -1), 1)
+            entry_id = int(ids[0][0])
+            if entry_id == -1 or scores[0][0] < self.threshold or entry_id not in self.entries:
+                return None
+            entry = self.entries[entry_id]
+            if not self._is_current(entry):
+                del self.entries[entry_id]
+                self.index.remove_ids(np.array([entry_id], dtype='int64'))
+                return None
+            self.entries.move_to_end(entry_id)
+            return {**entry["answer"], "similarity": float(scores[0][0])}
+    
+    def add(self, vector: np.ndarray, question: str, answer: Dict[str, Any]) -> bool:
+        """Insert an answer, evicting the least recently used entries past capacity.
+        Returns True when enough new entries have accumulated to be worth persisting."""
+        with self.lock:
+            if self.index is None:
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[0]))
+            entry_id = self.next_id
+            self.next_id += 1
+            self.index.add_with_ids(vector.reshape(1, -1), np.array([entry_id], dtype='int64'))
+            self.entries[entry_id] = {
+                "key": uuid.uuid4().hex,  # Identifies the entry across workers when caches are merged
+                "question": question,
+                "answer": answer,
+                "cached_at": time.time(),
+                "version": chat_cache_version()
+            }
+            
+            while len(self.entries) > self.max_entries:
+                evicted_id, _ = self.entries.popitem(last=False)
+                self.index.remove_ids(np.array([evicted_id], dtype='int64'))
+            
+            self.unsaved_entries += 1
+            return self.unsaved_entries >= CHAT_CACHE_SAVE_EVERY
+    
+    def _read_persisted(self) -> List[tuple]:
+        """(entry, vector) pairs from the persisted cache, least recently used first"""
+        index_bytes = read_cached_artifact(self.index_path)
+        entries_bytes = read_cached_artifact(self.entries_path)
+        if index_bytes is None or entries_bytes is None:
+            return []
+        index = faiss.deserialize_index(np.frombuffer(index_bytes, dtype='uint8'))
+        return [
+            (entry, index.reconstruct(int(entry_id)))
+            for entry_id, entry in json.loads(entries_bytes)["entries"]
+        ]
+    
+    def save(self):
+        """Merge this worker's entries into the persisted cache, dropping expired ones"""
+        with self.lock:
+            if self.index is None or self.unsaved_entries == 0:
+                return
+            ours = [(entry, self.index.reconstruct(entry_id)) for entry_id, entry in self.entries.items()]
+            self.unsaved_entries = 0
+        try:
+            theirs = self._read_persisted()
+        except Exception as e:
+            print(f"Warning: Could not read the persisted chat cache, overwriting it: {e}")
+            theirs = []
+        
+        # This worker's entries go last, so they count as the most recently used
+        merged = OrderedDict()
+        for entry, vector in theirs + ours:
+            if "key" in entry and self._is_current(entry):
+                merged.pop(entry["key"], None)
+                merged[entry["key"]] = (entry, vector)
+        kept = list(merged.values())[-self.max_entries:]
+        if not kept:
+            return
+        
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(kept[0][1].shape[0]))
+        index.add_with_ids(np.stack([vector for _, vector in kept]), np.arange(len(kept), dtype='int64'))
+        index_bytes = faiss.serialize_index(index).tobytes()
+        entries_json = json.dumps({"entries": [[entry_id, entry] for entry_id, (entry, _) in enumerate(kept)]})
+        write_cached_artifact(self.index_path, io.BytesIO(index_bytes), "application/octet-stream")
+        write_cached_artifact(self.entries_path, io.BytesIO(entries_json.encode('utf-8')), "application/json")
+    
+    def load(self):
+        """Restore the persisted cache, if there is one, keeping only current entries"""
+        try:
+            persisted = [(entry, vector) for entry, vector in self._read_persisted()
+                         if "key" in entry and self._is_current(entry)]
+            if not persisted:
+                return
+            index = faiss.IndexIDMap2(faiss.IndexFlatIP(persisted[0][1].shape[0]))
+            index.add_with_ids(np.stack([vector for _, vector in persisted]), np.arange(len(persisted), dtype='int64'))
+            with self.lock:
+                self.index = index
+                self.entries = OrderedDict((entry_id, entry) for entry_id, (entry, _) in enumerate(persisted))
+                self.next_id = len(persisted)
+                self.unsaved_entries = 0
+            print(f"✅ Loaded semantic chat cache ({len(self.entries)} entries)")
+        except Exception as e:
+            print(f"Warning: Could not load semantic chat cache: {e}")
+
+semantic_chat_cache = SemanticChatCache(CHAT_CACHE_THRESHOLD, CHAT_CACHE_MAX_ENTRIES, CHAT_CACHE_TTL_SECONDS)
+
+async def remember_chat_answer(vector: Optional[np.ndarray], message: str, answer: Dict[str, Any]):
+    """Store an answer to a generic question in the semantic cache"""
+    if vector is None:
+        return
+    try:
+        if semantic_chat_cache.add(vector, message, answer):
+            spawn_background_task(asyncio.to_thread(semantic_chat_cache.save))
+    except Exception as e:
+        print(f"Warning: Could not cache chat answer: {e}")
+
+# ==================== TAX KNOWLEDGE BASE ====================
+
+class TaxKnowledgeBase:
+    """Curated FAQ answers, matched against every question phrasing by FAISS nearest neighbour"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = []
+        self.question_entries = None  # Index row -> position in self.entries
+        self.index = None
+        self.lock = threading.Lock()
+    
+    def load(self):
+        """Read the knowledge base and embed its questions (once per process)"""
+        with self.lock:
+            if self.index is not None:
+                return
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)["entries"]
+            questions, question_entries = [], []
+            for position, entry in enumerate(entries):
+                for question in entry["questions"]:
+                    questions.append(question)
+                    question_entries.append(position)
+            vectors = embed_texts(questions)
+            index = faiss.IndexFlatIP(vectors.shape[1])
+            index.add(vectors)
+            self.entries = entries
+            self.question_entries = np.array(question_entries, dtype='int64')
+            self.index = index
+        print(f"✅ Loaded tax knowledge base ({len(entries)} entries, {len(questions)} questions)")
+    
+    def match(self, vector: np.ndarray, threshold: float) -> Optional[Dict[str, Any]]:
+        """Return the answer for the closest known question above the threshold"""
+        self.load()
+        scores, rows = self.index.search(vector.reshape(1, -1), 1)
+        row = int(rows[0][0])
+        if row == -1 or scores[0][0] < threshold:
+            return None
+        entry = self.entries[self.question_entries[row]]
+        return {
+            "response": entry["answer"],
+            "follow_up_questions": entry.get("follow_up_questions", []),
+            "action_chips": entry.get("action_chips", []),
+            "kb_id": entry["id"],
+            "similarity": float(scores[0][0])
+        }
+
+tax_knowledge_base = TaxKnowledgeBase(KB_PATH)
+
+def preload_knowledge_base():
+    try:
+        tax_knowledge_base.load()
+    except Exception as e:
+        print(f"Warning: Could not load tax knowledge base: {e}")
+
+async def answer_chat_locally(message: str):
+    """
+    Answer a chat message without Gemini where possible: first from the curated
+    knowledge base, then (for generic questions) from the semantic cache.
+    
+    Returns (question vector, answer or None, source or None). The vector is only
+    set for generic questions; it is reused to cache a fresh Gemini answer.
+    """
+    generic = is_generic_chat_question(message)
+    use_cache = CHAT_CACHE_ENABLED and generic
+    if not KB_ENABLED and not use_cache:
+        return None, None, None
+    try:
+        vector = (await asyncio.to_thread(embed_texts, [message]))[0]
+    except Exception as e:
+        print(f"Warning: Could not embed chat message: {e}")
+        return None, None, None
+    cache_vector = vector if use_cache else None
+    
+    if KB_ENABLED:
+        try:
+            threshold = KB_ANSWER_THRESHOLD if generic else KB_PERSONAL_ANSWER_THRESHOLD
+            answer = await asyncio.to_thread(tax_knowledge_base.match, vector, threshold)
+            if answer is not None:
+                return cache_vector, answer, "knowledge_base"
+        except Exception as e:
+            print(f"Warning: Knowledge base lookup failed: {e}")
+    
+    if use_cache:
+        try:
+            answer = semantic_chat_cache.lookup(vector)
+            if answer is not None:
+                return cache_vector, answer, "semantic_cache"
+        except Exception as e:
+            print(f"Warning: Semantic chat cache lookup failed: {e}")
+    return cache_vector, None, None
+
+# ==================== CHAT INTENT ROUTER ====================
+
+# Ordered (intent, pattern) rules; the first match wins. Personal intents are
+# answered from the user's documents by the tax engine instead of Gemini.
+CHAT_INTENT_RULES = [
+    ("tax_refund", re.compile(r"\brefund", re.IGNORECASE)),
+    ("deduction_80c", re.compile(r"\b80\s*-?c\b(?!cd)", re.IGNORECASE)),
+    ("deduction_80d", re.compile(r"\b80\s*-?d\b|\bhealth insurance\b", re.IGNORECASE)),
+    ("deduction_nps", re.compile(r"\bnps\b|\b80\s*ccd", re.IGNORECASE)),
+    ("tax_saving", re.compile(r"\bsave (?:more |on )?tax|\btax[- ]saving|\bsave more\b|\bopportunit", re.IGNORECASE)),
+    ("tds_deducted", re.compile(r"\btds\b|\btax deducted\b", re.IGNORECASE)),
+    ("taxable_income", re.compile(r"\b(?:taxable|total|gross) income\b", re.IGNORECASE)),
+    ("tax_payable", re.compile(r"\btax (?:payable|liability|due|bill)\b|\bhow much tax\b|\bowe\b|\bnet payable\b", re.IGNORECASE)),
+    ("next_deadline", re.compile(r"\b(?:next|upcoming|nearest|coming)\b.*\b(?:deadlines?|due dates?|due)\b|\bdeadlines? (?:coming|ahead)\b", re.IGNORECASE)),
+]
+# Questions about limits or room left, rather than the rules themselves
+CHAT_ROOM_RE = re.compile(r"\b(?:room|left|remaining|more|balance|headroom|claimed|used|invest|how much)\b", re.IGNORECASE)
+# Intents answered with the user's aggregate figures, which are wrong for a question about one income
+# head or instrument ("How much tax do I pay on FD interest?"); those go to Gemini instead
+AGGREGATE_INTENTS = {"tax_payable", "tds_deducted", "taxable_income", "tax_refund"}
+# Recognised so they are not mistaken for a later rule, but answered by Gemini: the 80D limit depends on
+# the ages of the user and of the parents they insure (₹25,000 to ₹1,00,000), which the tax engine does not know
+GEMINI_INTENTS = {"deduction_80d"}
+SPECIFIC_INCOME_RE = re.compile(
+    r"\b(?:fds?|fixed deposits?|recurring deposits?|interest|capital gains?|ltcg|stcg|crypto\w*|bitcoin|vda|"
+    r"rent(?:al)?|house property|dividends?|shares?|stocks?|mutual funds?|equity|property|gifts?|lottery|"
+    r"pension|gratuity|bonus|freelanc\w*|business|foreign|esops?|sale of|selling)\b",
+    re.IGNORECASE
+)
+DEDUCTION_INTENTS = {
+    "deduction_80c": ("Section 80C", "section_80c", 150000),
+    "deduction_nps": ("Section 80CCD(1B) (NPS)", "nps", 50000),
+}
+
+def classify_chat_intent(message: str) -> Optional[str]:
+    """Map a message to a computational intent the tax engine can answer exactly, or None"""
+    personal = bool(PERSONAL_QUESTION_RE.search(message))
+    for intent, pattern in CHAT_INTENT_RULES:
+        if not pattern.search(message):
+            continue
+        if intent == "next_deadline":
+            return intent
+        if intent in GEMINI_INTENTS:
+            return None
+        if intent in AGGREGATE_INTENTS and SPECIFIC_INCOME_RE.search(message):
+            return None
+        if not personal:
+            # "What is the 80C limit?" is a knowledge question, not a question about this user
+            return None
+        if intent in DEDUCTION_INTENTS and not CHAT_ROOM_RE.search(message):
+            return None
+        return intent
+    return None
+
+def _format_rupees(amount: float) -> str:
+    return f"₹{amount:,.0f}"
+
+def _bullets(points: List[str]) -> str:
+    return "\n".join(f"• {point}" for point in points)
+
+def _tax_engine_answer(points: List[str], follow_ups: List[str], chips: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {"response": _bullets(points), "follow_up_questions": follow_ups, "action_chips": chips}
+
+def _answer_tax_intent(intent: str, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build a templated answer for a document-based intent from the tax engine"""
+    summary_chip = {"label": "View tax summary", "type": "view_summary", "data": {}}
+    if not documents:
+        return _tax_engine_answer(
+            ["I don't have any of your documents yet, so I can't calculate this.",
+             "Upload your Form 16, salary slips or investment proofs and ask again."],
+            ["Which documents do I need to file my ITR?"],
+            [{"label": "Upload a document", "type": "upload_document", "data": {}}]
+        )
+    
+    summary = calculate_tax_summary(documents)
+    income, tds, estimate = summary["income"], summary["tds"], summary["tax_estimate"]
+    basis = f"Estimated from your {len(documents)} uploaded document{'s' if len(documents) != 1 else ''}; upload more for a fuller picture."
+    
+    if intent in DEDUCTION_INTENTS:
+        label, key, limit = DEDUCTION_INTENTS[intent]
+        claimed = summary["deductions"][key]["total"]
+        remaining = max(0, limit - claimed)
+        points = [f"You have claimed {_format_rupees(claimed)} under {label}, against a limit of {_format_rupees(limit)}."]
+        if remaining > 0:
+            savings = calculate_tax_savings(remaining, summary)
+            points.append(f"You can still claim {_format_rupees(remaining)} more.")
+            if savings > 0:
+                points.append(f"Using the full limit would cut your estimated tax by about {_format_rupees(savings)}.")
+        else:
+            points.append("You have used the full limit.")
+        points.append(basis)
+        return _tax_engine_answer(
+            points,
+            ["How can I save more tax?", "What is my tax payable?"],
+            [{"label": "Upload investment proof", "type": "upload_document", "data": {"document_type": "investment_proof"}}, summary_chip]
+        )
+    
+    if intent == "tax_saving":
+        opportunities = detect_opportunities(documents, summary)
+        if not opportunities:
+            points = ["I couldn't find any further tax-saving opportunities in your documents."]
+        else:
+            opportunities.sort(key=lambda o: o.get("potential_savings", 0), reverse=True)
+            points = [
+                f"{o['message']} (saves about {_format_rupees(o['potential_savings'])})" if o.get("potential_savings") else o["message"]
+                for o in opportunities
+            ]
+        points.append(basis)
+        return _tax_engine_answer(
+            points,
+            ["How much 80C room do I have left?", "What is my tax payable?"],
+            [{"label": "Upload investment proof", "type": "upload_document", "data": {"document_type": "investment_proof"}}, summary_chip]
+        )
+    
+    if intent == "tds_deducted":
+        points = [f"TDS deducted so far: {_format_rupees(tds['tds_deducted'])}."]
+        if tds["advance_tax"] or tds["self_assessment_tax"]:
+            points.append(f"Advance tax paid: {_format_rupees(tds['advance_tax'])}; self-assessment tax: {_format_rupees(tds['self_assessment_tax'])}.")
+        points.append(f"Against an estimated tax of {_format_rupees(estimate['total_tax'])}.")
+        points.append(basis)
+        return _tax_engine_answer(points, ["What is my tax payable?", "Will I get a refund?"], [summary_chip])
+    
+    if intent == "taxable_income":
+        gross = income["total_salary"] + income["other_income"]
+        points = [
+            f"Gross income: {_format_rupees(gross)} (salary {_format_rupees(income['total_salary'])}, other income {_format_rupees(income['other_income'])}).",
+            f"Taxable income after deductions and the {_format_rupees(50000)} standard deduction: {_format_rupees(estimate['taxable_income'])}.",
+            basis
+        ]
+        return _tax_engine_answer(points, ["What is my tax payable?", "How can I save more tax?"], [summary_chip])
+    
+    # tax_payable and tax_refund share the same figures
+    points = [
+        f"Estimated tax on a taxable income of {_format_rupees(estimate['taxable_income'])}: {_format_rupees(estimate['total_tax'])}.",
+        f"TDS already deducted: {_format_rupees(tds['tds_deducted'])}."
+    ]
+    if estimate["net_payable"] > 0:
+        points.append(f"You still owe about {_format_rupees(estimate['net_payable'])}; pay it as advance or self-assessment tax before filing.")
+    elif estimate["net_refundable"] > 0:
+        points.append(f"You should get a refund of about {_format_rupees(estimate['net_refundable'])} after filing your return.")
+        if intent == "tax_refund":
+            points.append("Refunds are issued once the return is e-verified and processed, usually within a few weeks.")
+    else:
+        points.append("Your TDS matches your estimated tax, so nothing more is due.")
+    points.append(basis)
+    return _tax_engine_answer(
+        points,
+        ["How can I save more tax?", "When is my next deadline?"],
+        [summary_chip, {"label": "View deadlines", "type": "view_deadlines", "data": {}}]
+    )
+
+async def _answer_deadline_intent() -> Dict[str, Any]:
+    """List the next upcoming deadlines from the tax calendar"""
+    calendar = await _get_tax_deadlines_internal()
+    upcoming = [d for d in calendar["deadlines"] if not d["is_overdue"]]
+    if not upcoming:
+        points = [f"There are no remaining deadlines in FY {calendar['financial_year']}."]
+    else:
+        points = []
+        for deadline in upcoming[:3]:
+            due = datetime.strptime(deadline["date"], "%Y-%m-%d").strftime("%d %b %Y")
+            when = "today" if deadline["days_until"] == 0 else f"in {deadline['days_until']} days"
+            points.append(f"{deadline['title']}: {due} ({when}). {deadline['description']}.")
+    return _tax_engine_answer(
+        points,
+        ["What are the advance tax due dates?", "What happens if I miss the ITR deadline?"],
+        [{"label": "View deadlines", "type": "view_deadlines", "data": {}}]
+    )
+
+async def route_chat_intent(request: ChatRequest) -> Optional[Dict[str, Any]]:
+    """Answer computational questions exactly from the tax engine; None sends the message on"""
+    intent = classify_chat_intent(request.message)
+    if intent is None:
+        return None
+    try:
+        if intent == "next_deadline":
+            answer = await _answer_deadline_intent()
+        else:
+            documents = await fetch_user_documents(request.user_id)
+            answer = _answer_tax_intent(intent, documents)
+        return {**answer, "intent": intent}
+    except Exception as e:
+        print(f"Warning: Could not answer '{intent}' from the tax engine: {e}")
+        return None
+
+async def answer_chat_without_llm(request: ChatRequest):
+    """
+    Try the tax engine, then the knowledge base and semantic cache.
+    Returns (question vector, answer or None, source or None), as answer_chat_locally.
+    """
+    answer = await route_chat_intent(request)
+    if answer is not None:
+        return None, answer, "tax_engine"
+    return await answer_chat_locally(request.message)
+
+# Chats answered per source since the worker started
+LOCAL_CHAT_SOURCES = ("tax_engine", "knowledge_base", "semantic_cache")
+chat_source_counts = Counter()
+_chat_source_counts_lock = threading.Lock()
+
+def record_chat_source(source: str):
+    with _chat_source_counts_lock:
+        chat_source_counts[source] += 1
+
+# ==================== CHAT SUGGESTIONS ====================
+
+# Follow-ups about the user's own numbers; the intent router answers these locally
+CHAT_PERSONAL_FOLLOW_UPS = [
+    ("What is my tax payable?", {"label": "Calculate my tax", "type": "calculate_tax", "data": {}}),
+    ("Will I get a refund?", {"label": "View tax summary", "type": "view_summary", "data": {}}),
+    ("How much 80C room do I have left?", {"label": "Upload investment proof", "type": "upload_document", "data": {"document_type": "investment_proof"}}),
+    ("How can I save more tax?", {"label": "View tax summary", "type": "view_summary", "data": {}}),
+    ("When is my next deadline?", {"label": "View deadlines", "type": "view_deadlines", "data": {}}),
+]
+CHAT_FOLLOW_UP_CANDIDATES = 10
+CHAT_FOLLOW_UP_MAX_SIMILARITY = 0.9  # Closer than this is the question just asked, reworded
+CHAT_MAX_FOLLOW_UPS = 4
+CHAT_MAX_ACTION_CHIPS = 4
+
+# Chips implied by the wording of the question, whatever the catalogue matches
+CHAT_CHIP_RULES = [
+    (re.compile(r"\b(?:ca|chartered accountant|notice|audit|scrutiny|professional help)\b", re.IGNORECASE),
+     {"label": "Find a CA", "type": "find_ca", "data": {}}),
+    (re.compile(r"\b(?:deadline|due date|last date|advance tax|belated|late fee)\b", re.IGNORECASE),
+     {"label": "View deadlines", "type": "view_deadlines", "data": {}}),
+    (re.compile(r"\b(?:calculate|how much tax|tax payable|liability|slab)\b", re.IGNORECASE),
+     {"label": "Calculate my tax", "type": "calculate_tax", "data": {}}),
+    (re.compile(r"\b(?:regime|summary|refund|itr draft)\b", re.IGNORECASE),
+     {"label": "View tax summary", "type": "view_summary", "data": {}}),
+]
+
+CHAT_GAP_DOCUMENT_LABELS = {
+    "form_16": "Form 16",
+    "form_26as": "Form 26AS",
+    "investment_proof": "investment proof",
+    "rent_receipt": "rent receipts",
+    "bank_interest_certificate": "interest certificate",
+}
+
+class FollowUpCatalogue:
+    """Suggested questions with their action chips, looked up by FAISS nearest neighbour"""
+    
+    def __init__(self):
+        self.items = []  # (question, action chip or None)
+        self.index = None
+        self.lock = threading.Lock()
+    
+    def load(self):
+        """Build the catalogue from the knowledge base questions plus personal follow-ups"""
+        with self.lock:
+            if self.index is not None:
+                return
+            items = []
+            if KB_ENABLED:
+                tax_knowledge_base.load()
+                for entry in tax_knowledge_base.entries:
+                    chips = entry.get("action_chips", [])
+                    items.append((entry["questions"][0], chips[0] if chips else None))
+            items.extend(CHAT_PERSONAL_FOLLOW_UPS)
+            vectors = embed_texts([question for question, _ in items])
+            index = faiss.IndexFlatIP(vectors.shape[1])
+            index.add(vectors)
+            self.items = items
+            self.index = index
+    
+    def nearest(self, vector: np.ndarray, k: int) -> List[tuple]:
+        """Return (question, chip, similarity) for the k closest catalogue questions"""
+        self.load()
+        scores, rows = self.index.search(vector.reshape(1, -1), min(k, self.index.ntotal))
+        return [(*self.items[row], float(score)) for score, row in zip(scores[0], rows[0]) if row != -1]
+
+follow_up_catalogue = FollowUpCatalogue()
+
+def _gap_suggestions(document_types: List[str]):
+    """Follow-ups and upload chips for the most important documents the user has not uploaded"""
+    gaps = analyze_document_gaps([{"document_type": doc_type} for doc_type in document_types])
+    follow_ups, chips = [], []
+    for gap in gaps["missing_documents"] + gaps["recommendations"]:
+        name = CHAT_GAP_DOCUMENT_LABELS.get(gap["type"], gap["type"].replace("_", " "))
+        chips.append({"label": f"Upload {name}", "type": "upload_document", "data": {"document_type": gap["type"]}})
+        if len(chips) == 2:
+            break
+    if gaps["missing_documents"]:
+        follow_ups.append("What documents do I need to file my ITR?")
+    return follow_ups, chips
+
+def suggest_chat_follow_ups(message: str, vector: Optional[np.ndarray] = None,
+                            document_types: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Choose follow-up questions and action chips locally: nearest catalogue questions to the
+    message, chips implied by its wording, and (for personal chats) the user's document gaps.
+    """
+    follow_ups, chips = [], []
+    try:
+        if vector is None:
+            vector = embed_texts([message])[0]
+        for question, chip, similarity in follow_up_catalogue.nearest(vector, CHAT_FOLLOW_UP_CANDIDATES):
+            if similarity >= CHAT_FOLLOW_UP_MAX_SIMILARITY:
+                continue
+            follow_ups.append(question)
+            if chip is not None:
+                chips.append(chip)
+            if len(follow_ups) == CHAT_MAX_FOLLOW_UPS:
+                break
+    except Exception as e:
+        print(f"Warning: Could not match follow-up questions: {e}")
+    
+    rule_chips = [chip for pattern, chip in CHAT_CHIP_RULES if pattern.search(message)]
+    gap_follow_ups, gap_chips = _gap_suggestions(document_types) if document_types is not None else ([], [])
+    
+    # Wording and gap chips are the most specific, so they go first
+    unique_chips, seen = [], set()
+    for chip in rule_chips + gap_chips + chips:
+        key = (chip["type"], json.dumps(chip.get("data", {}), sort_keys=True))
+        if key not in seen:
+            seen.add(key)
+            unique_chips.append(chip)
+    
+    follow_ups = list(dict.fromkeys(gap_follow_ups + follow_ups)) or DEFAULT_FOLLOW_UP_QUESTIONS
+    return {
+        "follow_up_questions": follow_ups[:CHAT_MAX_FOLLOW_UPS],
+        "action_chips": unique_chips[:CHAT_MAX_ACTION_CHIPS]
+    }
+
+# ==================== DOCUMENT RETRIEVAL FOR CHAT ====================
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for prompt budgeting (about 4 characters per token)"""
+    return len(text) // 4 + 1
+
+def chunk_document_text(text: str) -> List[str]:
+    """Split extracted document text into overlapping chunks on whitespace boundaries"""
+    text = re.sub(r'[ \t]+', ' ', text)
+    text = re.sub(r'\n\s*\n+', '\n\n', text).strip()
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + DOC_CHUNK_CHARS, len(text))
+        if end < len(text):
+            # Prefer to break at a paragraph, then a line, then a word
+            for separator in ('\n\n', '\n', ' '):
+                split_at = text.rfind(separator, start + DOC_CHUNK_CHARS // 2, end)
+                if split_at != -1:
+                    end = split_at
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - DOC_CHUNK_OVERLAP, start + 1)
+    return chunks
+
+class UserDocumentIndex:
+    """Compact FAISS index (fp16 vectors) over the chunks of one user's documents"""
+    
+    def __init__(self):
+        self.index = None  # Created on first insert, once the embedding size is known
+        self.chunks = {}  # Chunk id -> {"document_id", "document_type", "text"}
+        self.document_chunk_ids = {}  # Document id -> chunk ids
+        self.next_id = 0
+        self.loaded_at = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def add_document(self, document_id: str, document_type: str, texts: List[str], vectors: np.ndarray):
+        """Add (or replace) a document's chunks"""
+        with self.lock:
+            self._remove_document(document_id)
+            if self.index is None:
+                self.index = faiss.IndexIDMap2(faiss.IndexScalarQuantizer(
+                    vectors.shape[1], faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT
+                ))
+            ids = np.arange(self.next_id, self.next_id + len(texts), dtype='int64')
+            self.next_id += len(texts)
+            self.index.add_with_ids(np.ascontiguousarray(vectors, dtype='float32'), ids)
+            for chunk_id, text in zip(ids.tolist(), texts):
+                self.chunks[chunk_id] = {"document_id": document_id, "document_type": document_type, "text": text}
+            self.document_chunk_ids[document_id] = ids.tolist()
+    
+    def remove_document(self, document_id: str):
+        """Drop a document's chunks from the index"""
+        with self.lock:
+            self._remove_document(document_id)
+    
+    def _remove_document(self, document_id: str):
+        chunk_ids = self.document_chunk_ids.pop(document_id, None)
+        if not chunk_ids:
+            return
+        self.index.remove_ids(np.array(chunk_ids, dtype='int64'))
+        for chunk_id in chunk_ids:
+            self.chunks.pop(chunk_id, None)
+    
+    def search(self, vector: np.ndarray, top_k: int) -> List[Dict[str, Any]]:
+        """Return the closest chunks, best first"""
+        with self.lock:
+            if self.index is None or self.index.ntotal == 0:
+                return []
+            scores, ids = self.index.search(vector.reshape(1, -1), min(top_k, self.index.ntotal))
+            return [
+                {**self.chunks[int(chunk_id)], "score": float(score)}
+                for score, chunk_id in zip(scores[0], ids[0])
+                if chunk_id != -1 and int(chunk_id) in self.chunks
+            ]
+
+_document_indexes = OrderedDict()  # User id -> UserDocumentIndex, least recently used first
+_document_indexes_lock = threading.Lock()
+
+def _document_index_artifact_path(user_id: str, document_id: str) -> str:
+    return f"doc_index/{user_id}/{document_id}.npz"
+
+def _serialize_document_chunks(document_type: str, texts: List[str], vectors: np.ndarray) -> io.BytesIO:
+    """Pack one document's chunk vectors (fp16) and texts into an .npz buffer"""
+    buffer = io.BytesIO()
+    meta = json.dumps({"document_type": document_type, "texts": texts}).encode('utf-8')
+    np.savez_compressed(buffer, vectors=vectors.astype('float16'), meta=np.frombuffer(meta, dtype='uint8'))
+    return buffer
+
+def _load_user_document_index(user_id: str) -> UserDocumentIndex:
+    """Assemble a user's index from the per-document chunk artifacts written at upload time"""
+    user_index = UserDocumentIndex()
+    for path in list_cached_artifacts(f"doc_index/{user_id}/"):
+        data = read_cached_artifact(path)
+        if data is None:
+            continue
+        try:
+            with np.load(io.BytesIO(data)) as archive:
+                meta = json.loads(archive["meta"].tobytes())
+                vectors = archive["vectors"].astype('float32')
+            document_id = path.rsplit('/', 1)[-1][:-len('.npz')]
+            user_index.add_document(document_id, meta["document_type"], meta["texts"], vectors)
+        except Exception as e:
+            print(f"Warning: Could not load document chunks {path}: {e}")
+    return user_index
+
+_document_index_refreshes = set()  # User ids whose stale index is being reloaded in the background
+
+def _cache_document_index(user_id: str, user_index: UserDocumentIndex):
+    with _document_indexes_lock:
+        _document_indexes[user_id] = user_index
+        _document_indexes.move_to_end(user_id)
+        while len(_document_indexes) > DOC_INDEX_CACHE_SIZE:
+            _document_indexes.popitem(last=False)
+
+def _refresh_document_index(user_id: str):
+    try:
+        _cache_document_index(user_id, _load_user_document_index(user_id))
+    except Exception as e:
+        print(f"Warning: Could not refresh document index for {user_id}: {e}")
+    finally:
+        with _document_indexes_lock:
+            _document_index_refreshes.discard(user_id)
+
+def get_user_document_index(user_id: str) -> UserDocumentIndex:
+    """
+    Return the user's in-memory index, loading it if absent. A stale index is still served while
+    it is reloaded in the background, so chat requests never wait on the per-document downloads.
+    """
+    with _document_indexes_lock:
+        user_index = _document_indexes.get(user_id)
+        if user_index is not None:
+            _document_indexes.move_to_end(user_id)
+            stale = time.monotonic() - user_index.loaded_at >= DOC_INDEX_TTL_SECONDS
+            if stale and user_id not in _document_index_refreshes:
+                _document_index_refreshes.add(user_id)
+                threading.Thread(target=_refresh_document_index, args=(user_id,), daemon=True).start()
+            return user_index
+    
+    user_index = _load_user_document_index(user_id)
+    _cache_document_index(user_id, user_index)
+    return user_index
+
+def index_document_text(user_id: str, document_id: str, document_type: str, extracted_text: str):
+    """Chunk and embed a document's text and add it to the user's index"""
+    try:
+        texts = chunk_document_text(extracted_text)
+        if not texts:
+            return
+        vectors = embed_texts(texts)
+        write_cached_artifact(
+            _document_index_artifact_path(user_id, document_id),
+            _serialize_document_chunks(document_type, texts, vectors),
+            "application/octet-stream"
+        )
+        with _document_indexes_lock:
+            user_index = _document_indexes.get(user_id)
+        if user_index is not None:
+            user_index.add_document(document_id, document_type, texts, vectors)
+    except Exception as e:
+        print(f"Warning: Could not index document {document_id} for retrieval: {e}")
+
+def remove_document_from_index(user_id: str, document_id: str):
+    """Forget a deleted document's chunks"""
+    delete_cached_artifact(_document_index_artifact_path(user_id, document_id))
+    with _document_indexes_lock:
+        user_index = _document_indexes.get(user_id)
+    if user_index is not None:
+        user_index.remove_document(document_id)
+
+def retrieve_document_excerpts(user_id: str, message: str) -> List[Dict[str, Any]]:
+    """Retrieve the document chunks most relevant to a question, within the prompt token budget"""
+    try:
+        user_index = get_user_document_index(user_id)
+        if not user_index.chunks:
+            return []
+        question_vector = embed_texts([message])[0]
+        excerpts = []
+        tokens_used = 0
+        for match in user_index.search(question_vector, CHAT_RAG_TOP_K):
+            if match["score"] < CHAT_RAG_MIN_SCORE:
+                break
+            tokens = estimate_tokens(match["text"])
+            if tokens_used + tokens > CHAT_RAG_TOKEN_BUDGET:
+                continue
+            excerpts.append(match)
+            tokens_used += tokens
+        return excerpts
+    except Exception as e:
+        print(f"Warning: Could not retrieve document excerpts: {e}")
+        return []
+
+@app.post("/upload-document")
+async def upload_document(
+    user_id: str = Form(...),
+    document_type: str = Form(...),
+    file: UploadFile = File(...),
+    metadata: str = Form("{}")  # JSON string of additional metadata
+):
+    """
+    Upload and process tax documents with AI-powered extraction
+    """
+    try:
+        # Validate document type
+        if document_type not in DOCUMENT_TYPES:
+            raise HTTPException(status_code=400, detail=f"Invalid document type. Allowed types: {list(DOCUMENT_TYPES.keys())}")
         
         # Validate file type
         if not file.filename.lower().endswith('.pdf'):
@@ -578,98 +2637,297 @@ async def upload_document(
         # Read file content
         file_content = await file.read()
         
-        # Extract text from PDF
-        extracted_text = await extract_text_from_pdf(file_content)
-        
-        if not extracted_text.strip():
-            raise HTTPException(status_code=400, detail="Could not extract text from PDF. Please ensure the document is readable.")
-        
-        # Process with Gemini AI
-        ai_result = await process_document_with_gemini(document_type, extracted_text, user_metadata)
-        
-        # Upload file to Firebase Storage
-        file_url = await upload_file_to_firebase(file_content, file.filename, user_id)
+        # Upload file to Firebase Storage (skipped when the same bytes are already stored)
+        return await process_document_upload(
+            user_id, document_type, file_content, user_metadata,
+            lambda: upload_file_to_firebase(file_content, file.filename, user_id)
+        )
         
-        # Store metadata in Firestore
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+
+async def process_document_upload(user_id: str, document_type: str, file_content: bytes,
+                                  user_metadata: Dict[str, Any], store_file) -> Dict[str, Any]:
+    """
+    Extract, analyse and record an uploaded PDF. store_file() puts the bytes in the blob store
+    once the document is known to be readable and returns (download URL, content hash).
+    """
+    # Extract text from PDF
+    extracted_text = await extract_text_from_pdf(file_content)
+    
+    if not extracted_text.strip():
+        raise HTTPException(status_code=400, detail="Could not extract text from PDF. Please ensure the document is readable.")
+    
+    # Process with Gemini AI
+    ai_result = await process_document_with_gemini(document_type, extracted_text, user_metadata)
+    
+    file_url, blob_hash = await store_file()
+    
+    # Store metadata in Firestore
+    try:
         document_id = await store_document_metadata(
             user_id, 
             document_type, 
             file_url, 
             ai_result.get("extracted_metadata", {}), 
-            user_metadata
+            user_metadata,
+            blob_hash
         )
-        
-        return {
-            "success": True,
-            "document_id": document_id,
-            "file_url": file_url,
-            "extracted_metadata": ai_result.get("extracted_metadata", {}),
-            "confidence_score": ai_result.get("confidence_score", 0),
-            "validation_errors": ai_result.get("validation_errors", []),
-            "suggestions": ai_result.get("suggestions", [])
-        }
-        
     except HTTPException:
+        await release_blob(blob_hash)
+        raise
+    
+    # Make the document text available to chat retrieval without delaying the response
+    spawn_background_task(asyncio.to_thread(index_document_text, user_id, document_id, document_type, extracted_text))
+    
+    return {
+        "success": True,
+        "document_id": document_id,
+        "file_url": file_url,
+        "extracted_metadata": ai_result.get("extracted_metadata", {}),
+        "confidence_score": ai_result.get("confidence_score", 0),
+        "validation_errors": ai_result.get("validation_errors", []),
+        "suggestions": ai_result.get("suggestions", [])
+    }
+
+# ==================== DIRECT-TO-STORAGE UPLOADS ====================
+
+def _pending_upload_path(user_id: str, upload_id: str) -> str:
+    return user_path(user_id, 'pending_uploads', upload_id)
+
+def _sign_upload_target(user_id: str, upload_id: str, name: str, expires: int) -> str:
+    claims = {"u": user_id, "i": upload_id, "n": name, "e": expires}
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode('utf-8')).decode('ascii').rstrip("=")
+    signature = hmac.new(UPLOAD_SIGNING_SECRET.encode('utf-8'), payload.encode('ascii'), hashlib.sha256).hexdigest()
+    return f"{payload}.{signature}"
+
+def _verify_upload_target(token: str) -> Dict[str, Any]:
+    """The claims of a signed /upload-target token (user, upload and blob name); 403 if forged or expired"""
+    payload, _, signature = token.partition(".")
+    expected = hmac.new(UPLOAD_SIGNING_SECRET.encode('utf-8'), payload.encode('ascii'), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(signature, expected):
+        raise HTTPException(status_code=403, detail="Invalid upload URL")
+    claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    if claims["e"] < time.time():
+        raise HTTPException(status_code=403, detail="Upload URL has expired")
+    return claims
+
+@app.post("/upload-url")
+async def create_upload_url(request: UploadUrlRequest):
+    """
+    Step one of a direct upload: a short-lived URL the client sends the PDF to (a signed resumable
+    upload on Firebase Storage), so the file bytes never pass through this API.
+    """
+    if request.document_type not in DOCUMENT_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid document type. Allowed types: {list(DOCUMENT_TYPES.keys())}")
+    if not request.file_name.lower().endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="Only PDF files are supported")
+    
+    upload_id = uuid.uuid4().hex
+    staged_name = f"uploads/{request.user_id}/{upload_id}.pdf"
+    expires = int(time.time()) + UPLOAD_URL_TTL_SECONDS
+    try:
+        target = await asyncio.to_thread(blob_store.create_upload_url, staged_name, request.content_type, UPLOAD_URL_TTL_SECONDS, UPLOAD_MAX_BYTES)
+        if target is None:
+            # Stores without direct uploads take the bytes through a signed API route
+            target = {
+                "upload_url": f"{PUBLIC_BASE_URL.rstrip('/')}/upload-target/{_sign_upload_target(request.user_id, upload_id, staged_name, expires)}",
+                "method": "PUT",
+                "headers": {"Content-Type": request.content_type}
+            }
+        await repo.set(_pending_upload_path(request.user_id, upload_id), {
+            "document_type": request.document_type,
+            "file_name": request.file_name,
+            "metadata": request.metadata or {},
+            "blob_name": staged_name,
+            "status": "pending",
+            "created_at": datetime.utcnow(),
+            "expires_at": datetime.utcfromtimestamp(expires)
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error creating upload URL: {str(e)}")
+    
+    return {
+        "success": True,
+        "upload_id": upload_id,
+        **target,
+        "expires_at": datetime.utcfromtimestamp(expires).isoformat(),
+        "max_bytes": UPLOAD_MAX_BYTES
+    }
+
+@app.put("/upload-target/{token}")
+async def receive_direct_upload(token: str, request: Request):
+    """Upload endpoint behind /upload-url for stores that cannot accept client uploads themselves"""
+    claims = _verify_upload_target(token)
+    pending_path = _pending_upload_path(claims["u"], claims["i"])
+    
+    async def accepting_uploads() -> bool:
+        pending = await repo.get(pending_path)
+        return pending is not None and pending["status"] == "pending"
+    
+    # Once /upload-complete has started, the upload is closed even though the URL has not expired
+    if not await accepting_uploads():
+        raise HTTPException(status_code=409, detail="This upload has already been completed")
+    # Spool the body to disk as it arrives so an upload never sits in memory whole
+    with tempfile.TemporaryFile() as staged:
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > UPLOAD_MAX_BYTES:
+                raise HTTPException(status_code=413, detail="File is too large")
+            await asyncio.to_thread(staged.write, chunk)
+        await asyncio.to_thread(
+            blob_store.upload, claims["n"], staged, request.headers.get("content-type", "application/pdf"), False
+        )
+    if not await accepting_uploads():
+        # Completed while the body was arriving; the staged copy is no longer wanted
+        await asyncio.to_thread(blob_store.delete, claims["n"])
+        raise HTTPException(status_code=409, detail="This upload has already been completed")
+    return {"success": True}
+
+@app.post("/upload-complete")
+async def complete_direct_upload(request: UploadCompleteRequest):
+    """
+    Step two of a direct upload: read the uploaded PDF from storage in a worker thread, extract and
+    record it exactly as /upload-document does. Safe to call again: a finished upload returns
+    the same document. The client can still write to the staged object, so the verified bytes
+    are stored under a server-owned name and the staged object is deleted.
+    """
+    pending_path = _pending_upload_path(request.user_id, request.upload_id)
+    processing_id = uuid.uuid4().hex
+    
+    def start_processing(pending):
+        if pending is None:
+            return None, ("missing", None)
+        if pending["status"] == "processing":
+            started_at = pending.get("started_at")
+            if started_at and started_at.tzinfo is None:
+                started_at = started_at.replace(tzinfo=timezone.utc)
+            # The processing worker may have died or been cancelled; its lease lets another call take over
+            if started_at and datetime.now(timezone.utc) - started_at < timedelta(seconds=UPLOAD_PROCESSING_LEASE_SECONDS):
+                return None, ("processing", pending)
+        elif pending["status"] != "pending":
+            return None, (pending["status"], pending)
+        return {
+            **pending,
+            "status": "processing",
+            "processing_id": processing_id,
+            "started_at": datetime.now(timezone.utc)
+        }, ("started", pending)
+    
+    state, pending = await repo.transform(pending_path, start_processing)
+    if state == "missing":
+        raise HTTPException(status_code=404, detail="Upload not found")
+    if state == "completed":
+        return pending["result"]
+    if state == "processing":
+        raise HTTPException(status_code=409, detail="Upload is already being processed")
+    if state == "failed":
+        raise HTTPException(status_code=400, detail=pending.get("error", "Upload failed"))
+    
+    async def finish(update: Dict[str, Any]) -> bool:
+        """Apply the outcome, unless another call reclaimed the upload after this one's lease lapsed"""
+        def apply(current):
+            if current is None or current.get("processing_id") != processing_id:
+                return None, False
+            return {**current, **update}, True
+        
+        return await repo.transform(pending_path, apply)
+    
+    async def fail(error: str):
+        if await finish({"status": "failed", "error": error}):
+            await asyncio.to_thread(blob_store.delete, staged_name)
+    
+    staged_name = pending["blob_name"]
+    try:
+        # Checked from metadata first, so an oversized upload is never read into memory
+        file_size = await asyncio.to_thread(blob_store.size, staged_name)
+        file_content = None
+        if file_size is not None and file_size <= UPLOAD_MAX_BYTES:
+            file_content = await asyncio.to_thread(blob_store.download, staged_name)
+    except Exception as e:
+        file_size = file_content = None
+        print(f"Warning: Could not read uploaded file {staged_name}: {e}")
+    if file_size is not None and file_size > UPLOAD_MAX_BYTES:
+        await fail("File is too large")
+        raise HTTPException(status_code=413, detail="File is too large")
+    if file_content is None:
+        # Nothing arrived yet (or storage is unreachable): let the client retry
+        await finish({"status": "pending"})
+        raise HTTPException(status_code=400, detail="The file has not been uploaded yet")
+    
+    try:
+        if len(file_content) > UPLOAD_MAX_BYTES:  # Replaced after the size check
+            raise HTTPException(status_code=413, detail="File is too large")
+        result = await process_document_upload(
+            request.user_id, pending["document_type"], file_content, pending.get("metadata") or {},
+            lambda: store_blob(file_content, staged_name)
+        )
+    except HTTPException as e:
+        await fail(str(e.detail))
         raise
     except Exception as e:
+        await fail(str(e))
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+    
+    if not await finish({"status": "completed", "result": result, "completed_at": datetime.utcnow()}):
+        # Another call took over this upload and records its own document, so drop this one
+        doc_data = await take_document(user_path(request.user_id, 'documents', result["document_id"]))
+        if doc_data is not None:
+            await cleanup_document_file(doc_data)
+            await asyncio.to_thread(remove_document_from_index, request.user_id, result["document_id"])
+        raise HTTPException(status_code=409, detail="Upload was taken over by another request")
+    try:
+        await asyncio.to_thread(blob_store.delete, staged_name)
+    except Exception as e:
+        print(f"Warning: Could not delete staged upload {staged_name}: {e}")
+        spawn_background_task(enqueue_blob_cleanup("delete_object", staged_name, str(e)))
+    return result
 
 @app.get("/documents/{user_id}")
 async def get_user_documents(user_id: str, document_type: Optional[str] = None):
     """Get all documents for a user, optionally filtered by type"""
     try:
-        # Build base query
-        query = db.collection('users').document(user_id).collection('documents')
-        
-        if document_type:
-            query = query.where('document_type', '==', document_type)
+        collection_path = user_path(user_id, 'documents')
+        filters = (('document_type', '==', document_type),) if document_type else ()
         
         # Fetch documents - try with ordering first, fallback to no ordering if it fails
         documents = []
         try:
             # Try to fetch with ordering
-            docs = query.order_by('uploaded_at', direction=firestore.Query.DESCENDING).stream()
-            for doc in docs:
-                try:
-                    doc_data = doc.to_dict()
-                    if doc_data:  # Ensure doc_data is not None
-                        doc_data['id'] = doc.id
-                        # Convert Firestore datetime objects to ISO format strings for JSON serialization
-                        doc_data = convert_firestore_datetime_to_iso(doc_data)
-                        documents.append(doc_data)
-                except Exception as doc_error:
-                    print(f"Warning: Error processing document {doc.id}: {doc_error}")
-                    import traceback
-                    traceback.print_exc()
-                    continue
+            docs = await repo.query(collection_path, filters, order_by='uploaded_at', descending=True)
+            ordered = True
         except Exception as order_error:
             # If ordering fails (e.g., no index, empty collection, or index not created), fetch without ordering
             print(f"Warning: Could not order by uploaded_at: {order_error}. Fetching without order.")
             try:
-                docs = query.stream()
-                for doc in docs:
-                    try:
-                        doc_data = doc.to_dict()
-                        if doc_data:  # Ensure doc_data is not None
-                            doc_data['id'] = doc.id
-                            # Convert Firestore datetime objects to ISO format strings for JSON serialization
-                            doc_data = convert_firestore_datetime_to_iso(doc_data)
-                            documents.append(doc_data)
-                    except Exception as doc_error:
-                        print(f"Warning: Error processing document {doc.id}: {doc_error}")
-                        import traceback
-                        traceback.print_exc()
-                        continue
-                
-                # Sort in Python if we have documents
-                if documents:
-                    documents.sort(key=lambda x: x.get('uploaded_at', ''), reverse=True)
+                docs = await repo.query(collection_path, filters)
             except Exception as fetch_error:
                 print(f"Error fetching documents without order: {fetch_error}")
                 import traceback
                 traceback.print_exc()
                 # Return empty list instead of crashing
-                documents = []
+                docs = []
+            ordered = False
+        
+        for doc_id, doc_data in docs:
+            try:
+                if doc_data:  # Ensure doc_data is not None
+                    doc_data['id'] = doc_id
+                    # Convert Firestore datetime objects to ISO format strings for JSON serialization
+                    doc_data = convert_firestore_datetime_to_iso(doc_data)
+                    documents.append(doc_data)
+            except Exception as doc_error:
+                print(f"Warning: Error processing document {doc_id}: {doc_error}")
+                import traceback
+                traceback.print_exc()
+                continue
+        
+        # Sort in Python if the query could not order them
+        if documents and not ordered:
+            documents.sort(key=lambda x: x.get('uploaded_at', ''), reverse=True)
         
         # Verify the response is JSON serializable
         try:
@@ -704,7 +2962,9 @@ async def health_check():
     """Health check endpoint to verify server is running"""
     return {
         "status": "healthy",
-        "message": "Server is running"
+        "message": "Server is running",
+        "write_behind": {"queue_depth": write_behind_queue.depth, **write_behind_queue.stats},
+        "blobs": dict(blob_stats)
     }
 
 @app.get("/document-types")
@@ -719,28 +2979,17 @@ async def get_document_types():
 async def delete_document(user_id: str, document_id: str):
     """Delete a document and its associated file"""
     try:
-        # Get document reference
-        doc_ref = db.collection('users').document(user_id).collection('documents').document(document_id)
-        doc = doc_ref.get()
+        # Delete from Firestore first, so a failure below can only leave an unreferenced file behind.
+        # The read and delete are one transaction, so the file is only released by the request that deleted
+        doc_data = await take_document(user_path(user_id, 'documents', document_id))
         
-        if not doc.exists:
+        if doc_data is None:
             raise HTTPException(status_code=404, detail="Document not found")
         
-        doc_data = doc.to_dict()
-        file_url = doc_data.get('file_url')
-        
-        # Delete from Firebase Storage
-        if file_url:
-            try:
-                # Extract blob name from URL
-                blob_name = file_url.split(f"{FIREBASE_BUCKET}/")[-1]
-                blob = bucket.blob(blob_name)
-                blob.delete()
-            except Exception as e:
-                print(f"Warning: Could not delete file from storage: {e}")
+        # Delete from Firebase Storage (failures go to the cleanup retry queue)
+        await cleanup_document_file(doc_data)
         
-        # Delete from Firestore
-        doc_ref.delete()
+        await asyncio.to_thread(remove_document_from_index, user_id, document_id)
         
         return {
             "success": True,
@@ -752,59 +3001,401 @@ async def delete_document(user_id: str, document_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting document: {str(e)}")
 
+@app.post("/documents/{user_id}/bulk-delete")
+async def bulk_delete_documents(user_id: str, request: BulkDeleteRequest):
+    """
+    Delete many documents at once, by ID or by filter (document type and/or financial year).
+    Firestore deletes are committed in batches, files are removed concurrently, and file
+    cleanups that fail are retried in the background. Reports the outcome for each document.
+    """
+    collection_path = user_path(user_id, 'documents')
+    results = {}
+    try:
+        if request.document_ids:
+            requested = list(dict.fromkeys(request.document_ids))
+            if len(requested) > BULK_DELETE_MAX_DOCUMENTS:
+                raise HTTPException(status_code=400, detail=f"At most {BULK_DELETE_MAX_DOCUMENTS} documents can be deleted at once")
+            found = await repo.get_many([f"{collection_path}/{document_id}" for document_id in requested])
+            targets = {path.rsplit("/", 1)[-1]: data for path, data in found.items()}
+            for document_id in requested:
+                if document_id not in targets:
+                    results[document_id] = {"document_id": document_id, "status": "not_found"}
+        elif request.document_type or request.financial_year:
+            filters = []
+            if request.document_type:
+                filters.append(('document_type', '==', request.document_type))
+            if request.financial_year:
+                filters.append(('metadata.financial_year', '==', request.financial_year))
+            matches = await repo.query(collection_path, tuple(filters), limit=BULK_DELETE_MAX_DOCUMENTS + 1)
+            if len(matches) > BULK_DELETE_MAX_DOCUMENTS:
+                raise HTTPException(status_code=400, detail=f"More than {BULK_DELETE_MAX_DOCUMENTS} documents match; narrow the filter")
+            targets = dict(matches)
+        else:
+            raise HTTPException(status_code=400, detail="Provide document_ids or a document_type/financial_year filter")
+        
+        # Firestore deletes, one batch per 500 documents, committed concurrently. Every delete requires
+        # its document to still exist, so a batch that overlaps another delete of the same documents
+        # (e.g. a retried request) fails as a whole instead of reporting documents it did not delete
+        document_ids = list(targets)
+        chunks = [document_ids[start:start + FIRESTORE_BATCH_LIMIT] for start in range(0, len(document_ids), FIRESTORE_BATCH_LIMIT)]
+        outcomes = await asyncio.gather(
+            *(repo.commit([("delete_existing", f"{collection_path}/{document_id}", None) for document_id in chunk]) for chunk in chunks),
+            return_exceptions=True
+        )
+        deleted = []
+        contended = []
+        for chunk, outcome in zip(chunks, outcomes):
+            (contended if isinstance(outcome, Exception) else deleted).extend(chunk)
+        
+        semaphore = asyncio.Semaphore(BULK_DELETE_BLOB_CONCURRENCY)
+        
+        async def take(document_id: str):
+            # A failed batch is retried one transactional read-and-delete per document, so each
+            # document is deleted, and its file released, by exactly one request
+            async with semaphore:
+                try:
+                    doc_data = await take_document(f"{collection_path}/{document_id}")
+                except Exception as e:
+                    results[document_id] = {"document_id": document_id, "status": "failed", "error": str(e)}
+                    return
+            if doc_data is None:
+                results[document_id] = {"document_id": document_id, "status": "not_found"}
+            else:
+                targets[document_id] = doc_data
+                deleted.append(document_id)
+        
+        await asyncio.gather(*(take(document_id) for document_id in contended))
+        
+        # Files are removed only for documents whose records are gone, a bounded number at a time
+        async def remove_file(document_id: str):
+            async with semaphore:
+                try:
+                    file_status = await cleanup_document_file(targets[document_id])
+                except Exception as e:
+                    # The cleanup could not even be queued; the record is gone, so report that
+                    results[document_id] = {"document_id": document_id, "status": "deleted", "file": "failed", "error": str(e)}
+                    return
+            results[document_id] = {"document_id": document_id, "status": "deleted", "file": file_status}
+        
+        await asyncio.gather(*(remove_file(document_id) for document_id in deleted))
+        
+        def forget_documents():
+            for document_id in deleted:
+                remove_document_from_index(user_id, document_id)
+        
+        if deleted:
+            spawn_background_task(asyncio.to_thread(forget_documents))
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error deleting documents: {str(e)}")
+    
+    items = list(results.values())
+    return {
+        "success": all(item["status"] != "failed" for item in items),
+        "deleted_count": sum(1 for item in items if item["status"] == "deleted"),
+        "not_found_count": sum(1 for item in items if item["status"] == "not_found"),
+        "failed_count": sum(1 for item in items if item["status"] == "failed"),
+        "queued_file_cleanups": sum(1 for item in items if item.get("file") == "queued"),
+        "failed_file_cleanups": sum(1 for item in items if item.get("file") == "failed"),
+        "results": items
+    }
+
+def parse_byte_range(range_header: Optional[str], size: int) -> Optional[tuple]:
+    """
+    The (start, end) byte span of a single-range "bytes=" header, inclusive. Returns None to send
+    the whole file (no header, or several ranges) and raises 416 when the range cannot be met.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_text, _, end_text = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = min(int(end_text), size - 1) if end_text else size - 1
+        else:
+            start, end = max(size - int(end_text), 0), size - 1  # Suffix range: the last N bytes
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+def _iter_mapped_range(local_path: str, start: int, end: int):
+    """Yield a byte span of a file from a memory map, a chunk at a time"""
+    with open(local_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            for offset in range(start, end + 1, FILE_STREAM_CHUNK_SIZE):
+                yield bytes(view[offset:min(offset + FILE_STREAM_CHUNK_SIZE, end + 1)])
+        finally:
+            view.release()
+
+@app.get("/files/{name:path}")
+async def serve_stored_file(name: str, range_header: Optional[str] = Header(None, alias="range")):
+    """Serve a file from local storage: whole files via sendfile, byte ranges from a memory map"""
+    try:
+        local_path = blob_store.local_path(name)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not local_path or not os.path.isfile(local_path):
+        raise HTTPException(status_code=404, detail="File not found")
+    # Cached artifacts share the store but are private; the API reads them back itself
+    cache_dir = blob_store.local_path(CACHE_BLOB_PREFIX)
+    if os.path.commonpath([local_path, cache_dir]) == cache_dir:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    size = os.path.getsize(local_path)
+    byte_range = parse_byte_range(range_header, size) if size else None
+    if byte_range is None:
+        # FileResponse hands the file to the server's sendfile path when it has one
+        return FileResponse(local_path, headers={"Accept-Ranges": "bytes"})
+    
+    start, end = byte_range
+    media_type = mimetypes.guess_type(local_path)[0] or "application/octet-stream"
+    return StreamingResponse(
+        _iter_mapped_range(local_path, start, end),
+        status_code=206,
+        media_type=media_type,
+        headers={
+            "Accept-Ranges": "bytes",
+            "Content-Range": f"bytes {start}-{end}/{size}",
+            "Content-Length": str(end - start + 1)
+        }
+    )
+
+# ==================== CONVERSATION MEMORY ====================
+
+CHAT_MEMORY_DOC = "conversation"  # users/{user_id}/chat_memory/conversation
+_memory_refreshes_in_flight = set()
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * 4
+    return text if len(text) <= max_chars else text[:max_chars].rsplit(' ', 1)[0] + "…"
+
+def format_chat_turn(turn: Dict[str, Any]) -> str:
+    return f"User: {turn.get('message', '')}\nAssistant: {turn.get('response', '')}"
+
+async def load_conversation_memory(user_id: str) -> Dict[str, Any]:
+    """
+    Load the conversation so far within CHAT_MEMORY_TOKEN_BUDGET: the rolling summary of older
+    turns plus as many recent turns, verbatim, as fit. Recent turns that no longer fit and are not
+    yet in the summary are returned as "unsummarized" so the caller can fold them in.
+    """
+    memory, history = await asyncio.gather(
+        repo.get(user_path(user_id, 'chat_memory', CHAT_MEMORY_DOC)),
+        repo.query(user_path(user_id, 'chat_history'), order_by='timestamp', descending=True, limit=CHAT_MEMORY_FETCH_TURNS)
+    )
+    memory = memory or {}
+    summary = _truncate_to_tokens(memory.get("summary", ""), CHAT_MEMORY_SUMMARY_TOKENS)
+    summarized_until = memory.get("summarized_until")
+    turns = [turn for _, turn in history]  # Newest first
+    
+    # The latest turns may still be in the write-behind queue (stored as naive UTC)
+    queued = [
+        {**turn, "timestamp": turn["timestamp"].replace(tzinfo=timezone.utc)}
+        for turn in write_behind_queue.pending_in(f"users/{user_id}/chat_history")
+    ]
+    turns = list(reversed(queued)) + turns
+    
+    budget = CHAT_MEMORY_TOKEN_BUDGET - estimate_tokens(summary)
+    recent_turns, overflow = [], []
+    for turn in turns:
+        cost = estimate_tokens(format_chat_turn(turn))
+        if not overflow and len(recent_turns) < CHAT_MEMORY_MAX_RECENT_TURNS and cost <= budget:
+            recent_turns.append(turn)
+            budget -= cost
+        else:
+            overflow.append(turn)
+    
+    unsummarized = [
+        turn for turn in overflow
+        if summarized_until is None or (turn.get("timestamp") and turn["timestamp"] > summarized_until)
+    ]
+    return {
+        "summary": summary,
+        "recent_turns": list(reversed(recent_turns)),  # Oldest first, as in the conversation
+        "unsummarized": list(reversed(unsummarized))
+    }
+
+def _fallback_conversation_summary(previous_summary: str, turns: List[Dict[str, Any]]) -> str:
+    """Extractive summary used when Gemini is unavailable: the earlier questions, newest last"""
+    questions = "; ".join(turn.get("message", "").strip() for turn in turns)
+    if previous_summary:
+        return f"{previous_summary} Later the user asked: {questions}"
+    return f"Earlier the user asked: {questions}"
+
+async def summarize_conversation(previous_summary: str, turns: List[Dict[str, Any]]) -> str:
+    """Fold older chat turns into the rolling conversation summary"""
+    if not GEMINI_API_KEY:
+        return _fallback_conversation_summary(previous_summary, turns)
+    
+    transcript = "\n\n".join(format_chat_turn(turn) for turn in turns)
+    prompt = f"""
+    You maintain a running summary of a conversation between a user and an Indian tax assistant.
+    
+    Current summary:
+    {previous_summary or "(none)"}
+    
+    Older turns to fold in:
+    {transcript}
+    
+    Write the updated summary in at most {CHAT_MEMORY_SUMMARY_TOKENS * 3 // 4} words. Keep facts the user
+    shared about themselves (income, city, family, chosen regime, investments), their open questions and
+    any conclusions reached. Drop greetings and general explanations. Return only the summary text.
+    """
+    try:
+        model = genai.GenerativeModel('gemini-2.0-flash', generation_config={
+            "temperature": 0.1,
+            "max_output_tokens": CHAT_MEMORY_SUMMARY_TOKENS
+        })
+        response = await asyncio.wait_for(model.generate_content_async(prompt), timeout=30.0)
+        return response.text.strip()
+    except Exception as e:
+        print(f"Warning: Could not summarize conversation with Gemini: {e}")
+        return _fallback_conversation_summary(previous_summary, turns)
+
+async def refresh_conversation_summary(user_id: str, previous_summary: str, turns: List[Dict[str, Any]]):
+    """Background job: fold turns that dropped out of the verbatim window into the summary"""
+    if user_id in _memory_refreshes_in_flight:
+        return
+    _memory_refreshes_in_flight.add(user_id)
+    try:
+        summary = await summarize_conversation(previous_summary, turns)
+        await repo.set(user_path(user_id, 'chat_memory', CHAT_MEMORY_DOC), {
+            "summary": _truncate_to_tokens(summary, CHAT_MEMORY_SUMMARY_TOKENS),
+            "summarized_until": max(turn["timestamp"] for turn in turns),
+            "updated_at": datetime.utcnow()
+        })
+    except Exception as e:
+        print(f"Warning: Could not refresh conversation summary: {e}")
+    finally:
+        _memory_refreshes_in_flight.discard(user_id)
+
+def schedule_memory_refresh(user_id: str, context: Dict[str, Any]):
+    """Start a summary refresh if the context left turns out of both the summary and the window"""
+    conversation = context.get("conversation")
+    if conversation and conversation["unsummarized"]:
+        turns = [turn for turn in conversation["unsummarized"] if turn.get("timestamp")]
+        if turns:
+            spawn_background_task(refresh_conversation_summary(user_id, conversation["summary"], turns))
+
+async def _recent_documents(user_id: str) -> List[Dict[str, Any]]:
+    try:
+        docs = await repo.query(user_path(user_id, 'documents'), order_by='uploaded_at', descending=True, limit=5)
+        return [{**doc_data, 'id': doc_id} for doc_id, doc_data in docs]
+    except Exception as e:
+        print(f"Warning: Could not fetch user documents for context: {e}")
+        return []
+
+async def _document_types(user_id: str) -> List[str]:
+    # A projection, so only one field is read
+    try:
+        docs = await repo.query(user_path(user_id, 'documents'), fields=['document_type'])
+        return [doc_data.get('document_type', '') for _, doc_data in docs]
+    except Exception as e:
+        print(f"Warning: Could not fetch user document types: {e}")
+        return []
+
+async def _conversation_memory(user_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        return await load_conversation_memory(user_id)
+    except Exception as e:
+        print(f"Warning: Could not load conversation memory: {e}")
+        return None
+
+async def build_chat_context(request: ChatRequest) -> Dict[str, Any]:
+    """Build chat context from the user's most recent documents and profile"""
+    # Recent documents (for the prompt), all document types (for gap-based suggestions),
+    # conversation memory and document excerpts are independent, so they are fetched together
+    user_documents, document_types, conversation, document_excerpts = await asyncio.gather(
+        _recent_documents(request.user_id),
+        _document_types(request.user_id),
+        _conversation_memory(request.user_id),
+        asyncio.to_thread(retrieve_document_excerpts, request.user_id, request.message)
+    )
+    
+    return {
+        "documents": user_documents,
+        "document_types": document_types,
+        "conversation": conversation,
+        "document_excerpts": document_excerpts,
+        "user_profile": request.context.get("user_profile", {})
+    }
+
+def store_chat_history(user_id: str, message: str, response: str, context_used: bool):
+    """Queue a chat turn for the user's chat history (written behind the response)"""
+    try:
+        chat_data = {
+            "user_id": user_id,
+            "message": message,
+            "response": response,
+            "timestamp": datetime.utcnow(),
+            "context_used": context_used
+        }
+        chat_path = user_path(user_id, 'chat_history')
+        write_behind_queue.enqueue(f"{chat_path}/{repo.new_id(chat_path)}", chat_data)
+    except Exception as e:
+        print(f"Warning: Could not store chat history: {e}")
+
 @app.post("/chat")
 async def chat_with_assistant(request: ChatRequest):
     """Chat with the tax assistant using Gemini AI"""
     try:
-        # Get user's documents for context
-        user_documents = []
-        try:
-            docs_query = db.collection('users').document(request.user_id).collection('documents')
-            docs = docs_query.order_by('uploaded_at', direction=firestore.Query.DESCENDING).limit(5).stream()
-            
-            for doc in docs:
-                doc_data = doc.to_dict()
-                doc_data['id'] = doc.id
-                user_documents.append(doc_data)
-        except Exception as e:
-            print(f"Warning: Could not fetch user documents for context: {e}")
-        
-        # Build context
-        context = {
-            "documents": user_documents,
-            "user_profile": request.context.get("user_profile", {})
-        }
-        
-        # Process with Gemini AI
-        ai_response = await process_chat_with_gemini(request.message, context)
+        # Computational and FAQ-class questions are answered without Gemini
+        question_vector, local_answer, source = await answer_chat_without_llm(request)
+        if local_answer is not None:
+            context_used = source == "tax_engine"
+            record_chat_source(source)
+            store_chat_history(request.user_id, request.message, local_answer["response"], context_used)
+            return {
+                "success": True,
+                "response": local_answer["response"],
+                "follow_up_questions": local_answer["follow_up_questions"],
+                "action_chips": local_answer["action_chips"],
+                "context_used": context_used,
+                "source": source,
+                "timestamp": datetime.utcnow().isoformat()
+            }
         
-        # Extract response components
-        main_response = ai_response.get("response", "")
-        follow_up_questions = ai_response.get("follow_up_questions", [])
-        action_chips = ai_response.get("action_chips", [])
+        # Answers to generic questions are shared, so they must not draw on the user's documents
+        if question_vector is not None:
+            context = {"documents": [], "user_profile": {}}
+        else:
+            context = await build_chat_context(request)
+            schedule_memory_refresh(request.user_id, context)
+        user_documents = context["documents"]
+        
+        # Gemini writes the answer; follow-ups and action chips are chosen locally meanwhile
+        ai_response, suggestions = await asyncio.gather(
+            process_chat_with_gemini(request.message, context),
+            asyncio.to_thread(suggest_chat_follow_ups, request.message, question_vector, context.get("document_types"))
+        )
+        follow_up_questions = suggestions["follow_up_questions"]
+        action_chips = suggestions["action_chips"]
         
         # Sanitize and format main response
-        formatted_response = await sanitize_chat_response(main_response)
+        formatted_response = sanitize_chat_response(ai_response.get("response", ""))
         
-        # Store chat history (optional)
-        try:
-            chat_data = {
-                "user_id": request.user_id,
-                "message": request.message,
+        if not ai_response.get("fallback"):
+            await remember_chat_answer(question_vector, request.message, {
                 "response": formatted_response,
-                "timestamp": datetime.utcnow(),
-                "context_used": bool(user_documents)
-            }
-            db.collection('users').document(request.user_id).collection('chat_history').add(chat_data)
-        except Exception as e:
-            print(f"Warning: Could not store chat history: {e}")
+                **suggestions
+            })
+        
+        # Store chat history (optional)
+        record_chat_source("gemini")
+        store_chat_history(request.user_id, request.message, formatted_response, bool(user_documents))
         
         return {
             "success": True,
             "response": formatted_response,
-            "follow_up_questions": follow_up_questions[:4],  # Limit to 4
-            "action_chips": action_chips[:4],  # Limit to 4
+            "follow_up_questions": follow_up_questions,
+            "action_chips": action_chips,
             "context_used": bool(user_documents),
+            "source": "gemini",
             "timestamp": datetime.utcnow().isoformat()
         }
         
@@ -813,17 +3404,118 @@ async def chat_with_assistant(request: ChatRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing chat: {str(e)}")
 
+@app.post("/chat/stream")
+async def chat_with_assistant_stream(request: ChatRequest):
+    """
+    Chat with the tax assistant, streaming the answer as Server-Sent Events.
+    
+    Events: "token" ({"text": ...}) for each generated chunk, then "suggestions"
+    ({"follow_up_questions": [...], "action_chips": [...]}) and a final "done".
+    """
+    question_vector, local_answer, source = await answer_chat_without_llm(request)
+    if local_answer is not None or question_vector is not None:
+        # Generic question: shared answers must not draw on the user's documents
+        context = {"documents": [], "user_profile": {}}
+    else:
+        context = await build_chat_context(request)
+        schedule_memory_refresh(request.user_id, context)
+    user_documents = context["documents"]
+    
+    async def event_stream():
+        try:
+            if local_answer is not None:
+                record_chat_source(source)
+                yield sse_event("token", {"text": local_answer["response"]})
+                yield sse_event("suggestions", {
+                    "follow_up_questions": local_answer["follow_up_questions"],
+                    "action_chips": local_answer["action_chips"]
+                })
+                context_used = source == "tax_engine"
+                store_chat_history(request.user_id, request.message, local_answer["response"], context_used)
+                yield sse_event("done", {
+                    "context_used": context_used,
+                    "source": source,
+                    "timestamp": datetime.utcnow().isoformat()
+                })
+                return
+            
+            # Follow-ups and action chips are chosen locally while the answer streams
+            suggestions_task = asyncio.ensure_future(asyncio.to_thread(
+                suggest_chat_follow_ups, request.message, question_vector, context.get("document_types")
+            ))
+            answer_parts = []
+            stream_failed = False
+            try:
+                async for text in stream_chat_with_gemini(request.message, context):
+                    answer_parts.append(text)
+                    yield sse_event("token", {"text": text})
+            except Exception as e:
+                print(f"Warning: Streaming chat response failed: {e}")
+                stream_failed = True
+                error_text = chat_stream_error_message(e)
+                if answer_parts:
+                    error_text = f"\n\n{error_text}"
+                answer_parts.append(error_text)
+                yield sse_event("token", {"text": error_text})
+            
+            answer = "".join(answer_parts).strip()
+            suggestions = await suggestions_task
+            yield sse_event("suggestions", suggestions)
+            
+            if GEMINI_API_KEY and not stream_failed and question_vector is not None:
+                # Cached in the same shape /chat caches, so either endpoint can serve it
+                await remember_chat_answer(question_vector, request.message, {
+                    "response": sanitize_chat_response(answer),
+                    **suggestions
+                })
+            
+            record_chat_source("gemini")
+            store_chat_history(request.user_id, request.message, answer, bool(user_documents))
+            
+            yield sse_event("done", {
+                "context_used": bool(user_documents),
+                "source": "gemini",
+                "timestamp": datetime.utcnow().isoformat()
+            })
+        except Exception as e:
+            print(f"Error streaming chat: {e}")
+            yield sse_event("error", {"detail": f"Error processing chat: {str(e)}"})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # Stop proxies from buffering the stream
+        }
+    )
+
+@app.get("/chat/stats")
+async def get_chat_stats():
+    """Chats answered per source by this worker, and the fraction served without Gemini"""
+    with _chat_source_counts_lock:
+        counts = dict(chat_source_counts)
+    total = sum(counts.values())
+    served_locally = sum(counts.get(source, 0) for source in LOCAL_CHAT_SOURCES)
+    return {
+        "success": True,
+        "total_chats": total,
+        "by_source": counts,
+        "served_locally": served_locally,
+        "local_fraction": round(served_locally / total, 4) if total else 0.0,
+        "knowledge_base_enabled": KB_ENABLED,
+        "semantic_cache_enabled": CHAT_CACHE_ENABLED
+    }
+
 @app.get("/chat-history/{user_id}")
 async def get_chat_history(user_id: str, limit: int = Query(10, ge=1, le=50)):
     """Get user's chat history"""
     try:
-        query = db.collection('users').document(user_id).collection('chat_history')
-        docs = query.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(limit).stream()
+        docs = await repo.query(user_path(user_id, 'chat_history'), order_by='timestamp', descending=True, limit=limit)
         
         chat_history = []
-        for doc in docs:
-            doc_data = doc.to_dict()
-            doc_data['id'] = doc.id
+        for doc_id, doc_data in docs:
+            doc_data['id'] = doc_id
             # Convert Firestore datetime objects to ISO format strings for JSON serialization
             doc_data = convert_firestore_datetime_to_iso(doc_data)
             chat_history.append(doc_data)
@@ -851,122 +3543,653 @@ def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     
     return R * c
 
+def haversine_km(latitude: float, longitude: float, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    """Vectorized haversine distance in kilometers from one point to arrays of points"""
+    lat1, lon1 = np.radians(latitude), np.radians(longitude)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+class CAFirmCatalogue:
+    """
+    Local catalogue of CA firms seen in past Places responses. Nearby searches in areas it was
+    fed recently are answered from it without calling Places, and it keeps answering when the
+    Places API is throttled or unreachable. Firms are kept in NumPy arrays sorted by latitude:
+    a query binary-searches the latitude band, masks the longitude band and ranks the survivors
+    with vectorized haversine.
+    """
+    
+    def __init__(self):
+        self.records = {}  # place_id -> {"place": ..., "details": ..., "updated_at": ...}
+        self.coverage = {}  # Search key -> (fed at, whether every result page was seen)
+        self.place_ids = []  # Sorted by latitude, aligned with the arrays below
+        self.latitudes = np.empty(0)
+        self.longitudes = np.empty(0)
+        self.dirty = False
+        self.lock = threading.Lock()
+    
+    def upsert(self, places: List[Dict[str, Any]], details: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """Add or refresh firms from a Places response. Returns the records that changed."""
+        changed = {}
+        with self.lock:
+            for place in places:
+                place_id = place.get("place_id")
+                if not place_id or "location" not in place.get("geometry", {}):
+                    continue
+                previous = self.records.get(place_id, {})
+                # Opening status is only meaningful at search time
+                stored_place = {k: v for k, v in place.items() if k != "opening_hours"}
+                place_details = details.get(place_id) or previous.get("details", {})
+                if previous.get("place") == stored_place and previous.get("details") == place_details:
+                    continue
+                record = {"place": stored_place, "details": place_details, "updated_at": time.time()}
+                self.records[place_id] = record
+                changed[place_id] = record
+            if changed:
+                self.dirty = True
+        return changed
+    
+    def merge(self, records: Dict[str, Dict[str, Any]]):
+        """Merge firms persisted by any worker, keeping whichever copy of a firm is newer"""
+        with self.lock:
+            for place_id, record in records.items():
+                if record.get("updated_at", 0) > self.records.get(place_id, {}).get("updated_at", -1):
+                    self.records[place_id] = record
+            self.dirty = True
+    
+    def mark_covered(self, search_key: str, complete: bool):
+        with self.lock:
+            self.coverage[search_key] = (time.time(), complete)
+    
+    def coverage_for(self, search_key: str) -> Optional[bool]:
+        """None unless the search's area was fed recently, else whether all its result pages were seen"""
+        with self.lock:
+            entry = self.coverage.get(search_key)
+            if entry is None or time.time() - entry[0] > CA_CATALOGUE_COVERAGE_SECONDS:
+                return None
+            return entry[1]
+    
+    def _rebuild(self):
+        place_ids = list(self.records)
+        latitudes = np.array([self.records[pid]["place"]["geometry"]["location"]["lat"] for pid in place_ids], dtype='float64')
+        longitudes = np.array([self.records[pid]["place"]["geometry"]["location"]["lng"] for pid in place_ids], dtype='float64')
+        order = np.argsort(latitudes, kind='stable')
+        self.place_ids = [place_ids[i] for i in order]
+        self.latitudes = latitudes[order]
+        self.longitudes = longitudes[order]
+        self.dirty = False
+    
+    def query(self, latitude: float, longitude: float, radius_m: int, limit: int) -> List[tuple]:
+        """The closest firms within the radius, nearest first, as (record, distance in km)"""
+        with self.lock:
+            if self.dirty:
+                self._rebuild()
+            radius_km = radius_m / 1000
+            lat_margin = np.degrees(radius_km / EARTH_RADIUS_KM)
+            start, end = np.searchsorted(self.latitudes, [latitude - lat_margin, latitude + lat_margin])
+            if start == end:
+                return []
+            
+            lats, lons = self.latitudes[start:end], self.longitudes[start:end]
+            lon_margin = lat_margin / max(np.cos(np.radians(latitude)), 1e-6)
+            in_band = np.abs((lons - longitude + 180) % 360 - 180) <= lon_margin
+            candidates = np.nonzero(in_band)[0]
+            distances = haversine_km(latitude, longitude, lats[candidates], lons[candidates])
+            within = distances <= radius_km
+            candidates, distances = candidates[within], distances[within]
+            
+            if len(distances) > limit:
+                nearest = np.argpartition(distances, limit - 1)[:limit]
+                candidates, distances = candidates[nearest], distances[nearest]
+            order = np.argsort(distances)
+            return [(self.records[self.place_ids[start + candidates[i]]], float(distances[i])) for i in order]
+
+ca_catalogue = CAFirmCatalogue()
+
+async def load_ca_catalogue():
+    """Load the firms every worker has persisted to ca_firms/{place_id}"""
+    try:
+        firms = await repo.query("ca_firms")
+        ca_catalogue.merge(dict(firms))
+        print(f"✅ Loaded CA catalogue ({len(firms)} firms)")
+    except Exception as e:
+        print(f"Warning: Could not load CA catalogue: {e}")
+
+def local_ca_results(latitude: float, longitude: float, radius: int, limit: int) -> List[Dict[str, Any]]:
+    """Nearby CA results from the local catalogue"""
+    return [
+        build_ca_result(record["place"], record["details"], latitude, longitude, distance)
+        for record, distance in ca_catalogue.query(latitude, longitude, radius, limit)
+    ]
+
+def catalogue_nearby(latitude: float, longitude: float, radius: int, offset: int, limit: int,
+                     search_key: str) -> Optional[List[tuple]]:
+    """
+    (place, distance in km) within the radius from the catalogue, nearest first, when it can stand
+    in for a Places search of this area: the area was searched recently and either every result
+    page was seen or the catalogue already holds more firms than this page needs.
+    """
+    if not CA_CATALOGUE_ENABLED:
+        return None
+    complete = ca_catalogue.coverage_for(search_key)
+    if complete is None:
+        return None
+    matches = ca_catalogue.query(latitude, longitude, radius, offset + limit + 1)
+    if not complete and len(matches) <= offset + limit:
+        return None  # A Places page not seen yet may hold more firms
+    return [(record["place"], distance) for record, distance in matches]
+
+def remember_ca_firms(places: List[Dict[str, Any]], details: Dict[str, Dict[str, Any]],
+                      search_key: Optional[str] = None, complete: bool = False):
+    """
+    Feed firms into the catalogue, persisting the ones that changed as one document per firm so
+    workers' updates merge. With a search key, the area counts as covered from now on.
+    """
+    if not CA_CATALOGUE_ENABLED:
+        return
+    for place_id, record in ca_catalogue.upsert(places, details).items():
+        write_behind_queue.enqueue(f"ca_firms/{place_id}", record)
+    if search_key:
+        ca_catalogue.mark_covered(search_key, complete)
+
+_places_client: Optional[httpx.AsyncClient] = None
+
+def get_places_client() -> httpx.AsyncClient:
+    """Shared async HTTP client for the Places API, so connections are kept alive across requests"""
+    global _places_client
+    if _places_client is None:
+        _places_client = httpx.AsyncClient(
+            base_url=PLACES_API_BASE_URL,
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            limits=httpx.Limits(max_connections=PLACES_MAX_CONNECTIONS, max_keepalive_connections=PLACES_MAX_CONNECTIONS)
+        )
+    return _places_client
+
+async def close_places_client():
+    global _places_client
+    if _places_client is not None:
+        await _places_client.aclose()
+        _places_client = None
+
+# Geohash cells: precision -> approximate cell size in meters (width, height)
+GEOHASH_CELL_SIZES = {5: (4900, 4900), 6: (1200, 610)}
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def geohash_encode(latitude: float, longitude: float, precision: int) -> str:
+    """Standard geohash of a coordinate"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash, bits, bit_count, even = [], 0, 0, True
+    while len(geohash) < precision:
+        value, value_range = (longitude, lon_range) if even else (latitude, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_BASE32[bits])
+            bits, bit_count = 0, 0
+    return "".join(geohash)
+
+def geohash_center(geohash: str) -> tuple:
+    """Latitude and longitude of a geohash cell's center"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        bits = GEOHASH_BASE32.index(char)
+        for shift in range(4, -1, -1):
+            value_range = lon_range if even else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if (bits >> shift) & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+class TTLCache:
+    """Small in-process LRU cache whose entries expire after a fixed time"""
+    
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # Key -> (stored at, value)
+        self.lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            if time.time() - item[0] > self.ttl_seconds:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return item[1]
+    
+    def set(self, key: str, value: Any, stored_at: Optional[float] = None):
+        with self.lock:
+            self.entries[key] = (stored_at or time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+# In-process caches in front of the shared Firestore caches (places_search_cache / place_details_cache)
+places_search_cache = TTLCache(PLACES_SEARCH_TTL_SECONDS, PLACES_CACHE_MAX_ENTRIES)
+place_details_cache = TTLCache(PLACES_DETAILS_TTL_SECONDS, PLACES_CACHE_MAX_ENTRIES)
+
+# Fields of a nearbysearch result that build_ca_result reads
+PLACE_SEARCH_FIELDS = ("place_id", "name", "vicinity", "formatted_address", "rating", "user_ratings_total", "geometry", "opening_hours", "types")
+
+def places_search_key(latitude: float, longitude: float, radius: int) -> tuple:
+    """
+    Bucket a search so nearby users share it: (cache key, cell center, search radius).
+    The search runs from the cell center with the radius widened by half the cell diagonal,
+    so it covers the requested radius from anywhere in the cell.
+    """
+    radius_bucket = next((bucket for bucket in PLACES_RADIUS_BUCKETS if bucket >= radius), PLACES_RADIUS_BUCKETS[-1])
+    precision = 5 if radius_bucket >= 5000 else 6
+    cell = geohash_encode(latitude, longitude, precision)
+    cell_width, cell_height = GEOHASH_CELL_SIZES[precision]
+    search_radius = min(50000, radius_bucket + int(sqrt(cell_width ** 2 + cell_height ** 2) / 2))
+    keyword_slug = re.sub(r'[^a-z0-9]+', '-', PLACES_SEARCH_KEYWORD.lower())
+    return f"{cell}_{radius_bucket}_{keyword_slug}", geohash_center(cell), search_radius
+
+async def _read_shared_cache(collection: str, key: str, ttl_seconds: int) -> Optional[Dict[str, Any]]:
+    """Read a fresh entry from a Firestore-backed cache"""
+    entry = await repo.get(f"{collection}/{key}")
+    if entry is not None and time.time() - entry.get("cached_at", 0) <= ttl_seconds:
+        return entry
+    return None
+
+def _trim_places(raw: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{field: place[field] for field in PLACE_SEARCH_FIELDS if field in place} for place in raw.get("results", [])]
+
+def _store_search(key: str, data: Dict[str, Any]):
+    places_search_cache.set(key, data, data["cached_at"])
+    write_behind_queue.enqueue(f"places_search_cache/{key}", {"data": data, "cached_at": data["cached_at"]})
+
+async def cached_nearby_search(latitude: float, longitude: float, radius: int) -> tuple:
+    """
+    Nearbysearch results for the user's geohash cell and radius bucket: (search key, response,
+    cache status). Only the first page is fetched here; extend_nearby_search adds later pages.
+    """
+    key, (center_lat, center_lng), search_radius = places_search_key(latitude, longitude, radius)
+    
+    data = places_search_cache.get(key)
+    if data is not None:
+        return key, data, "hit"
+    try:
+        entry = await _read_shared_cache("places_search_cache", key, PLACES_SEARCH_TTL_SECONDS)
+        if entry is not None:
+            places_search_cache.set(key, entry["data"], entry["cached_at"])
+            return key, entry["data"], "hit"
+    except Exception as e:
+        print(f"Warning: Could not read places search cache: {e}")
+    
+    raw = await places_nearby_search(center_lat, center_lng, search_radius)
+    data = {
+        "status": raw.get("status"),
+        "results": _trim_places(raw),
+        "next_page_token": raw.get("next_page_token"),
+        "next_page_token_at": time.time(),
+        "cached_at": time.time()  # Later pages keep the first page's expiry
+    }
+    if data["status"] in ("OK", "ZERO_RESULTS"):
+        _store_search(key, data)
+    return key, data, "miss"
+
+# One page fetch at a time per search in this worker, so concurrent requests do not fetch it twice
+_search_extension_locks = weakref.WeakValueDictionary()
+
+def _drop_page_token(key: str, data: Dict[str, Any]):
+    """Stop following a search's pages, so later requests do not retry a dead token until the search expires"""
+    data["next_page_token"] = None
+    data["truncated"] = True  # More results may exist, so the area is not fully covered
+    _store_search(key, data)
+
+async def extend_nearby_search(key: str, data: Dict[str, Any]) -> bool:
+    """Append the next page of results to a cached search. Returns False when there are no more."""
+    known_results = len(data["results"])
+    lock = _search_extension_locks.get(key)
+    if lock is None:
+        lock = _search_extension_locks[key] = asyncio.Lock()
+    async with lock:
+        # Another request may have fetched the page while this one waited
+        latest = places_search_cache.get(key) or data
+        if len(latest["results"]) > known_results:
+            if latest is not data:
+                data.update(latest)
+            return True
+        
+        page_token = data.get("next_page_token")
+        if not page_token:
+            return False
+        token_age = time.time() - data.get("next_page_token_at", data.get("cached_at", 0))
+        if token_age > PLACES_PAGE_TOKEN_MAX_AGE_SECONDS:
+            _drop_page_token(key, data)
+            return False
+        raw = await places_next_page(page_token)
+        if raw.get("status") not in ("OK", "ZERO_RESULTS"):
+            print(f"Warning: Could not fetch next results page: {places_error_message(raw.get('status'))}")
+            _drop_page_token(key, data)
+            return False
+        seen = {place.get("place_id") for place in data["results"]}
+        data["results"] = data["results"] + [place for place in _trim_places(raw) if place.get("place_id") not in seen]
+        data["next_page_token"] = raw.get("next_page_token")
+        data["next_page_token_at"] = time.time()
+        data.setdefault("cached_at", time.time())
+        _store_search(key, data)
+        return True
+
+async def iter_place_details(place_ids: List[str]):
+    """
+    Yield (place_id, details, from cache) for each place: cached details first, then
+    Places API lookups as each completes, so callers can stream enriched results.
+    """
+    details = {}
+    missing = []
+    for place_id in place_ids:
+        cached = place_details_cache.get(place_id)
+        if cached is not None:
+            details[place_id] = cached
+        else:
+            missing.append(place_id)
+    
+    if missing:
+        try:
+            # One round trip for all the places missing from this worker's cache
+            entries = await repo.get_many([f"place_details_cache/{place_id}" for place_id in missing])
+            for path, entry in entries.items():
+                place_id = path.rsplit("/", 1)[-1]
+                if time.time() - entry.get("cached_at", 0) <= PLACES_DETAILS_TTL_SECONDS:
+                    details[place_id] = entry["details"]
+                    place_details_cache.set(place_id, entry["details"], entry["cached_at"])
+        except Exception as e:
+            print(f"Warning: Could not read place details cache: {e}")
+    for place_id, place_details in details.items():
+        yield place_id, place_details, True
+    
+    to_fetch = [place_id for place_id in missing if place_id not in details]
+    if not to_fetch:
+        return
+    
+    # Details lookups run concurrently, capped so one search cannot exhaust the pool
+    semaphore = asyncio.Semaphore(PLACES_DETAILS_CONCURRENCY)
+    
+    async def fetch(place_id: str):
+        return place_id, await fetch_place_details(place_id, semaphore)
+    
+    for next_done in asyncio.as_completed([fetch(place_id) for place_id in to_fetch]):
+        place_id, place_details = await next_done
+        if place_details:  # Failed lookups are retried next time
+            place_details_cache.set(place_id, place_details)
+            write_behind_queue.enqueue(
+                f"place_details_cache/{place_id}",
+                {"details": place_details, "cached_at": time.time()}
+            )
+        yield place_id, place_details, False
+
+async def cached_place_details(place_ids: List[str]) -> tuple:
+    """Details for each place, from the caches where possible: ({place_id: details}, cache hits)"""
+    details, hits = {}, 0
+    async for place_id, place_details, cached in iter_place_details(place_ids):
+        details[place_id] = place_details
+        hits += cached
+    return details, hits
+
+def places_error_message(status: str) -> str:
+    """Readable message for a non-OK Places API status"""
+    error_msg = f"Places API error: {status}"
+    if status == "OVER_QUERY_LIMIT":
+        error_msg += " - API quota exceeded"
+    elif status == "REQUEST_DENIED":
+        error_msg += " - Request denied (check API key permissions)"
+    elif status == "INVALID_REQUEST":
+        error_msg += " - Invalid request parameters"
+    return error_msg
+
+async def places_nearby_search(latitude: float, longitude: float, radius: int) -> Dict[str, Any]:
+    """Run a Places nearbysearch for chartered accountants and return the raw response"""
+    params = {
+        "location": f"{latitude},{longitude}",
+        "radius": radius,
+        "type": "accounting",
+        "keyword": PLACES_SEARCH_KEYWORD,
+        "key": GOOGLE_PLACES_API_KEY
+    }
+    response = await get_places_client().get("/nearbysearch/json", params=params)
+    response.raise_for_status()
+    return response.json()
+
+async def places_next_page(page_token: str) -> Dict[str, Any]:
+    """Fetch the next page of a nearbysearch. Google only activates a token a moment after
+    issuing it and answers INVALID_REQUEST until then, so retry briefly."""
+    params = {"pagetoken": page_token, "key": GOOGLE_PLACES_API_KEY}
+    for attempt in range(PLACES_PAGE_TOKEN_RETRIES):
+        response = await get_places_client().get("/nearbysearch/json", params=params)
+        response.raise_for_status()
+        data = response.json()
+        if data.get("status") != "INVALID_REQUEST":
+            return data
+        await asyncio.sleep(PLACES_PAGE_TOKEN_DELAY_SECONDS)
+    return data
+
+async def fetch_place_details(place_id: str, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    """Fetch phone number, website and opening hours for a place; empty if the lookup fails"""
+    params = {
+        "place_id": place_id,
+        "fields": "formatted_phone_number,website,opening_hours",
+        "key": GOOGLE_PLACES_API_KEY
+    }
+    try:
+        async with semaphore:
+            response = await get_places_client().get("/details/json", params=params, timeout=5.0)
+        if response.status_code == 200:
+            details_data = response.json()
+            if details_data.get("status") == "OK":
+                result = details_data.get("result", {})
+                return {
+                    "phone_number": result.get("formatted_phone_number"),
+                    "website": result.get("website"),
+                    "opening_hours": result.get("opening_hours")
+                }
+    except Exception as e:
+        print(f"Warning: Could not fetch place details for {place_id}: {e}")
+    return {}
+
+def build_ca_result(place: Dict[str, Any], details: Dict[str, Any], latitude: float, longitude: float,
+                    distance_km: Optional[float] = None) -> Dict[str, Any]:
+    """Shape a nearbysearch place plus its details into the API result"""
+    place_lat = place["geometry"]["location"]["lat"]
+    place_lng = place["geometry"]["location"]["lng"]
+    if distance_km is None:
+        distance_km = calculate_distance(latitude, longitude, place_lat, place_lng)
+    return {
+        "place_id": place.get("place_id"),
+        "name": place.get("name", "Unknown"),
+        "address": place.get("vicinity") or place.get("formatted_address", ""),
+        "rating": place.get("rating", 0),
+        "user_ratings_total": place.get("user_ratings_total", 0),
+        "location": {
+            "latitude": place_lat,
+            "longitude": place_lng
+        },
+        "distance_km": round(distance_km, 2),
+        "phone_number": details.get("phone_number"),
+        "website": details.get("website"),
+        "is_open": place.get("opening_hours", {}).get("open_now") if place.get("opening_hours") else None,
+        "types": place.get("types", [])
+    }
+
+def encode_places_cursor(search_key: str, offset: int) -> str:
+    """Opaque cursor for the next page of a nearby-CA search"""
+    payload = json.dumps({"k": search_key, "o": offset}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip("=")
+
+def decode_places_cursor(cursor: str, search_key: str) -> int:
+    """Offset encoded in a cursor, checked against the search it was issued for"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        offset = int(payload["o"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if payload.get("k") != search_key or offset < 0:
+        raise HTTPException(status_code=400, detail="Cursor does not belong to this search; start again without it")
+    return offset
+
+def places_within_radius(places: List[Dict[str, Any]], latitude: float, longitude: float, radius: int) -> List[tuple]:
+    """(place, distance in km) for identifiable places within the radius, in the API's ranking order"""
+    places = [place for place in places if place.get("place_id") and "location" in place.get("geometry", {})]
+    if not places:
+        return []
+    distances = haversine_km(
+        latitude, longitude,
+        np.array([place["geometry"]["location"]["lat"] for place in places], dtype='float64'),
+        np.array([place["geometry"]["location"]["lng"] for place in places], dtype='float64')
+    )
+    return [(place, float(distance)) for place, distance in zip(places, distances) if distance * 1000 <= radius]
+
+def places_fallback_response(latitude: float, longitude: float, radius: int, limit: int,
+                             offset: int, search_key: str, error: str) -> Dict[str, Any]:
+    """Answer from the local CA catalogue when the Places API cannot be used, or report the error"""
+    results = []
+    if CA_CATALOGUE_ENABLED:
+        try:
+            results = local_ca_results(latitude, longitude, radius, offset + limit + 1)
+        except Exception as e:
+            print(f"Warning: Local CA catalogue query failed: {e}")
+    if results:
+        page = results[offset:offset + limit]
+        return {
+            "success": True,
+            "results": page,
+            "count": len(page),
+            "next_cursor": encode_places_cursor(search_key, offset + limit) if len(results) > offset + limit else None,
+            "user_location": {"latitude": latitude, "longitude": longitude},
+            "source": "local_catalogue",
+            "warning": f"{error} - showing previously seen CAs"
+        }
+    return {
+        "success": False,
+        "results": [],
+        "count": 0,
+        "error": error,
+        "user_location": {"latitude": latitude, "longitude": longitude}
+    }
+
+def ndjson_line(data: Dict[str, Any]) -> str:
+    return json.dumps(data) + "\n"
+
 @app.get("/places/nearby-ca")
 async def find_nearby_ca(
     latitude: float = Query(..., description="User's latitude"),
     longitude: float = Query(..., description="User's longitude"),
     radius: int = Query(10000, description="Search radius in meters (default 10km)"),
-    limit: int = Query(10, description="Maximum number of results")
+    limit: int = Query(10, ge=1, le=60, description="Results per page (Places returns at most 60 in all)"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    stream: bool = Query(False, description="Stream results as NDJSON as each one is enriched")
 ):
-    """Find nearby Chartered Accountants using Google Places API"""
+    """
+    Find nearby Chartered Accountants from the local catalogue when it covers the area, otherwise
+    with the Google Places API (falling back to the catalogue if Places fails).
+    
+    Results are paged: pass the returned next_cursor to get the next page. Further Places result
+    pages are only fetched when a cursor reaches them, and details are only looked up for the
+    page being returned. With stream=true the response is NDJSON: one {"type": "result"} line
+    per CA as its details arrive, then a final {"type": "end"} line with next_cursor.
+    """
+    search_key = places_search_key(latitude, longitude, radius)[0]
+    offset = decode_places_cursor(cursor, search_key) if cursor else 0
     try:
-        if not GOOGLE_PLACES_API_KEY:
-            print("Warning: GOOGLE_PLACES_API_KEY not configured")
-            return {
-                "success": False,
-                "results": [],
-                "count": 0,
-                "error": "Google Places API key not configured",
-                "user_location": {"latitude": latitude, "longitude": longitude}
-            }
-        
-        # Use nearbysearch API
-        url = f"{PLACES_API_BASE_URL}/nearbysearch/json"
-        params = {
-            "location": f"{latitude},{longitude}",
-            "radius": radius,
-            "type": "accounting",
-            "keyword": "chartered accountant",
-            "key": GOOGLE_PLACES_API_KEY
-        }
+        # Areas searched recently are answered from the catalogue; details still come from their caches
+        nearby = catalogue_nearby(latitude, longitude, radius, offset, limit, search_key)
+        if nearby is not None:
+            search_cache, source = "catalogue", "local_catalogue"
+        else:
+            if not GOOGLE_PLACES_API_KEY:
+                print("Warning: GOOGLE_PLACES_API_KEY not configured")
+                return places_fallback_response(latitude, longitude, radius, limit, offset, search_key, "Google Places API key not configured")
+            
+            search_key, data, search_cache = await cached_nearby_search(latitude, longitude, radius)
+            source = "places_api"
+            
+            # Handle different API response statuses
+            status = data.get("status")
+            if status == "ZERO_RESULTS":
+                remember_ca_firms([], {}, search_key, complete=True)
+                return {
+                    "success": True,
+                    "results": [],
+                    "count": 0,
+                    "next_cursor": None,
+                    "user_location": {"latitude": latitude, "longitude": longitude},
+                    "source": source
+                }
+            elif status not in ["OK", "ZERO_RESULTS"]:
+                error_msg = places_error_message(status)
+                print(f"Places API error: {error_msg}")
+                return places_fallback_response(latitude, longitude, radius, limit, offset, search_key, error_msg)
+            
+            # The cached search covers the whole cell, so keep the places within the user's radius,
+            # following next_page_token only until this page (plus one, to know if more exist) is filled
+            nearby = places_within_radius(data["results"], latitude, longitude, radius)
+            while len(nearby) <= offset + limit:
+                try:
+                    if not await extend_nearby_search(search_key, data):
+                        break
+                except httpx.HTTPError as e:
+                    print(f"Warning: Could not fetch next results page: {e}")
+                    break
+                nearby = places_within_radius(data["results"], latitude, longitude, radius)
+            # Every firm seen in the area goes into the catalogue; details are added as pages are enriched
+            remember_ca_firms(
+                [place for place, _ in nearby], {}, search_key,
+                complete=not data.get("next_page_token") and not data.get("truncated")
+            )
         
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        page = nearby[offset:offset + limit]
+        next_cursor = encode_places_cursor(search_key, offset + limit) if len(nearby) > offset + limit else None
+        distances = {place["place_id"]: distance for place, distance in page}
+        page_places = [place for place, _ in page]
+        place_ids = [place["place_id"] for place in page_places]
         
-        # Handle different API response statuses
-        status = data.get("status")
-        if status == "ZERO_RESULTS":
-            return {
-                "success": True,
-                "results": [],
-                "count": 0,
-                "user_location": {"latitude": latitude, "longitude": longitude}
-            }
-        elif status not in ["OK", "ZERO_RESULTS"]:
-            error_msg = f"Places API error: {status}"
-            if status == "OVER_QUERY_LIMIT":
-                error_msg += " - API quota exceeded"
-            elif status == "REQUEST_DENIED":
-                error_msg += " - Request denied (check API key permissions)"
-            elif status == "INVALID_REQUEST":
-                error_msg += " - Invalid request parameters"
-            print(f"Places API error: {error_msg}")
-            return {
-                "success": False,
-                "results": [],
-                "count": 0,
-                "error": error_msg,
-                "user_location": {"latitude": latitude, "longitude": longitude}
-            }
+        if stream:
+            async def result_stream():
+                details, details_hits = {}, 0
+                try:
+                    places_by_id = {place["place_id"]: place for place in page_places}
+                    async for place_id, place_details, cached in iter_place_details(place_ids):
+                        details[place_id] = place_details
+                        details_hits += cached
+                        result = build_ca_result(places_by_id[place_id], place_details, latitude, longitude, distances[place_id])
+                        yield ndjson_line({"type": "result", "result": result})
+                    remember_ca_firms(page_places, details)
+                    yield ndjson_line({
+                        "type": "end",
+                        "count": len(page_places),
+                        "next_cursor": next_cursor,
+                        "user_location": {"latitude": latitude, "longitude": longitude},
+                        "source": source,
+                        "cache": {"search": search_cache, "details_hits": details_hits, "details_total": len(details)}
+                    })
+                except Exception as e:
+                    print(f"Error streaming nearby CAs: {e}")
+                    yield ndjson_line({"type": "error", "error": f"Error finding nearby CAs: {str(e)}"})
+            
+            return StreamingResponse(result_stream(), media_type="application/x-ndjson")
         
-        places = data.get("results", [])
+        details, details_hits = await cached_place_details(place_ids)
+        remember_ca_firms(page_places, details)
         
-        # Process and enrich results
         ca_results = []
-        for place in places[:limit]:
+        for place in page_places:
             try:
-                # Validate required fields
-                if "geometry" not in place or "location" not in place["geometry"]:
-                    continue
-                    
-                place_lat = place["geometry"]["location"]["lat"]
-                place_lng = place["geometry"]["location"]["lng"]
-                distance = calculate_distance(latitude, longitude, place_lat, place_lng)
-                
-                # Get place details for phone number and website
-                place_id = place.get("place_id")
-                phone_number = None
-                website = None
-                opening_hours = None
-                
-                if place_id:
-                    try:
-                        details_url = f"{PLACES_API_BASE_URL}/details/json"
-                        details_params = {
-                            "place_id": place_id,
-                            "fields": "formatted_phone_number,website,opening_hours",
-                            "key": GOOGLE_PLACES_API_KEY
-                        }
-                        details_response = requests.get(details_url, params=details_params, timeout=5)
-                        if details_response.status_code == 200:
-                            details_data = details_response.json()
-                            if details_data.get("status") == "OK":
-                                result = details_data.get("result", {})
-                                phone_number = result.get("formatted_phone_number")
-                                website = result.get("website")
-                                opening_hours = result.get("opening_hours")
-                    except Exception as e:
-                        print(f"Warning: Could not fetch place details for {place_id}: {e}")
-                        pass  # Continue without details if fetch fails
-                
-                ca_result = {
-                    "place_id": place_id,
-                    "name": place.get("name", "Unknown"),
-                    "address": place.get("vicinity") or place.get("formatted_address", ""),
-                    "rating": place.get("rating", 0),
-                    "user_ratings_total": place.get("user_ratings_total", 0),
-                    "location": {
-                        "latitude": place_lat,
-                        "longitude": place_lng
-                    },
-                    "distance_km": round(distance, 2),
-                    "phone_number": phone_number,
-                    "website": website,
-                    "is_open": place.get("opening_hours", {}).get("open_now") if place.get("opening_hours") else None,
-                    "types": place.get("types", [])
-                }
-                ca_results.append(ca_result)
+                ca_results.append(build_ca_result(place, details.get(place["place_id"], {}), latitude, longitude, distances[place["place_id"]]))
             except Exception as e:
                 print(f"Warning: Error processing place: {e}")
                 continue  # Skip this place and continue with others
@@ -978,18 +4201,15 @@ async def find_nearby_ca(
             "success": True,
             "results": ca_results,
             "count": len(ca_results),
-            "user_location": {"latitude": latitude, "longitude": longitude}
+            "next_cursor": next_cursor,
+            "user_location": {"latitude": latitude, "longitude": longitude},
+            "source": source,
+            "cache": {"search": search_cache, "details_hits": details_hits, "details_total": len(details)}
         }
         
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Error calling Places API: {e}")
-        return {
-            "success": False,
-            "results": [],
-            "count": 0,
-            "error": f"Error calling Places API: {str(e)}",
-            "user_location": {"latitude": latitude, "longitude": longitude}
-        }
+        return places_fallback_response(latitude, longitude, radius, limit, offset, search_key, f"Error calling Places API: {str(e)}")
     except Exception as e:
         print(f"Error finding nearby CAs: {e}")
         import traceback
@@ -1002,102 +4222,106 @@ async def find_nearby_ca(
             "user_location": {"latitude": latitude, "longitude": longitude}
         }
 
+def financial_year_for(day: date) -> str:
+    """Indian financial year (April-March) containing a date, e.g. 2024-25"""
+    start_year = day.year if day.month >= 4 else day.year - 1
+    return f"{start_year}-{str(start_year + 1)[2:]}"
+
+@lru_cache(maxsize=8)
+def build_system_calendar(financial_year: str) -> tuple:
+    """
+    System tax deadlines for a financial year, built once per year: a tuple of
+    (deadline, due date) sorted by date. Callers must copy the deadline dicts.
+    """
+    fy_start_year = int(financial_year.split("-")[0])
+    fy_end_year = fy_start_year + 1
+    
+    deadlines = [
+        # ITR Filing Deadlines
+        {
+            "title": "ITR Filing Deadline (Individual)",
+            "date": f"{fy_end_year}-07-31",
+            "type": "deadline",
+            "priority": "high",
+            "description": "Last date to file Income Tax Return for individuals",
+            "category": "filing"
+        },
+        {
+            "title": "ITR Filing Deadline (Business)",
+            "date": f"{fy_end_year}-10-31",
+            "type": "deadline",
+            "priority": "high",
+            "description": "Last date to file Income Tax Return for businesses",
+            "category": "filing"
+        },
+        # Advance Tax Deadlines
+        {
+            "title": "Advance Tax - Q1",
+            "date": f"{fy_start_year}-06-15",
+            "type": "deadline",
+            "priority": "medium",
+            "description": "First installment of advance tax (15% of estimated tax)",
+            "category": "advance_tax"
+        },
+        {
+            "title": "Advance Tax - Q2",
+            "date": f"{fy_start_year}-09-15",
+            "type": "deadline",
+            "priority": "medium",
+            "description": "Second installment of advance tax (45% of estimated tax)",
+            "category": "advance_tax"
+        },
+        {
+            "title": "Advance Tax - Q3",
+            "date": f"{fy_start_year}-12-15",
+            "type": "deadline",
+            "priority": "medium",
+            "description": "Third installment of advance tax (75% of estimated tax)",
+            "category": "advance_tax"
+        },
+        {
+            "title": "Advance Tax - Q4",
+            "date": f"{fy_end_year}-03-15",
+            "type": "deadline",
+            "priority": "medium",
+            "description": "Final installment of advance tax (100% of estimated tax)",
+            "category": "advance_tax"
+        },
+        # TDS Certificate Deadline
+        {
+            "title": "TDS Certificate (Form 16) Due Date",
+            "date": f"{fy_end_year}-06-15",
+            "type": "deadline",
+            "priority": "medium",
+            "description": "Employers must issue Form 16 to employees",
+            "category": "tds"
+        }
+    ]
+    
+    calendar = [(deadline, datetime.strptime(deadline["date"], "%Y-%m-%d").date()) for deadline in deadlines]
+    calendar.sort(key=lambda item: item[1])
+    return tuple(calendar)
+
+def with_days_until(deadline: Dict[str, Any], due: date, today: date) -> Dict[str, Any]:
+    """Copy of a deadline with its countdown fields for today"""
+    days_until = (due - today).days
+    return {
+        **deadline,
+        "days_until": days_until,
+        "is_overdue": days_until < 0,
+        "is_upcoming": 0 <= days_until <= 30
+    }
+
 async def _get_tax_deadlines_internal(financial_year: Optional[str] = None):
     """Internal function to get tax deadlines - can be called from endpoints or other functions"""
-    current_year = datetime.now().year
-    current_month = datetime.now().month
+    today = datetime.now().date()
     
     # Determine financial year if not provided
     if not financial_year:
-        if current_month >= 4:  # April onwards
-            financial_year = f"{current_year}-{str(current_year + 1)[2:]}"
-        else:
-            financial_year = f"{current_year - 1}-{str(current_year)[2:]}"
-    
-    # Tax deadlines for India
-    deadlines = []
-    
-    # Calculate dates based on current financial year
-    fy_start_year = int(financial_year.split("-")[0])
-    fy_end_year = fy_start_year + 1
-    
-    # ITR Filing Deadlines
-    deadlines.append({
-        "title": "ITR Filing Deadline (Individual)",
-        "date": f"{fy_end_year}-07-31",
-        "type": "deadline",
-        "priority": "high",
-        "description": "Last date to file Income Tax Return for individuals",
-        "category": "filing"
-    })
-    
-    deadlines.append({
-        "title": "ITR Filing Deadline (Business)",
-        "date": f"{fy_end_year}-10-31",
-        "type": "deadline",
-        "priority": "high",
-        "description": "Last date to file Income Tax Return for businesses",
-        "category": "filing"
-    })
-    
-    # Advance Tax Deadlines
-    deadlines.append({
-        "title": "Advance Tax - Q1",
-        "date": f"{fy_start_year}-06-15",
-        "type": "deadline",
-        "priority": "medium",
-        "description": "First installment of advance tax (15% of estimated tax)",
-        "category": "advance_tax"
-    })
-    
-    deadlines.append({
-        "title": "Advance Tax - Q2",
-        "date": f"{fy_start_year}-09-15",
-        "type": "deadline",
-        "priority": "medium",
-        "description": "Second installment of advance tax (45% of estimated tax)",
-        "category": "advance_tax"
-    })
-    
-    deadlines.append({
-        "title": "Advance Tax - Q3",
-        "date": f"{fy_start_year}-12-15",
-        "type": "deadline",
-        "priority": "medium",
-        "description": "Third installment of advance tax (75% of estimated tax)",
-        "category": "advance_tax"
-    })
+        financial_year = financial_year_for(today)
     
-    deadlines.append({
-        "title": "Advance Tax - Q4",
-        "date": f"{fy_end_year}-03-15",
-        "type": "deadline",
-        "priority": "medium",
-        "description": "Final installment of advance tax (100% of estimated tax)",
-        "category": "advance_tax"
-    })
-    
-    # TDS Certificate Deadline
-    deadlines.append({
-        "title": "TDS Certificate (Form 16) Due Date",
-        "date": f"{fy_end_year}-06-15",
-        "type": "deadline",
-        "priority": "medium",
-        "description": "Employers must issue Form 16 to employees",
-        "category": "tds"
-    })
-        
-    # Calculate days until each deadline
-    today = datetime.now().date()
-    for deadline in deadlines:
-        deadline_date = datetime.strptime(deadline["date"], "%Y-%m-%d").date()
-        days_until = (deadline_date - today).days
-        deadline["days_until"] = days_until
-        deadline["is_overdue"] = days_until < 0
-        deadline["is_upcoming"] = 0 <= days_until <= 30
-    
-    # Sort by date
-    deadlines.sort(key=lambda x: x["date"])
+    # Only the countdown depends on the day; the calendar itself is built once per year
+    deadlines = [with_days_until(deadline, due, today) for deadline, due in build_system_calendar(financial_year)]
     
     return {
         "success": True,
@@ -1125,11 +4349,15 @@ async def add_user_deadline(
     category: Optional[str] = Body("custom")
 ):
     """Add a custom deadline for the user"""
+    try:
+        due = datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date must be in YYYY-MM-DD format")
     try:
         deadline_data = {
             "user_id": user_id,
             "title": title,
-            "date": date,
+            "date": due.replace(tzinfo=timezone.utc),  # Stored as a timestamp so it can be range-queried
             "description": description,
             "category": category,
             "type": "custom",
@@ -1137,26 +4365,123 @@ async def add_user_deadline(
             "is_completed": False
         }
         
-        doc_ref = db.collection('users').document(user_id).collection('deadlines').add(deadline_data)
+        deadline_id = await repo.add(user_path(user_id, 'deadlines'), deadline_data)
+        
+        # Keep today's precomputed nudges in step with the new deadline
+        spawn_background_task(refresh_user_nudges(user_id))
         
         return {
             "success": True,
-            "deadline_id": doc_ref[1].id,
-            "deadline": deadline_data
+            "deadline_id": deadline_id,
+            "deadline": {**deadline_data, "date": date}
         }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error adding deadline: {str(e)}")
 
+def parse_deadline_date(value: Any) -> Optional[date]:
+    """Due date of a stored deadline, whether saved as a "YYYY-MM-DD" string or a timestamp"""
+    if isinstance(value, str):
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return None
+
+def deadline_timestamp(day: date) -> datetime:
+    """Midnight UTC on a day, the form custom deadline dates are stored in"""
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+async def migrate_legacy_deadline_dates(collection_path: str) -> int:
+    """
+    Convert custom deadlines saved with a "YYYY-MM-DD" string date to timestamps. A string range
+    filter only matches string values, so once a user is migrated this is a single empty query.
+    """
+    writes = []
+    for doc_id, data in await repo.query(collection_path, (('date', '>=', ''),)):
+        try:
+            due = datetime.strptime(data["date"], "%Y-%m-%d").date()
+        except (ValueError, KeyError, TypeError):
+            print(f"Warning: Could not parse date for deadline {doc_id}")
+            continue
+        writes.append(("update", f"{collection_path}/{doc_id}", {
+            "date": deadline_timestamp(due),
+            "is_completed": data.get("is_completed", False)
+        }))
+    if writes:
+        await repo.commit(writes)
+    return len(writes)
+
+async def fetch_custom_deadlines(user_id: str, from_date: Optional[date] = None, to_date: Optional[date] = None,
+                                 include_completed: bool = True) -> List[tuple]:
+    """
+    The user's custom deadlines as (deadline, due date), ordered by date. The date range and
+    completion filter run in Firestore (composite index: is_completed + date).
+    """
+    collection_path = user_path(user_id, 'deadlines')
+    await migrate_legacy_deadline_dates(collection_path)
+    
+    filters = []
+    if not include_completed:
+        filters.append(('is_completed', '==', False))
+    if from_date:
+        filters.append(('date', '>=', deadline_timestamp(from_date)))
+    if to_date:
+        filters.append(('date', '<', deadline_timestamp(to_date + timedelta(days=1))))
+    
+    custom_deadlines = []
+    for doc_id, deadline in await repo.query(collection_path, tuple(filters), order_by='date'):
+        try:
+            if not deadline:
+                continue
+            deadline["deadline_id"] = doc_id
+            
+            # Validate and parse date
+            if "date" not in deadline:
+                print(f"Warning: Deadline {doc_id} missing date field")
+                continue
+            due = parse_deadline_date(deadline["date"])
+            if due is None:
+                print(f"Warning: Invalid date format for deadline {doc_id}")
+                continue
+            deadline["date"] = due.isoformat()  # Same form as the system deadlines
+            custom_deadlines.append((deadline, due))
+        except (ValueError, AttributeError) as e:
+            print(f"Warning: Could not parse date for deadline {doc_id}: {e}")
+            continue
+        except Exception as e:
+            print(f"Warning: Error processing custom deadline {doc_id}: {e}")
+            continue
+    return custom_deadlines
+
 @app.get("/calendar/user-deadlines/{user_id}")
-async def get_user_deadlines(user_id: str):
+async def get_user_deadlines(
+    user_id: str,
+    from_date: Optional[date] = Query(None, alias="from", description="Only deadlines on or after this date (YYYY-MM-DD)"),
+    to_date: Optional[date] = Query(None, alias="to", description="Only deadlines on or before this date (YYYY-MM-DD)"),
+    include_completed: bool = Query(True, description="Include custom deadlines marked completed")
+):
     """Get all deadlines (system + custom) for a user"""
+    if from_date and to_date and from_date > to_date:
+        raise HTTPException(status_code=400, detail="'from' must not be after 'to'")
     try:
-        # Get system deadlines
+        today = datetime.now().date()
+        
+        def in_range(due: date) -> bool:
+            return (from_date is None or due >= from_date) and (to_date is None or due <= to_date)
+        
+        # Get system deadlines for every financial year the range touches
         system_deadlines = []
         try:
-            deadlines_response = await _get_tax_deadlines_internal()
-            system_deadlines = deadlines_response.get("deadlines", [])
+            first_fy = financial_year_for(from_date or today)
+            last_fy = financial_year_for(to_date or today)
+            for start_year in range(int(first_fy.split("-")[0]), int(last_fy.split("-")[0]) + 1):
+                financial_year = f"{start_year}-{str(start_year + 1)[2:]}"
+                system_deadlines += [
+                    with_days_until(deadline, due, today)
+                    for deadline, due in build_system_calendar(financial_year) if in_range(due)
+                ]
         except Exception as e:
             print(f"Warning: Could not fetch system deadlines: {e}")
             import traceback
@@ -1165,41 +4490,10 @@ async def get_user_deadlines(user_id: str):
         # Get custom deadlines
         custom_deadlines = []
         try:
-            custom_docs = db.collection('users').document(user_id).collection('deadlines').stream()
-            for doc in custom_docs:
-                try:
-                    deadline = doc.to_dict()
-                    if not deadline:
-                        continue
-                    
-                    deadline["deadline_id"] = doc.id
-                    
-                    # Validate and parse date
-                    if "date" not in deadline:
-                        print(f"Warning: Deadline {doc.id} missing date field")
-                        continue
-                    
-                    try:
-                        # Handle both string and date objects from Firestore
-                        if isinstance(deadline["date"], str):
-                            deadline_date = datetime.strptime(deadline["date"], "%Y-%m-%d").date()
-                        elif hasattr(deadline["date"], "date"):
-                            deadline_date = deadline["date"].date()
-                        else:
-                            print(f"Warning: Invalid date format for deadline {doc.id}")
-                            continue
-                    except (ValueError, AttributeError) as e:
-                        print(f"Warning: Could not parse date for deadline {doc.id}: {e}")
-                        continue
-                    
-                    today = datetime.now().date()
-                    deadline["days_until"] = (deadline_date - today).days
-                    deadline["is_overdue"] = deadline["days_until"] < 0
-                    deadline["is_upcoming"] = 0 <= deadline["days_until"] <= 30
-                    custom_deadlines.append(deadline)
-                except Exception as e:
-                    print(f"Warning: Error processing custom deadline {doc.id}: {e}")
-                    continue
+            custom_deadlines = [
+                with_days_until(deadline, due, today)
+                for deadline, due in await fetch_custom_deadlines(user_id, from_date, to_date, include_completed)
+            ]
         except Exception as e:
             print(f"Warning: Could not fetch custom deadlines: {e}")
             import traceback
@@ -1228,6 +4522,98 @@ async def get_user_deadlines(user_id: str):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error fetching user deadlines: {str(e)}")
 
+ICS_PRODID = "-//Tax Assistant//Deadlines//EN"
+ICS_UID_DOMAIN = "tax-assistant"
+
+def ics_escape(text: str) -> str:
+    """Escape a TEXT value (RFC 5545 section 3.3.11)"""
+    return (text or "").replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def ics_fold(line: str) -> str:
+    """Fold a content line at 75 octets, continuing with a leading space"""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line
+    parts, start = [], 0
+    while start < len(encoded):
+        end = min(start + (75 if start == 0 else 74), len(encoded))
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:  # Don't split a UTF-8 character
+            end -= 1
+        parts.append(encoded[start:end].decode('utf-8'))
+        start = end
+    return "\r\n ".join(parts)
+
+def ics_event(uid: str, due: date, stamp: datetime, title: str, description: str, category: str) -> List[str]:
+    """An all-day VEVENT with a reminder the day before"""
+    return [
+        "BEGIN:VEVENT",
+        f"UID:{uid}@{ICS_UID_DOMAIN}",
+        f"DTSTAMP:{stamp.strftime('%Y%m%dT%H%M%SZ')}",
+        f"DTSTART;VALUE=DATE:{due.strftime('%Y%m%d')}",
+        f"DTEND;VALUE=DATE:{(due + timedelta(days=1)).strftime('%Y%m%d')}",
+        f"SUMMARY:{ics_escape(title)}",
+        f"DESCRIPTION:{ics_escape(description)}",
+        f"CATEGORIES:{ics_escape(category)}",
+        "TRANSP:TRANSPARENT",
+        "BEGIN:VALARM",
+        "ACTION:DISPLAY",
+        f"DESCRIPTION:{ics_escape(title)}",
+        "TRIGGER:-P1D",
+        "END:VALARM",
+        "END:VEVENT"
+    ]
+
+def build_deadlines_ics(custom_deadlines: List[tuple], today: date) -> str:
+    """iCalendar feed of the system deadlines for the previous, current and next financial years
+    plus the user's open custom deadlines"""
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:{ICS_PRODID}",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        "X-WR-CALNAME:Tax Deadlines",
+        "REFRESH-INTERVAL;VALUE=DURATION:PT12H",
+        "X-PUBLISHED-TTL:PT12H"
+    ]
+    for year_offset in (-1, 0, 1):
+        financial_year = financial_year_for(date(today.year + year_offset, today.month, 1))
+        fy_start = datetime(int(financial_year.split("-")[0]), 4, 1)
+        for deadline, due in build_system_calendar(financial_year):
+            uid = f"fy{financial_year}-{deadline['category']}-{due.isoformat()}"
+            lines += ics_event(uid, due, fy_start, deadline["title"], deadline["description"], deadline["category"])
+    
+    for deadline, due in custom_deadlines:
+        if deadline.get("is_completed"):
+            continue
+        created_at = deadline.get("created_at")
+        stamp = created_at.replace(tzinfo=None) if isinstance(created_at, datetime) else datetime(2000, 1, 1)
+        lines += ics_event(f"custom-{deadline['deadline_id']}", due, stamp, deadline.get("title", "Deadline"),
+                           deadline.get("description") or "", deadline.get("category") or "custom")
+    
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(ics_fold(line) for line in lines) + "\r\n"
+
+@app.get("/calendar/{user_id}.ics")
+async def get_deadlines_ics(user_id: str, if_none_match: Optional[str] = Header(None)):
+    """Subscribable iCalendar feed of system and custom deadlines, with ETag revalidation"""
+    try:
+        today = datetime.now().date()
+        custom_deadlines = await fetch_custom_deadlines(user_id, today - timedelta(days=365), None, False)
+        body = build_deadlines_ics(custom_deadlines, today)
+        etag = f'"{hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]}"'
+        headers = {"ETag": etag, "Cache-Control": "private, max-age=3600"}
+        
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        return Response(
+            content=body,
+            media_type="text/calendar; charset=utf-8",
+            headers={**headers, "Content-Disposition": 'inline; filename="tax-deadlines.ics"'}
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error building calendar feed: {str(e)}")
+
 def calculate_tax_summary(documents: List[Dict[str, Any]]) -> Dict[str, Any]:
     """Calculate tax summary from user documents"""
     
@@ -1516,19 +4902,191 @@ async def calculate_tax_regime_comparison(tax_summary: Dict[str, Any], user_docu
             "recommendations": ["Consider maximizing Section 80C investments", "Review HRA claims if applicable"]
         }
 
+# ==================== RENDERED PDF CACHE ====================
+
+def _local_cache_path(path: str) -> str:
+    """Map a cache path to a file under LOCAL_CACHE_DIR"""
+    return os.path.join(LOCAL_CACHE_DIR, *path.split('/'))
+
+def read_cached_artifact(path: str) -> Optional[bytes]:
+    """Read a cached artifact, returning None on a cache miss"""
+    try:
+        if LOCAL_CACHE_DIR:
+            local_path = _local_cache_path(path)
+            if not os.path.exists(local_path):
+                return None
+            with open(local_path, 'rb') as f:
+                return f.read()
+
+        return blob_store.download(f"{CACHE_BLOB_PREFIX}/{path}")
+    except Exception as e:
+        print(f"Warning: Could not read cached artifact {path}: {e}")
+        return None
+
+def write_cached_artifact(path: str, buffer: io.BytesIO, content_type: str):
+    """Write an artifact to the cache from an in-memory buffer"""
+    try:
+        if LOCAL_CACHE_DIR:
+            local_path = _local_cache_path(path)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            # Write to a temp file first so concurrent readers never see a partial file
+            tmp_path = f"{local_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(buffer.getbuffer())
+            os.replace(tmp_path, local_path)
+            return
+
+        # Cached renders, document indexes and chat answers hold user data: never make them public
+        blob_store.upload(f"{CACHE_BLOB_PREFIX}/{path}", buffer, content_type, public=False)
+    except Exception as e:
+        print(f"Warning: Could not write cached artifact {path}: {e}")
+
+def list_cached_artifacts(prefix: str) -> List[str]:
+    """List cache paths that start with a prefix"""
+    try:
+        if LOCAL_CACHE_DIR:
+            local_prefix = _local_cache_path(prefix)
+            directory = os.path.dirname(local_prefix)
+            if not os.path.isdir(directory):
+                return []
+            directory_path = prefix.rsplit('/', 1)[0] if '/' in prefix else ''
+            return [
+                f"{directory_path}/{name}" if directory_path else name
+                for name in os.listdir(directory)
+                if os.path.join(directory, name).startswith(local_prefix) and not name.endswith('.tmp')
+            ]
+
+        blob_prefix = f"{CACHE_BLOB_PREFIX}/"
+        return [name[len(blob_prefix):] for name in blob_store.list(f"{blob_prefix}{prefix}")]
+    except Exception as e:
+        print(f"Warning: Could not list cached artifacts under {prefix}: {e}")
+        return []
+
+def delete_cached_artifact(path: str):
+    """Delete a cached artifact if it exists"""
+    try:
+        if LOCAL_CACHE_DIR:
+            local_path = _local_cache_path(path)
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            return
+
+        blob_store.delete(f"{CACHE_BLOB_PREFIX}/{path}")
+    except Exception as e:
+        print(f"Warning: Could not delete cached artifact {path}: {e}")
+
+def prune_cached_artifacts(prefix: str, keep_path: str):
+    """Delete cached artifacts under a prefix, except the one just written"""
+    for path in list_cached_artifacts(prefix):
+        if path != keep_path:
+            delete_cached_artifact(path)
+
+def compute_pdf_cache_key(kind: str, payload: Any) -> str:
+    """Hash the inputs of a PDF report together with the template version"""
+    canonical = json.dumps(convert_firestore_datetime_to_iso(payload), sort_keys=True, default=str)
+    return hashlib.sha256(f"{kind}:{PDF_TEMPLATE_VERSION}:{canonical}".encode('utf-8')).hexdigest()
+
+def store_rendered_pdf(user_id: str, kind: str, cache_key: str, buffer: io.BytesIO):
+    """Cache a freshly rendered PDF and drop renders of older inputs"""
+    cache_path = f"pdf/{user_id}/{kind}_{cache_key}.pdf"
+    write_cached_artifact(cache_path, buffer, "application/pdf")
+    prune_cached_artifacts(f"pdf/{user_id}/{kind}_", cache_path)
+
+def _pdf_headers(filename: str, cache_key: str, cache_status: str) -> Dict[str, str]:
+    """Headers for a PDF download tagged with its content hash"""
+    return {
+        "Content-Disposition": f"attachment; filename={filename}",
+        "ETag": f'"{cache_key}"',
+        "X-Cache": cache_status
+    }
+
+async def cached_pdf_response(user_id: str, kind: str, cache_key: str, filename: str) -> Optional[Response]:
+    """Return the cached render for these inputs, or None on a cache miss"""
+    cache_path = f"pdf/{user_id}/{kind}_{cache_key}.pdf"
+    headers = _pdf_headers(filename, cache_key, "HIT")
+    
+    local_path = _local_cache_path(cache_path) if LOCAL_CACHE_DIR else blob_store.local_path(f"{CACHE_BLOB_PREFIX}/{cache_path}")
+    if local_path:
+        # Let the server send the file directly instead of reading it into memory
+        if os.path.exists(local_path):
+            return FileResponse(local_path, media_type="application/pdf", headers=headers)
+        return None
+    
+    try:
+        cached_file = await asyncio.to_thread(blob_store.open, f"{CACHE_BLOB_PREFIX}/{cache_path}")
+    except Exception as e:
+        print(f"Warning: Could not read cached artifact {cache_path}: {e}")
+        return None
+    if cached_file is None:
+        return None
+    return StreamingResponse(_iter_pdf_file(cached_file), media_type="application/pdf", headers=headers)
+
+_pdf_render_executor: Optional[ThreadPoolExecutor] = None
+
+def get_pdf_render_executor() -> ThreadPoolExecutor:
+    """The thread pool PDFs are rendered in, kept apart from the default pool used for I/O"""
+    global _pdf_render_executor
+    if _pdf_render_executor is None:
+        _pdf_render_executor = ThreadPoolExecutor(
+            max_workers=PDF_RENDER_WORKERS,
+            thread_name_prefix="pdf-render"
+        )
+    return _pdf_render_executor
+
+async def render_pdf(render, *args) -> io.BytesIO:
+    """Run a render_*_pdf function in the PDF render pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pdf_render_executor(), render, *args)
+
+def _iter_pdf_file(f):
+    """Yield a cached PDF in chunks from an open blob, closing it at the end"""
+    try:
+        for chunk in iter(lambda: f.read(PDF_STREAM_CHUNK_SIZE), b""):
+            yield chunk
+    finally:
+        f.close()
+
+def _iter_pdf_buffer(buffer: io.BytesIO):
+    """Yield a rendered PDF in chunks straight from the buffer's memory"""
+    view = buffer.getbuffer()
+    try:
+        for offset in range(0, len(view), PDF_STREAM_CHUNK_SIZE):
+            yield view[offset:offset + PDF_STREAM_CHUNK_SIZE]
+    finally:
+        view.release()
+
+def streamed_pdf_response(buffer: io.BytesIO, user_id: str, kind: str, cache_key: str, filename: str) -> StreamingResponse:
+    """Stream a fresh render to the client, then store it in the render cache"""
+    headers = _pdf_headers(filename, cache_key, "MISS")
+    headers["Content-Length"] = str(buffer.seek(0, io.SEEK_END))
+    return StreamingResponse(
+        _iter_pdf_buffer(buffer),
+        media_type="application/pdf",
+        headers=headers,
+        background=BackgroundTask(store_rendered_pdf, user_id, kind, cache_key, buffer)
+    )
+
+def pdf_not_modified(if_none_match: Optional[str], cache_key: str) -> bool:
+    """Check whether the client already holds the PDF for these inputs"""
+    return bool(if_none_match) and f'"{cache_key}"' in if_none_match
+
+async def fetch_user_documents(user_id: str) -> List[Dict[str, Any]]:
+    """Fetch all documents for a user with their IDs"""
+    return [{**doc_data, 'id': doc_id} for doc_id, doc_data in await repo.query(user_path(user_id, 'documents'))]
+
+async def fetch_user_profile(user_id: str) -> Optional[Dict[str, Any]]:
+    """Fetch the user's profile document if it exists"""
+    try:
+        return await repo.get(user_path(user_id))
+    except Exception:
+        return None
+
 @app.get("/tax-summary/{user_id}")
 async def get_tax_summary(user_id: str):
     """Get comprehensive tax summary and insights for a user"""
     try:
         # Get all user documents
-        docs_query = db.collection('users').document(user_id).collection('documents')
-        docs = docs_query.stream()
-        
-        documents = []
-        for doc in docs:
-            doc_data = doc.to_dict()
-            doc_data['id'] = doc.id
-            documents.append(doc_data)
+        documents = await fetch_user_documents(user_id)
         
         if not documents:
             return {
@@ -1554,181 +5112,126 @@ async def get_tax_summary(user_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error calculating tax summary: {str(e)}")
 
+def render_tax_summary_pdf(tax_summary: Dict[str, Any], regime_comparison: Optional[Dict[str, Any]]) -> io.BytesIO:
+    """Render the tax summary report into an in-memory PDF buffer (runs in the PDF render pool)"""
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    
+    # Build PDF content
+    story = []
+    
+    # Title
+    story.append(Paragraph("Tax Summary & Insights", PDF_SUMMARY_TITLE_STYLE))
+    story.append(Spacer(1, 0.2*inch))
+    
+    # Income Summary
+    story.append(Paragraph("Income Summary", PDF_SUMMARY_HEADING_STYLE))
+    income_data = [
+        ['Total Salary', f"₹{tax_summary['income']['total_salary']:,.2f}"],
+        ['Employer', tax_summary['income']['employer_name'] or 'N/A'],
+        ['PAN', tax_summary['income']['pan'] or 'N/A'],
+        ['Other Income', f"₹{tax_summary['income']['other_income']:,.2f}"],
+    ]
+    income_table = Table(income_data, colWidths=[3*inch, 3*inch])
+    income_table.setStyle(PDF_SUMMARY_TABLE_STYLE)
+    story.append(income_table)
+    story.append(Spacer(1, 0.3*inch))
+    
+    # TDS & Tax Paid
+    story.append(Paragraph("TDS & Tax Paid", PDF_SUMMARY_HEADING_STYLE))
+    tds_data = [
+        ['TDS Deducted', f"₹{tax_summary['tds']['tds_deducted']:,.2f}"],
+        ['Advance Tax', f"₹{tax_summary['tds']['advance_tax']:,.2f}"],
+    ]
+    tds_table = Table(tds_data, colWidths=[3*inch, 3*inch])
+    tds_table.setStyle(PDF_SUMMARY_TABLE_STYLE)
+    story.append(tds_table)
+    story.append(Spacer(1, 0.3*inch))
+    
+    # Deductions
+    story.append(Paragraph("Deductions Detected", PDF_SUMMARY_HEADING_STYLE))
+    deductions_data = [
+        ['Section 80C', f"₹{tax_summary['deductions']['section_80c']['total']:,.2f}"],
+        ['Section 80D', f"₹{tax_summary['deductions']['section_80d']['total']:,.2f}"],
+        ['HRA', f"₹{tax_summary['deductions']['hra']['total']:,.2f}"],
+        ['NPS', f"₹{tax_summary['deductions']['nps']['total']:,.2f}"],
+        ['Home Loan Interest', f"₹{tax_summary['deductions']['home_loan_interest']:,.2f}"],
+    ]
+    deductions_table = Table(deductions_data, colWidths=[3*inch, 3*inch])
+    deductions_table.setStyle(PDF_SUMMARY_TABLE_STYLE)
+    story.append(deductions_table)
+    story.append(Spacer(1, 0.3*inch))
+    
+    # Tax Estimate
+    story.append(Paragraph("Tax Estimate", PDF_SUMMARY_HEADING_STYLE))
+    tax_data = [
+        ['Taxable Income', f"₹{tax_summary['tax_estimate']['taxable_income']:,.2f}"],
+        ['Total Tax', f"₹{tax_summary['tax_estimate']['total_tax']:,.2f}"],
+        ['Net Payable', f"₹{tax_summary['tax_estimate']['net_payable']:,.2f}"],
+        ['Net Refundable', f"₹{tax_summary['tax_estimate']['net_refundable']:,.2f}"],
+    ]
+    tax_table = Table(tax_data, colWidths=[3*inch, 3*inch])
+    tax_table.setStyle(PDF_SUMMARY_TABLE_STYLE)
+    story.append(tax_table)
+    
+    # Regime Comparison
+    if regime_comparison:
+        story.append(PageBreak())
+        story.append(Paragraph("Old vs New Tax Regime Comparison", PDF_SUMMARY_HEADING_STYLE))
+        
+        regime_data = [
+            ['', 'Old Regime', 'New Regime'],
+            ['Taxable Income', 
+             f"₹{regime_comparison.get('old_regime', {}).get('taxable_income', 0):,.2f}",
+             f"₹{regime_comparison.get('new_regime', {}).get('taxable_income', 0):,.2f}"],
+            ['Total Tax',
+             f"₹{regime_comparison.get('old_regime', {}).get('total_tax', 0):,.2f}",
+             f"₹{regime_comparison.get('new_regime', {}).get('total_tax', 0):,.2f}"],
+            ['Effective Rate',
+             f"{regime_comparison.get('old_regime', {}).get('effective_rate', 0):.2f}%",
+             f"{regime_comparison.get('new_regime', {}).get('effective_rate', 0):.2f}%"],
+        ]
+        
+        regime_table = Table(regime_data, colWidths=[2*inch, 2*inch, 2*inch])
+        regime_table.setStyle(PDF_REGIME_TABLE_STYLE)
+        story.append(regime_table)
+        story.append(Spacer(1, 0.2*inch))
+        
+        # Recommendations
+        if regime_comparison.get('explanation'):
+            story.append(Paragraph("Recommendation", PDF_SUMMARY_HEADING_STYLE))
+            story.append(Paragraph(regime_comparison['explanation'], PDF_STYLES['Normal']))
+    
+    # Build PDF
+    doc.build(story)
+    return buffer
+
 @app.get("/tax-summary/{user_id}/pdf")
-async def get_tax_summary_pdf(user_id: str):
-    """Generate and return PDF of tax summary"""
+async def get_tax_summary_pdf(user_id: str, if_none_match: Optional[str] = Header(None)):
+    """Generate and return PDF of tax summary, served from the render cache when inputs are unchanged"""
     try:
-        # Get tax summary
-        summary_response = await get_tax_summary(user_id)
+        documents = await fetch_user_documents(user_id)
         
-        if not summary_response['success'] or not summary_response.get('summary'):
+        if not documents:
             raise HTTPException(status_code=404, detail="Tax summary not available")
         
-        tax_summary = summary_response['summary']
-        regime_comparison = summary_response.get('regime_comparison', {})
-        
-        # Create PDF in memory
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        styles = getSampleStyleSheet()
-        
-        # Custom styles
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=24,
-            textColor=colors.HexColor('#FF6D4D'),
-            spaceAfter=30,
-        )
-        
-        heading_style = ParagraphStyle(
-            'CustomHeading',
-            parent=styles['Heading2'],
-            fontSize=16,
-            textColor=colors.HexColor('#D5451B'),
-            spaceAfter=12,
-        )
-        
-        # Build PDF content
-        story = []
+        # Serve repeat downloads without recomputing the summary or re-rendering
+        cache_key = compute_pdf_cache_key("tax_summary", documents)
+        filename = f"tax_summary_{user_id}.pdf"
+        if pdf_not_modified(if_none_match, cache_key):
+            return Response(status_code=304, headers={"ETag": f'"{cache_key}"'})
         
-        # Title
-        story.append(Paragraph("Tax Summary & Insights", title_style))
-        story.append(Spacer(1, 0.2*inch))
+        cached_response = await cached_pdf_response(user_id, "tax_summary", cache_key, filename)
+        if cached_response is not None:
+            return cached_response
         
-        # Income Summary
-        story.append(Paragraph("Income Summary", heading_style))
-        income_data = [
-            ['Total Salary', f"₹{tax_summary['income']['total_salary']:,.2f}"],
-            ['Employer', tax_summary['income']['employer_name'] or 'N/A'],
-            ['PAN', tax_summary['income']['pan'] or 'N/A'],
-            ['Other Income', f"₹{tax_summary['income']['other_income']:,.2f}"],
-        ]
-        income_table = Table(income_data, colWidths=[3*inch, 3*inch])
-        income_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#FDF6EB')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ]))
-        story.append(income_table)
-        story.append(Spacer(1, 0.3*inch))
-        
-        # TDS & Tax Paid
-        story.append(Paragraph("TDS & Tax Paid", heading_style))
-        tds_data = [
-            ['TDS Deducted', f"₹{tax_summary['tds']['tds_deducted']:,.2f}"],
-            ['Advance Tax', f"₹{tax_summary['tds']['advance_tax']:,.2f}"],
-        ]
-        tds_table = Table(tds_data, colWidths=[3*inch, 3*inch])
-        tds_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#FDF6EB')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ]))
-        story.append(tds_table)
-        story.append(Spacer(1, 0.3*inch))
-        
-        # Deductions
-        story.append(Paragraph("Deductions Detected", heading_style))
-        deductions_data = [
-            ['Section 80C', f"₹{tax_summary['deductions']['section_80c']['total']:,.2f}"],
-            ['Section 80D', f"₹{tax_summary['deductions']['section_80d']['total']:,.2f}"],
-            ['HRA', f"₹{tax_summary['deductions']['hra']['total']:,.2f}"],
-            ['NPS', f"₹{tax_summary['deductions']['nps']['total']:,.2f}"],
-            ['Home Loan Interest', f"₹{tax_summary['deductions']['home_loan_interest']:,.2f}"],
-        ]
-        deductions_table = Table(deductions_data, colWidths=[3*inch, 3*inch])
-        deductions_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#FDF6EB')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ]))
-        story.append(deductions_table)
-        story.append(Spacer(1, 0.3*inch))
-        
-        # Tax Estimate
-        story.append(Paragraph("Tax Estimate", heading_style))
-        tax_data = [
-            ['Taxable Income', f"₹{tax_summary['tax_estimate']['taxable_income']:,.2f}"],
-            ['Total Tax', f"₹{tax_summary['tax_estimate']['total_tax']:,.2f}"],
-            ['Net Payable', f"₹{tax_summary['tax_estimate']['net_payable']:,.2f}"],
-            ['Net Refundable', f"₹{tax_summary['tax_estimate']['net_refundable']:,.2f}"],
-        ]
-        tax_table = Table(tax_data, colWidths=[3*inch, 3*inch])
-        tax_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#FDF6EB')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ]))
-        story.append(tax_table)
-        
-        # Regime Comparison
-        if regime_comparison:
-            story.append(PageBreak())
-            story.append(Paragraph("Old vs New Tax Regime Comparison", heading_style))
-            
-            regime_data = [
-                ['', 'Old Regime', 'New Regime'],
-                ['Taxable Income', 
-                 f"₹{regime_comparison.get('old_regime', {}).get('taxable_income', 0):,.2f}",
-                 f"₹{regime_comparison.get('new_regime', {}).get('taxable_income', 0):,.2f}"],
-                ['Total Tax',
-                 f"₹{regime_comparison.get('old_regime', {}).get('total_tax', 0):,.2f}",
-                 f"₹{regime_comparison.get('new_regime', {}).get('total_tax', 0):,.2f}"],
-                ['Effective Rate',
-                 f"{regime_comparison.get('old_regime', {}).get('effective_rate', 0):.2f}%",
-                 f"{regime_comparison.get('new_regime', {}).get('effective_rate', 0):.2f}%"],
-            ]
-            
-            regime_table = Table(regime_data, colWidths=[2*inch, 2*inch, 2*inch])
-            regime_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#FF6D4D')),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 12),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor('#FDF6EB')),
-                ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-                ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-                ('FONTSIZE', (0, 1), (-1, -1), 10),
-                ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-            ]))
-            story.append(regime_table)
-            story.append(Spacer(1, 0.2*inch))
-            
-            # Recommendations
-            if regime_comparison.get('explanation'):
-                story.append(Paragraph("Recommendation", heading_style))
-                story.append(Paragraph(regime_comparison['explanation'], styles['Normal']))
+        tax_summary = calculate_tax_summary(documents)
+        regime_comparison = await calculate_tax_regime_comparison(tax_summary, documents)
         
-        # Build PDF
-        doc.build(story)
-        buffer.seek(0)
+        # Render off the event loop
+        buffer = await render_pdf(render_tax_summary_pdf, tax_summary, regime_comparison)
         
-        # Return PDF as response
-        from fastapi.responses import Response
-        return Response(
-            content=buffer.getvalue(),
-            media_type="application/pdf",
-            headers={"Content-Disposition": f"attachment; filename=tax_summary_{user_id}.pdf"}
-        )
+        return streamed_pdf_response(buffer, user_id, "tax_summary", cache_key, filename)
         
     except HTTPException:
         raise
@@ -2124,23 +5627,10 @@ async def get_auto_file_analysis(user_id: str):
     """Get comprehensive auto-filing analysis"""
     try:
         # Get all user documents
-        docs_query = db.collection('users').document(user_id).collection('documents')
-        docs = docs_query.stream()
-        
-        documents = []
-        for doc in docs:
-            doc_data = doc.to_dict()
-            doc_data['id'] = doc.id
-            documents.append(doc_data)
+        documents = await fetch_user_documents(user_id)
         
         # Get user profile if available
-        user_profile = None
-        try:
-            profile_doc = db.collection('users').document(user_id).get()
-            if profile_doc.exists:
-                user_profile = profile_doc.to_dict()
-        except:
-            pass
+        user_profile = await fetch_user_profile(user_id)
         
         # Perform analysis
         gap_analysis = analyze_document_gaps(documents)
@@ -2168,22 +5658,9 @@ async def get_auto_file_analysis(user_id: str):
 async def get_itr_draft(user_id: str):
     """Get ITR draft JSON"""
     try:
-        docs_query = db.collection('users').document(user_id).collection('documents')
-        docs = docs_query.stream()
-        
-        documents = []
-        for doc in docs:
-            doc_data = doc.to_dict()
-            doc_data['id'] = doc.id
-            documents.append(doc_data)
+        documents = await fetch_user_documents(user_id)
         
-        user_profile = None
-        try:
-            profile_doc = db.collection('users').document(user_id).get()
-            if profile_doc.exists:
-                user_profile = profile_doc.to_dict()
-        except:
-            pass
+        user_profile = await fetch_user_profile(user_id)
         
         itr_draft = generate_itr_draft(documents, user_profile)
         
@@ -2195,116 +5672,84 @@ async def get_itr_draft(user_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating ITR draft: {str(e)}")
 
+def render_itr_preview_pdf(itr_draft: Dict[str, Any]) -> io.BytesIO:
+    """Render the ITR draft preview into an in-memory PDF buffer (runs in the PDF render pool)"""
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    
+    story = []
+    
+    # Title
+    story.append(Paragraph("ITR Draft Preview", PDF_ITR_TITLE_STYLE))
+    story.append(Paragraph(f"Financial Year: {itr_draft['financial_year']}", PDF_STYLES['Normal']))
+    story.append(Spacer(1, 0.2*inch))
+    
+    # Personal Info
+    story.append(Paragraph("Personal Information", PDF_ITR_HEADING_STYLE))
+    personal_data = [
+        ['Name', itr_draft['personal_info']['name'] or 'N/A'],
+        ['PAN', itr_draft['personal_info']['pan'] or 'N/A'],
+        ['Email', itr_draft['personal_info']['email'] or 'N/A'],
+    ]
+    personal_table = Table(personal_data, colWidths=[3*inch, 3*inch])
+    personal_table.setStyle(PDF_ITR_TABLE_STYLE)
+    story.append(personal_table)
+    story.append(Spacer(1, 0.3*inch))
+    
+    # Income Details
+    story.append(Paragraph("Income Details", PDF_ITR_HEADING_STYLE))
+    income_data = [
+        ['Gross Salary', f"₹{itr_draft['income_details']['salary_income']['gross_salary']:,.2f}"],
+        ['Other Income', f"₹{itr_draft['income_details']['other_income']['interest_income'] + itr_draft['income_details']['other_income']['capital_gains']:,.2f}"],
+        ['Gross Total Income', f"₹{itr_draft['tax_computation']['gross_total_income']:,.2f}"],
+    ]
+    income_table = Table(income_data, colWidths=[3*inch, 3*inch])
+    income_table.setStyle(PDF_ITR_TABLE_STYLE)
+    story.append(income_table)
+    story.append(Spacer(1, 0.3*inch))
+    
+    # Tax Computation
+    story.append(Paragraph("Tax Computation", PDF_ITR_HEADING_STYLE))
+    tax_data = [
+        ['Taxable Income', f"₹{itr_draft['tax_computation']['taxable_income']:,.2f}"],
+        ['Tax on Total Income', f"₹{itr_draft['tax_computation']['tax_on_total_income']:,.2f}"],
+        ['TDS', f"₹{itr_draft['tax_computation']['tds']:,.2f}"],
+        ['Net Tax Payable', f"₹{itr_draft['tax_computation']['net_tax_payable']:,.2f}"],
+        ['Refund', f"₹{itr_draft['tax_computation']['refund']:,.2f}"],
+    ]
+    tax_table = Table(tax_data, colWidths=[3*inch, 3*inch])
+    tax_table.setStyle(PDF_ITR_TABLE_STYLE)
+    story.append(tax_table)
+    
+    story.append(Spacer(1, 0.3*inch))
+    story.append(Paragraph("Note: This is a draft preview. Please verify all details before filing.", 
+                          PDF_STYLES['Normal']))
+    
+    doc.build(story)
+    return buffer
+
 @app.get("/auto-file/{user_id}/itr-preview-pdf")
-async def get_itr_preview_pdf(user_id: str):
-    """Generate ITR preview PDF"""
-    try:
-        # Get ITR draft
-        draft_response = await get_itr_draft(user_id)
-        if not draft_response['success']:
-            raise HTTPException(status_code=404, detail="ITR draft not available")
-        
-        itr_draft = draft_response['itr_draft']
-        
-        # Create PDF
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        styles = getSampleStyleSheet()
-        
-        title_style = ParagraphStyle(
-            'ITRTitle',
-            parent=styles['Heading1'],
-            fontSize=20,
-            textColor=colors.HexColor('#FF6D4D'),
-            spaceAfter=20,
-        )
+async def get_itr_preview_pdf(user_id: str, if_none_match: Optional[str] = Header(None)):
+    """Generate ITR preview PDF, served from the render cache when inputs are unchanged"""
+    try:
+        documents, user_profile = await asyncio.gather(fetch_user_documents(user_id), fetch_user_profile(user_id))
         
-        heading_style = ParagraphStyle(
-            'ITRHeading',
-            parent=styles['Heading2'],
-            fontSize=14,
-            textColor=colors.HexColor('#D5451B'),
-            spaceAfter=10,
-        )
+        # The draft is derived entirely from documents and profile, so hash those
+        cache_key = compute_pdf_cache_key("itr_preview", {"documents": documents, "profile": user_profile})
+        filename = f"itr_draft_{user_id}.pdf"
+        if pdf_not_modified(if_none_match, cache_key):
+            return Response(status_code=304, headers={"ETag": f'"{cache_key}"'})
         
-        story = []
+        cached_response = await cached_pdf_response(user_id, "itr_preview", cache_key, filename)
+        if cached_response is not None:
+            return cached_response
         
-        # Title
-        story.append(Paragraph("ITR Draft Preview", title_style))
-        story.append(Paragraph(f"Financial Year: {itr_draft['financial_year']}", styles['Normal']))
-        story.append(Spacer(1, 0.2*inch))
+        itr_draft = generate_itr_draft(documents, user_profile)
         
-        # Personal Info
-        story.append(Paragraph("Personal Information", heading_style))
-        personal_data = [
-            ['Name', itr_draft['personal_info']['name'] or 'N/A'],
-            ['PAN', itr_draft['personal_info']['pan'] or 'N/A'],
-            ['Email', itr_draft['personal_info']['email'] or 'N/A'],
-        ]
-        personal_table = Table(personal_data, colWidths=[3*inch, 3*inch])
-        personal_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#FDF6EB')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ]))
-        story.append(personal_table)
-        story.append(Spacer(1, 0.3*inch))
-        
-        # Income Details
-        story.append(Paragraph("Income Details", heading_style))
-        income_data = [
-            ['Gross Salary', f"₹{itr_draft['income_details']['salary_income']['gross_salary']:,.2f}"],
-            ['Other Income', f"₹{itr_draft['income_details']['other_income']['interest_income'] + itr_draft['income_details']['other_income']['capital_gains']:,.2f}"],
-            ['Gross Total Income', f"₹{itr_draft['tax_computation']['gross_total_income']:,.2f}"],
-        ]
-        income_table = Table(income_data, colWidths=[3*inch, 3*inch])
-        income_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#FDF6EB')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ]))
-        story.append(income_table)
-        story.append(Spacer(1, 0.3*inch))
-        
-        # Tax Computation
-        story.append(Paragraph("Tax Computation", heading_style))
-        tax_data = [
-            ['Taxable Income', f"₹{itr_draft['tax_computation']['taxable_income']:,.2f}"],
-            ['Tax on Total Income', f"₹{itr_draft['tax_computation']['tax_on_total_income']:,.2f}"],
-            ['TDS', f"₹{itr_draft['tax_computation']['tds']:,.2f}"],
-            ['Net Tax Payable', f"₹{itr_draft['tax_computation']['net_tax_payable']:,.2f}"],
-            ['Refund', f"₹{itr_draft['tax_computation']['refund']:,.2f}"],
-        ]
-        tax_table = Table(tax_data, colWidths=[3*inch, 3*inch])
-        tax_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#FDF6EB')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ]))
-        story.append(tax_table)
-        
-        story.append(Spacer(1, 0.3*inch))
-        story.append(Paragraph("Note: This is a draft preview. Please verify all details before filing.", 
-                              styles['Normal']))
-        
-        doc.build(story)
-        buffer.seek(0)
-        
-        from fastapi.responses import Response
-        return Response(
-            content=buffer.getvalue(),
-            media_type="application/pdf",
-            headers={"Content-Disposition": f"attachment; filename=itr_draft_{user_id}.pdf"}
-        )
+        # Render off the event loop
+        buffer = await render_pdf(render_itr_preview_pdf, itr_draft)
+        
+        return streamed_pdf_response(buffer, user_id, "itr_preview", cache_key, filename)
         
     except HTTPException:
         raise
@@ -2314,8 +5759,10 @@ async def get_itr_preview_pdf(user_id: str):
 # ==================== REAL-TIME TAX INSIGHTS FEED ====================
 
 def generate_tax_insights(documents: List[Dict[str, Any]], tax_summary: Dict[str, Any], 
-                          consistencies: Dict[str, Any]) -> List[Dict[str, Any]]:
-    """Generate real-time tax insights from documents and analysis"""
+                          consistencies: Dict[str, Any],
+                          deadline_nudges: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """Generate real-time tax insights from documents and analysis. Pass the user's precomputed
+    deadline nudges when available; otherwise the system deadline nudges are computed here."""
     
     insights = []
     
@@ -2328,7 +5775,7 @@ def generate_tax_insights(documents: List[Dict[str, Any]], tax_summary: Dict[str
     insights.extend(risks)
     
     # Deadline Insights
-    deadlines = get_upcoming_deadlines()
+    deadlines = deadline_nudges if deadline_nudges is not None else get_upcoming_deadlines()
     insights.extend(deadlines)
     
     # Optimization Insights
@@ -2492,24 +5939,23 @@ def get_upcoming_deadlines() -> List[Dict[str, Any]]:
     
     deadlines = []
     today = datetime.utcnow()
-    current_year = today.year
-    
-    # Advance Tax Deadlines (FY 2023-24)
-    advance_tax_dates = [
-        (datetime(current_year, 6, 15), "Q1 Advance Tax"),
-        (datetime(current_year, 9, 15), "Q2 Advance Tax"),
-        (datetime(current_year, 12, 15), "Q3 Advance Tax"),
-        (datetime(current_year + 1, 3, 15), "Q4 Advance Tax"),
-    ]
     
-    for deadline_date, description in advance_tax_dates:
+    # The previous year's ITR deadline falls in the current year, so look at both calendars
+    current_fy = financial_year_for(today.date())
+    previous_fy = financial_year_for(date(today.year - 1, today.month, 1))
+    calendar = build_system_calendar(previous_fy) + build_system_calendar(current_fy)
+    
+    for deadline, due in calendar:
+        deadline_date = datetime.combine(due, datetime.min.time())
         days_until = (deadline_date - today).days
-        if 0 <= days_until <= 7:  # Within 7 days
+        
+        if deadline["category"] == "advance_tax" and 0 <= days_until <= 7:  # Within 7 days
             priority = "critical" if days_until <= 3 else "high"
+            quarter = deadline["title"].rsplit(" ", 1)[-1]
             deadlines.append({
                 "type": "deadline",
                 "category": "advance_tax",
-                "title": f"{description} Due",
+                "title": f"{quarter} Advance Tax Due",
                 "message": f"Quarterly Advance Tax due in {days_until} day{'s' if days_until != 1 else ''}.",
                 "priority": priority,
                 "action": f"Pay advance tax before {deadline_date.strftime('%B %d, %Y')}",
@@ -2517,23 +5963,20 @@ def get_upcoming_deadlines() -> List[Dict[str, Any]]:
                 "days_remaining": days_until,
                 "timestamp": datetime.utcnow().isoformat()
             })
-    
-    # ITR Filing Deadline (July 31)
-    itr_deadline = datetime(current_year + 1, 7, 31)
-    days_until_itr = (itr_deadline - today).days
-    if 0 <= days_until_itr <= 30:
-        priority = "critical" if days_until_itr <= 7 else "high"
-        deadlines.append({
-            "type": "deadline",
-            "category": "itr_filing",
-            "title": "ITR Filing Deadline",
-            "message": f"ITR filing deadline in {days_until_itr} day{'s' if days_until_itr != 1 else ''}.",
-            "priority": priority,
-            "action": "File your ITR before July 31 to avoid penalty",
-            "deadline_date": itr_deadline.isoformat(),
-            "days_remaining": days_until_itr,
-            "timestamp": datetime.utcnow().isoformat()
-        })
+        
+        elif deadline["title"] == "ITR Filing Deadline (Individual)" and 0 <= days_until <= 30:
+            priority = "critical" if days_until <= 7 else "high"
+            deadlines.append({
+                "type": "deadline",
+                "category": "itr_filing",
+                "title": "ITR Filing Deadline",
+                "message": f"ITR filing deadline in {days_until} day{'s' if days_until != 1 else ''}.",
+                "priority": priority,
+                "action": f"File your ITR before {deadline_date.strftime('%B %d')} to avoid penalty",
+                "deadline_date": deadline_date.isoformat(),
+                "days_remaining": days_until,
+                "timestamp": datetime.utcnow().isoformat()
+            })
     
     return deadlines
 
@@ -2728,14 +6171,7 @@ async def get_tax_insights(user_id: str):
     """Get real-time tax insights feed"""
     try:
         # Get all user documents
-        docs_query = db.collection('users').document(user_id).collection('documents')
-        docs = docs_query.stream()
-        
-        documents = []
-        for doc in docs:
-            doc_data = doc.to_dict()
-            doc_data['id'] = doc.id
-            documents.append(doc_data)
+        documents = await fetch_user_documents(user_id)
         
         if not documents:
             return {
@@ -2753,8 +6189,9 @@ async def get_tax_insights(user_id: str):
         # Analyze gaps
         gap_analysis = analyze_document_gaps(documents)
         
-        # Generate insights
-        insights = generate_tax_insights(documents, tax_summary, consistencies)
+        # Generate insights, using the nudges precomputed by today's deadline sweep when there are some
+        deadline_nudges = await load_pending_nudges(user_id)
+        insights = generate_tax_insights(documents, tax_summary, consistencies, deadline_nudges)
         
         # Calculate tax health score
         health_score = calculate_tax_health_score(documents, tax_summary, consistencies, gap_analysis)
@@ -2774,14 +6211,7 @@ async def get_tax_insights(user_id: str):
 async def get_health_score(user_id: str):
     """Get current tax health score"""
     try:
-        docs_query = db.collection('users').document(user_id).collection('documents')
-        docs = docs_query.stream()
-        
-        documents = []
-        for doc in docs:
-            doc_data = doc.to_dict()
-            doc_data['id'] = doc.id
-            documents.append(doc_data)
+        documents = await fetch_user_documents(user_id)
         
         if not documents:
             return {
@@ -2803,13 +6233,9 @@ async def get_health_score(user_id: str):
         
         # Get previous month's score for comparison
         try:
-            health_history = db.collection('users').document(user_id).collection('health_scores')
             prev_month = (datetime.utcnow() - timedelta(days=30)).strftime("%Y-%m")
-            prev_docs = health_history.where('month', '==', prev_month).limit(1).stream()
-            prev_score_data = None
-            for doc in prev_docs:
-                prev_score_data = doc.to_dict()
-                break
+            prev_docs = await repo.query(user_path(user_id, 'health_scores'), (('month', '==', prev_month),), limit=1)
+            prev_score_data = prev_docs[0][1] if prev_docs else None
             
             if prev_score_data:
                 health_score['previous_score'] = prev_score_data.get('score')
@@ -2817,10 +6243,10 @@ async def get_health_score(user_id: str):
         except:
             pass
         
-        # Store current score
+        # Store current score (written behind the response)
         try:
-            health_history = db.collection('users').document(user_id).collection('health_scores')
-            health_history.add(health_score)
+            health_history = user_path(user_id, 'health_scores')
+            write_behind_queue.enqueue(f"{health_history}/{repo.new_id(health_history)}", dict(health_score))
         except:
             pass
         
@@ -2832,6 +6258,315 @@ async def get_health_score(user_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error calculating health score: {str(e)}")
 
+# ==================== DATA EXPORT ====================
+
+class _ZipChunkSink:
+    """Write-only file object for zipfile that hands back what was written since the last drain"""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def _export_file_name(document: Dict[str, Any]) -> str:
+    extension = document.get('file_url', '').rsplit('.', 1)[-1].lower() or 'pdf'
+    document_type = re.sub(r'[^a-z0-9_-]+', '_', str(document.get('document_type', 'other')).lower())
+    return f"documents/{document_type}/{document['id']}.{extension}"
+
+async def _fetch_export_file(document: Dict[str, Any]) -> tuple:
+    """(file bytes or None, error) for one document; a missing file does not fail the export"""
+    file_url = document.get('file_url')
+    if not file_url:
+        return None, "no file"
+    try:
+        content = await asyncio.to_thread(blob_store.download, blob_store.name_from_url(file_url))
+        return content, None if content is not None else "file not found in storage"
+    except Exception as e:
+        return None, str(e)
+
+async def iter_user_export(user_id: str, documents: List[Dict[str, Any]]):
+    """
+    Yield a ZIP of the user's files, a manifest.json of their document metadata and the computed
+    tax_summary.json, as it is built. Files are fetched EXPORT_PREFETCH ahead of the one being
+    written, so memory stays bounded by a few files whatever the archive size.
+    """
+    sink = _ZipChunkSink()
+    archive = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED)
+    manifest = []
+    pending = deque()
+    next_index = 0
+    try:
+        while next_index < len(documents) or pending:
+            while next_index < len(documents) and len(pending) < EXPORT_PREFETCH:
+                pending.append(asyncio.ensure_future(_fetch_export_file(documents[next_index])))
+                next_index += 1
+            document = documents[next_index - len(pending)]
+            content, error = await pending.popleft()
+            
+            entry = {**convert_firestore_datetime_to_iso(document), "archive_path": None}
+            if content is not None:
+                entry["archive_path"] = _export_file_name(document)
+                entry["size"] = len(content)
+                # PDFs are already compressed, so they are stored as-is
+                await asyncio.to_thread(archive.writestr, entry["archive_path"], content, zipfile.ZIP_STORED)
+            else:
+                entry["export_error"] = error
+            manifest.append(entry)
+            del content
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+        
+        tax_summary = calculate_tax_summary(documents) if documents else None
+        archive.writestr("tax_summary.json", json.dumps(convert_firestore_datetime_to_iso(tax_summary), indent=2, default=str))
+        archive.writestr("manifest.json", json.dumps({
+            "user_id": user_id,
+            "exported_at": datetime.utcnow().isoformat(),
+            "document_count": len(documents),
+            "documents": manifest
+        }, indent=2, default=str))
+        archive.close()
+        yield sink.drain()
+    finally:
+        for task in pending:
+            task.cancel()
+
+@app.get("/export/{user_id}")
+async def export_user_data(user_id: str):
+    """Download everything the user has uploaded, with metadata and tax summary, as a streamed ZIP"""
+    try:
+        documents = await fetch_user_documents(user_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error exporting documents: {str(e)}")
+    documents.sort(key=lambda document: str(document.get('uploaded_at', '')))
+    
+    filename = f"taxmate_export_{user_id}_{datetime.utcnow().strftime('%Y%m%d')}.zip"
+    return StreamingResponse(
+        iter_user_export(user_id, documents),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+# ==================== DEADLINE REMINDER SCHEDULER ====================
+
+DEADLINE_LEASE_PATH = "scheduler_leases/deadline_sweep"
+DEADLINE_SWEEP_CONCURRENCY = 20  # Users whose deadlines are queried at once
+DEADLINE_SWEEP_BATCH = 200  # Users committed together; the lease is renewed before each commit
+
+def custom_deadline_nudges(custom_deadlines: List[tuple], today: date) -> List[Dict[str, Any]]:
+    """Nudges for a user's open custom deadlines that are due soon or just slipped"""
+    nudges = []
+    for deadline, due in custom_deadlines:
+        days_until = (due - today).days
+        if days_until < 0:
+            priority = "high"
+            message = f"{deadline.get('title', 'Deadline')} was due {-days_until} day{'s' if days_until != -1 else ''} ago."
+        elif days_until <= CUSTOM_DEADLINE_NUDGE_DAYS:
+            priority = "critical" if days_until <= 3 else "high" if days_until <= 7 else "medium"
+            message = f"{deadline.get('title', 'Deadline')} due in {days_until} day{'s' if days_until != 1 else ''}."
+        else:
+            continue
+        nudges.append({
+            "type": "deadline",
+            "category": "custom",
+            "title": deadline.get("title", "Deadline"),
+            "message": message,
+            "priority": priority,
+            "action": "Mark it completed once done",
+            "deadline_id": deadline.get("deadline_id"),
+            "deadline_date": datetime.combine(due, datetime.min.time()).isoformat(),
+            "days_remaining": days_until,
+            "timestamp": datetime.utcnow().isoformat()
+        })
+    return nudges
+
+async def compute_user_nudges(user_id: str, today: date, system_nudges: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """System nudges plus the user's open custom deadlines from a week ago to the nudge window"""
+    custom_deadlines = await fetch_custom_deadlines(
+        user_id, today - timedelta(days=7), today + timedelta(days=CUSTOM_DEADLINE_NUDGE_DAYS), include_completed=False
+    )
+    return system_nudges + custom_deadline_nudges(custom_deadlines, today)
+
+def _nudges_path(user_id: str) -> str:
+    return user_path(user_id, 'nudges', 'pending')
+
+async def refresh_user_nudges(user_id: str):
+    """Recompute one user's pending nudges, e.g. after their custom deadlines change"""
+    today = datetime.utcnow().date()
+    try:
+        await repo.set(_nudges_path(user_id), {
+            "date": today.isoformat(),
+            "nudges": await compute_user_nudges(user_id, today, get_upcoming_deadlines()),
+            "generated_at": firestore.SERVER_TIMESTAMP
+        })
+    except Exception as e:
+        print(f"Warning: Could not refresh nudges for user {user_id}: {e}")
+
+async def load_pending_nudges(user_id: str) -> Optional[List[Dict[str, Any]]]:
+    """Today's precomputed nudges for a user, or None if the sweep has not covered them yet"""
+    try:
+        record = await repo.get(_nudges_path(user_id))
+    except Exception as e:
+        print(f"Warning: Could not read pending nudges: {e}")
+        return None
+    if not record or record.get("date") != datetime.utcnow().date().isoformat():
+        return None
+    return record.get("nudges", [])
+
+async def sweep_deadline_nudges() -> Optional[int]:
+    """
+    Precompute today's pending nudges for every user. Users are streamed and committed
+    DEADLINE_SWEEP_BATCH at a time, renewing the lease before each commit so a long sweep keeps
+    it. Returns the number of users swept, or None if another worker took the lease meanwhile.
+    """
+    today = datetime.utcnow().date()
+    system_nudges = get_upcoming_deadlines()  # Same for everyone, computed once per sweep
+    semaphore = asyncio.Semaphore(DEADLINE_SWEEP_CONCURRENCY)
+    
+    async def sweep_user(user_id: str) -> Optional[tuple]:
+        async with semaphore:
+            try:
+                nudges = await compute_user_nudges(user_id, today, system_nudges)
+            except Exception as e:
+                print(f"Warning: Could not compute nudges for user {user_id}: {e}")
+                return None
+        return ("set", _nudges_path(user_id), {
+            "date": today.isoformat(),
+            "nudges": nudges,
+            "generated_at": firestore.SERVER_TIMESTAMP
+        })
+    
+    async def sweep_batch(user_ids: List[str]) -> Optional[int]:
+        writes = [write for write in await asyncio.gather(*(sweep_user(user_id) for user_id in user_ids)) if write]
+        # Renewing right before the commit also confirms this worker still leads
+        if await acquire_scheduler_lease() is None:
+            return None
+        await repo.commit(writes)
+        return len(writes)
+    
+    swept = 0
+    batch = []
+    # iter_ids also yields users that only exist as a parent of subcollections
+    async for user_id in repo.iter_ids('users'):
+        batch.append(user_id)
+        if len(batch) < DEADLINE_SWEEP_BATCH:
+            continue
+        batch_swept = await sweep_batch(batch)
+        if batch_swept is None:
+            return None
+        swept += batch_swept
+        batch = []
+    if batch:
+        batch_swept = await sweep_batch(batch)
+        if batch_swept is None:
+            return None
+        swept += batch_swept
+    return swept
+
+async def acquire_scheduler_lease() -> Optional[Dict[str, Any]]:
+    """
+    Take or renew the deadline sweep lease for this worker. Returns the lease if this worker is
+    the leader, or None while another worker's lease is still live.
+    """
+    def take(lease: Optional[Dict[str, Any]]) -> tuple:
+        lease = lease or {}
+        now = datetime.now(timezone.utc)
+        expires_at = lease.get("expires_at")
+        if lease.get("holder") not in (None, SCHEDULER_WORKER_ID) and expires_at and expires_at > now:
+            return None, None
+        lease.update({
+            "holder": SCHEDULER_WORKER_ID,
+            "expires_at": now + timedelta(seconds=DEADLINE_SCHEDULER_LEASE_SECONDS)
+        })
+        return lease, lease
+    
+    return await repo.transform(DEADLINE_LEASE_PATH, take)
+
+async def record_sweep(day: date):
+    """Mark the day as swept, unless another worker has taken the lease since"""
+    def record(lease: Optional[Dict[str, Any]]) -> tuple:
+        if not lease or lease.get("holder") != SCHEDULER_WORKER_ID:
+            return None, None
+        return {**lease, "last_sweep_date": day.isoformat(), "last_sweep_at": datetime.now(timezone.utc)}, None
+    
+    await repo.transform(DEADLINE_LEASE_PATH, record)
+
+async def release_scheduler_lease():
+    """Give up the lease on shutdown so another worker can take over without waiting for expiry"""
+    def release(lease: Optional[Dict[str, Any]]) -> tuple:
+        if lease and lease.get("holder") == SCHEDULER_WORKER_ID:
+            return {**lease, "holder": None, "expires_at": None}, None
+        return None, None
+    
+    await repo.transform(DEADLINE_LEASE_PATH, release)
+
+async def run_deadline_scheduler():
+    """Every worker polls for the lease; the leader runs the sweep once per UTC day"""
+    while True:
+        try:
+            lease = await acquire_scheduler_lease()
+            today = datetime.utcnow().date()
+            if lease and lease.get("last_sweep_date") != today.isoformat():
+                started = time.perf_counter()
+                swept = await sweep_deadline_nudges()
+                if swept is None:
+                    print("Deadline sweep stopped: another worker took over the lease")
+                else:
+                    await record_sweep(today)
+                    print(f"Deadline sweep: {swept} users in {time.perf_counter() - started:.1f}s")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Warning: Deadline scheduler tick failed: {e}")
+        await asyncio.sleep(DEADLINE_SCHEDULER_POLL_SECONDS)
+
+deadline_scheduler_task: Optional[asyncio.Task] = None
+blob_cleanup_task: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def load_persisted_caches():
+    """Restore caches persisted by a previous run and start background workers"""
+    global deadline_scheduler_task, blob_cleanup_task
+    write_behind_queue.start()
+    blob_cleanup_task = asyncio.create_task(run_blob_cleanup_retries())
+    if CHAT_CACHE_ENABLED:
+        await asyncio.to_thread(semantic_chat_cache.load)
+    if CA_CATALOGUE_ENABLED:
+        await load_ca_catalogue()
+    if KB_ENABLED:
+        # Embed the knowledge base in the background so startup is not held up by the model load
+        spawn_background_task(asyncio.to_thread(preload_knowledge_base))
+    if DEADLINE_SCHEDULER_ENABLED:
+        deadline_scheduler_task = asyncio.create_task(run_deadline_scheduler())
+
+@app.on_event("shutdown")
+async def persist_caches():
+    """Persist in-memory caches and queued writes, and release connections, before the worker exits"""
+    if blob_cleanup_task:
+        blob_cleanup_task.cancel()
+    if deadline_scheduler_task:
+        deadline_scheduler_task.cancel()
+        try:
+            await release_scheduler_lease()
+        except Exception as e:
+            print(f"Warning: Could not release deadline scheduler lease: {e}")
+    await write_behind_queue.stop()
+    await close_places_client()
+    if _pdf_render_executor is not None:
+        _pdf_render_executor.shutdown(wait=False, cancel_futures=True)
+    if CHAT_CACHE_ENABLED:
+        await asyncio.to_thread(semantic_chat_cache.save)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -51,6 +51,17 @@ GEMINI_API_KEY=your-gemini-api-key
 # Google Cloud Vision (optional for image processing)
 GOOGLE_APPLICATION_CREDENTIALS=path/to/service-account.json
 
+# Data backend: firebase, or memory for load tests without GCP (nothing is persisted)
+# DATA_BACKEND=memory
+# MEMORY_BACKEND_LATENCY_MS=20
+# MEMORY_BACKEND_JITTER_MS=10
+
+# File storage: firebase, memory, or local (files on disk served from /files)
+# STORAGE_BACKEND=local
+# LOCAL_STORAGE_DIR=./storage
+# PUBLIC_BASE_URL=http://localhost:8000
+# UPLOAD_SIGNING_SECRET=change-me  # Signs direct-upload URLs; required for local storage
+
 # Server Configuration
 HOST=0.0.0.0
 PORT=8000
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# server.py configures its backends at import time; tests run against the in-memory ones
+os.environ["DATA_BACKEND"] = "memory"
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ["MEMORY_BACKEND_LATENCY_MS"] = "0"
+os.environ["MEMORY_BACKEND_JITTER_MS"] = "0"
+os.environ.pop("LOCAL_CACHE_DIR", None)
+os.environ.pop("GEMINI_API_KEY", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def memory_repo(monkeypatch):
+    """A fresh in-memory repository in place of the module's repo"""
+    repository = server.InMemoryRepository()
+    monkeypatch.setattr(server, "repo", repository)
+    return repository
+
+
+@pytest.fixture
+def memory_blob_store(monkeypatch):
+    """A fresh in-memory blob store in place of the module's blob_store"""
+    store = server.InMemoryBlobStore()
+    monkeypatch.setattr(server, "blob_store", store)
+    return store
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def blobs(memory_repo, memory_blob_store, monkeypatch):
+    monkeypatch.setattr(server, "blob_stats", server.Counter())
+    return memory_repo, memory_blob_store
+
+
+def _record(repo, blob_hash):
+    return run(repo.get(server._blob_record_path(blob_hash)))
+
+
+def test_repeat_content_is_stored_once(blobs):
+    repo, store = blobs
+    url, blob_hash = run(server.store_blob(b"%PDF form16", "form16.pdf"))
+    same_url, same_hash = run(server.store_blob(b"%PDF form16", "copy.pdf"))
+    assert (same_url, same_hash) == (url, blob_hash)
+    assert _record(repo, blob_hash)["ref_count"] == 2
+    assert len(store.blobs) == 1
+    assert server.blob_stats["uploaded"] == 1 and server.blob_stats["deduplicated"] == 1
+
+
+def test_object_is_deleted_with_the_last_reference(blobs):
+    repo, store = blobs
+    _, blob_hash = run(server.store_blob(b"%PDF salary slip", "slip.pdf"))
+    run(server.store_blob(b"%PDF salary slip", "slip.pdf"))
+    assert run(server.release_blob(blob_hash)) is False
+    assert _record(repo, blob_hash)["ref_count"] == 1 and len(store.blobs) == 1
+    assert run(server.release_blob(blob_hash)) is True
+    assert _record(repo, blob_hash) is None and store.blobs == {}
+    # Releasing content that is no longer referenced is a no-op
+    assert run(server.release_blob(blob_hash)) is False
+
+
+def test_concurrent_uploads_of_new_content_keep_one_object(blobs):
+    repo, store = blobs
+
+    async def upload_many():
+        return await asyncio.gather(*(server.store_blob(b"%PDF same bytes", f"{i}.pdf") for i in range(10)))
+
+    results = run(upload_many())
+    blob_hash = results[0][1]
+    assert len({url for url, _ in results}) == 1
+    assert _record(repo, blob_hash)["ref_count"] == 10
+    assert len(store.blobs) == 1
+
+
+def test_upload_after_the_last_release_gets_a_fresh_object(blobs):
+    repo, store = blobs
+    first_url, blob_hash = run(server.store_blob(b"%PDF rent receipt", "rent.pdf"))
+    run(server.release_blob(blob_hash))
+    second_url, _ = run(server.store_blob(b"%PDF rent receipt", "rent.pdf"))
+    assert second_url != first_url
+    assert _record(repo, blob_hash)["ref_count"] == 1 and len(store.blobs) == 1
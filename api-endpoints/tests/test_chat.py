@@ -0,0 +1,71 @@
+import pytest
+
+from server import classify_chat_intent, sanitize_chat_response
+
+
+def test_sanitize_empty_response():
+    assert sanitize_chat_response("") == ""
+    assert sanitize_chat_response(None) == ""
+
+
+def test_sanitize_short_response_is_collapsed_not_bulleted():
+    assert sanitize_chat_response("**Hello**   there.") == "Hello there."
+
+
+def test_sanitize_keeps_list_structure_and_drops_duplicates():
+    raw = (
+        "Here are your options:\n"
+        "- Invest in **PPF** under 80C.\n"
+        "- Invest in PPF under 80C.\n"
+        "- Buy health insurance for 80D\n"
+        "  which also covers parents.\n"
+    )
+    assert sanitize_chat_response(raw + "Keep every receipt for your records.") == (
+        "• Invest in PPF under 80C.\n"
+        "• Buy health insurance for 80D which also covers parents.\n"
+        "• Keep every receipt for your records."
+    )
+
+
+def test_sanitize_splits_long_prose_into_bounded_bullets():
+    raw = " ".join([
+        "Salary is taxed under the head income from salaries.",
+        "Rent you receive counts as house property income.",
+        "Bank interest belongs under other sources.",
+        "Selling shares creates capital gains, short or long term.",
+        "Freelance work is reported as business or profession.",
+        "Dividends are added to your total income at slab rates.",
+        "Gifts above fifty thousand rupees from non-relatives are taxable.",
+        "Lottery winnings attract a flat thirty percent rate.",
+        "Crypto transfers are taxed at thirty percent with one percent TDS.",
+        "Agricultural income is exempt but affects the rate on other income.",
+    ])
+    bullets = sanitize_chat_response(raw).split("\n")
+    assert 1 < len(bullets) <= 8
+    assert all(bullet.startswith("• ") for bullet in bullets)
+
+
+@pytest.mark.parametrize("message, intent", [
+    ("How much 80C room do I have left?", "deduction_80c"),
+    ("How much more can I invest in NPS?", "deduction_nps"),
+    ("What is my tax payable?", "tax_payable"),
+    ("Will I get a refund?", "tax_refund"),
+    ("How much TDS was deducted from my salary?", "tds_deducted"),
+    ("When is the next deadline?", "next_deadline"),
+    ("How can I save more tax?", "tax_saving"),
+])
+def test_classify_routes_personal_questions_to_the_tax_engine(message, intent):
+    assert classify_chat_intent(message) == intent
+
+
+@pytest.mark.parametrize("message", [
+    "What is the 80C limit?",  # Knowledge question, not about this user
+    "What is NPS?",
+    "Which investments qualify for my 80C?",  # About the rules, not the room left
+    "How much tax do I pay on my FD interest?",  # One income head, not the aggregate
+    "How much 80D can I still claim?",  # Limit depends on ages the engine does not know
+    "Is my health insurance enough?",
+    "Tell me about tax regimes",
+])
+def test_classify_leaves_other_questions_to_gemini(message):
+    assert classify_chat_intent(message) is None
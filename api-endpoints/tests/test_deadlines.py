@@ -0,0 +1,42 @@
+from datetime import date, datetime, timezone
+
+from server import build_deadlines_ics
+
+
+def _custom(deadline_id, due, **fields):
+    return {"deadline_id": deadline_id, "title": "Pay advance tax", **fields}, due
+
+
+def test_ics_is_a_well_formed_calendar():
+    body = build_deadlines_ics([], date(2024, 7, 1))
+    assert body.startswith("BEGIN:VCALENDAR\r\nVERSION:2.0\r\n")
+    assert body.endswith("END:VCALENDAR\r\n")
+    assert "\n" not in body.replace("\r\n", "")
+    assert body.count("BEGIN:VEVENT") == body.count("END:VEVENT") > 0
+    for line in body.split("\r\n"):
+        assert len(line.encode("utf-8")) <= 75
+
+
+def test_ics_covers_previous_current_and_next_financial_years():
+    body = build_deadlines_ics([], date(2024, 7, 1))
+    for financial_year in ("2023-24", "2024-25", "2025-26"):
+        assert f"UID:fy{financial_year}-" in body
+
+
+def test_ics_includes_open_custom_deadlines_only():
+    created = datetime(2024, 6, 1, 9, 30, tzinfo=timezone.utc)
+    body = build_deadlines_ics([
+        _custom("open1", date(2024, 9, 15), created_at=created, description="Second instalment; 45%"),
+        _custom("done1", date(2024, 6, 15), is_completed=True),
+    ], date(2024, 7, 1))
+    unfolded = body.replace("\r\n ", "")
+    assert "UID:custom-open1@" in unfolded
+    assert "DTSTART;VALUE=DATE:20240915" in unfolded
+    assert "DTSTAMP:20240601T093000Z" in unfolded
+    assert r"DESCRIPTION:Second instalment\; 45%" in unfolded
+    assert "custom-done1" not in unfolded
+
+
+def test_ics_is_stable_for_the_same_inputs():
+    deadlines = [_custom("open1", date(2024, 9, 15))]
+    assert build_deadlines_ics(deadlines, date(2024, 7, 1)) == build_deadlines_ics(deadlines, date(2024, 7, 1))
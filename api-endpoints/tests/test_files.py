@@ -0,0 +1,55 @@
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+
+from server import compute_pdf_cache_key, parse_byte_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=900-5000", (900, 999)),  # End past the file is clamped
+    ("bytes=-5000", (0, 999)),  # Suffix longer than the file is the whole file
+])
+def test_parse_byte_range(header, expected):
+    assert parse_byte_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", [None, "", "items=0-10", "bytes=0-10,20-30", "bytes=a-b"])
+def test_parse_byte_range_sends_the_whole_file(header):
+    assert parse_byte_range(header, 1000) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=500-100"])
+def test_parse_byte_range_rejects_unsatisfiable_ranges(header):
+    with pytest.raises(HTTPException) as error:
+        parse_byte_range(header, 1000)
+    assert error.value.status_code == 416
+    assert error.value.headers["Content-Range"] == "bytes */1000"
+
+
+def test_pdf_cache_key_ignores_key_order():
+    assert compute_pdf_cache_key("tax_summary", {"a": 1, "b": [1, 2]}) == \
+        compute_pdf_cache_key("tax_summary", {"b": [1, 2], "a": 1})
+
+
+def test_pdf_cache_key_changes_with_kind_and_inputs():
+    payload = {"documents": [{"id": "d1", "amount": 100}]}
+    key = compute_pdf_cache_key("tax_summary", payload)
+    assert compute_pdf_cache_key("itr_preview", payload) != key
+    assert compute_pdf_cache_key("tax_summary", {"documents": [{"id": "d1", "amount": 101}]}) != key
+
+
+def test_pdf_cache_key_hashes_datetimes_by_value():
+    stamp = datetime(2024, 7, 31, 12, 0, tzinfo=timezone.utc)
+    assert compute_pdf_cache_key("itr_preview", {"uploaded_at": stamp}) == \
+        compute_pdf_cache_key("itr_preview", {"uploaded_at": datetime(2024, 7, 31, 12, 0, tzinfo=timezone.utc)})
+
+
+def test_pdf_cache_key_follows_the_template_version(monkeypatch):
+    import server
+    key = compute_pdf_cache_key("tax_summary", {})
+    monkeypatch.setattr(server, "PDF_TEMPLATE_VERSION", server.PDF_TEMPLATE_VERSION + "-next")
+    assert compute_pdf_cache_key("tax_summary", {}) != key
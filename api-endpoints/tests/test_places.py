@@ -0,0 +1,21 @@
+import pytest
+
+from server import geohash_center, geohash_encode
+
+
+@pytest.mark.parametrize("latitude, longitude, precision, expected", [
+    (57.64911, 10.40744, 11, "u4pruydqqvj"),
+    (0.0, 0.0, 5, "s0000"),
+    (-90.0, -180.0, 4, "0000"),
+])
+def test_geohash_encode(latitude, longitude, precision, expected):
+    assert geohash_encode(latitude, longitude, precision) == expected
+
+
+def test_geohash_prefixes_nest():
+    assert geohash_encode(12.9716, 77.5946, 8).startswith(geohash_encode(12.9716, 77.5946, 5))
+
+
+def test_geohash_center_lies_in_its_cell():
+    cell = geohash_encode(12.9716, 77.5946, 6)
+    assert geohash_encode(*geohash_center(cell), 6) == cell
@@ -0,0 +1,102 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from google.api_core.exceptions import NotFound
+
+from server import DELETE_DOCUMENT
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def users(memory_repo):
+    async def seed():
+        await memory_repo.set("users/u1", {"name": "Asha", "age": 34, "tags": ["salaried"], "city": "Pune"})
+        await memory_repo.set("users/u2", {"name": "Ravi", "age": 61, "tags": ["senior", "pensioner"]})
+        await memory_repo.set("users/u3", {"name": "Meera", "age": "unknown"})
+        await memory_repo.set("users/u1/documents/d1", {"name": "Form 16"})
+    run(seed())
+    return memory_repo
+
+
+def test_query_filters_like_firestore(users):
+    async def check():
+        assert [doc_id for doc_id, _ in await users.query("users", [("age", ">=", 30)], order_by="age")] == ["u1", "u2"]
+        assert [doc_id for doc_id, _ in await users.query("users", [("tags", "array_contains", "senior")])] == ["u2"]
+        assert [doc_id for doc_id, _ in await users.query("users", [("city", "==", "Pune")])] == ["u1"]
+        # Range filters never match values of another type, and missing fields never match
+        assert [doc_id for doc_id, _ in await users.query("users", [("age", "<", 100)])] == ["u1", "u2"]
+        assert await users.query("users", [("pan", "!=", "X")]) == []
+    run(check())
+
+
+def test_query_orders_limits_and_projects(users):
+    async def check():
+        results = await users.query("users", [("age", ">", 0)], order_by="age", descending=True, limit=1, fields=["name"])
+        assert results == [("u2", {"name": "Ravi"})]
+        # Documents without the ordering field are left out, as in Firestore
+        assert [doc_id for doc_id, _ in await users.query("users", order_by="city")] == ["u1"]
+    run(check())
+
+
+def test_query_only_returns_direct_children(users):
+    async def check():
+        assert sorted(doc_id for doc_id, _ in await users.query("users")) == ["u1", "u2", "u3"]
+        assert [doc_id for doc_id, _ in await users.query("users/u1/documents")] == ["d1"]
+    run(check())
+
+
+def test_results_are_copies(users):
+    async def check():
+        (_, data), = await users.query("users", [("city", "==", "Pune")])
+        data["tags"].append("changed")
+        assert (await users.get("users/u1"))["tags"] == ["salaried"]
+    run(check())
+
+
+def test_naive_datetimes_are_stored_as_utc(memory_repo):
+    async def check():
+        await memory_repo.set("events/e1", {"at": datetime(2024, 7, 31, 10, 0)})
+        assert (await memory_repo.get("events/e1"))["at"] == datetime(2024, 7, 31, 10, 0, tzinfo=timezone.utc)
+    run(check())
+
+
+def test_transform_sets_deletes_and_leaves_documents(memory_repo):
+    async def check():
+        assert await memory_repo.transform("counters/c", lambda data: ({"n": 1}, "created")) == "created"
+        assert await memory_repo.transform("counters/c", lambda data: (None, data["n"])) == 1
+        assert await memory_repo.get("counters/c") == {"n": 1}
+        assert await memory_repo.transform("counters/c", lambda data: (DELETE_DOCUMENT, "gone")) == "gone"
+        assert await memory_repo.get("counters/c") is None
+    run(check())
+
+
+def test_concurrent_transforms_do_not_lose_updates(memory_repo):
+    async def increment():
+        def add_one(data):
+            count = (data or {}).get("n", 0) + 1
+            return {"n": count}, count
+        return await memory_repo.transform("counters/c", add_one)
+
+    async def check():
+        results = await asyncio.gather(*(increment() for _ in range(50)))
+        assert sorted(results) == list(range(1, 51))
+        assert await memory_repo.get("counters/c") == {"n": 50}
+    run(check())
+
+
+def test_commit_is_atomic_on_a_failed_precondition(memory_repo):
+    async def check():
+        await memory_repo.set("docs/a", {"v": 1})
+        with pytest.raises(NotFound):
+            await memory_repo.commit([
+                ("set", "docs/b", {"v": 2}),
+                ("delete_existing", "docs/missing", None),
+            ])
+        assert await memory_repo.get("docs/b") is None
+        await memory_repo.commit([("update", "docs/a", {"w": 3}), ("delete", "docs/missing", None)])
+        assert await memory_repo.get("docs/a") == {"v": 1, "w": 3}
+    run(check())